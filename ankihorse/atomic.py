@@ -0,0 +1,46 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+"""
+atomic
+======
+
+Writes files so that readers only ever see the old file or the new one.
+
+The content is written to a hidden temporary file in the same directory
+and renamed over the destination once complete, so a failed write never
+leaves a partial file behind. Used for the config file, the example index
+and the media written straight into the collection.
+
+"""
+import os
+import tempfile
+
+
+def write_atomically(path, write, prefix='.ankihorse', replace=True):
+    """Writes the file at `path` atomically.
+
+    Args:
+        path (str): the destination file.
+        write (Callable[[str], None]): writes the content to the path it
+            is given, a temporary file next to `path`.
+        prefix (str): the start of the temporary file's name.
+        replace (bool): if False and `path` already exists, the existing
+            file is kept and the new content discarded.
+
+    """
+    directory = os.path.dirname(path) or '.'
+    handle, temp_path = tempfile.mkstemp(dir=directory, prefix=prefix)
+    os.close(handle)
+    try:
+        write(temp_path)
+        if os.path.exists(path):
+            if not replace:
+                os.remove(temp_path)
+                return
+            if os.name == 'nt':
+                os.remove(path)  # rename can't overwrite on Windows
+        os.rename(temp_path, path)
+    except:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
@@ -1,19 +1,94 @@
 #!/usr/bin/env python
 # -*- encoding: utf-8 -*-
-import urllib
 import urllib2
 import json
 import os
 
-from aqt import mw
-from aqt.utils import showInfo, getText
-
-from .config import ConfigParser, CONFIG_FILE
-from .cognitive_services import bing_image
+try:
+    from aqt import mw
+    from aqt.utils import showInfo, getText
+except ImportError:
+    mw = showInfo = getText = None  # no GUI; see headless.install
+
+from .cache import DiskCache, MetadataCache, make_key
+from .config import store
+from .httpclient import default_client, DownloadError
+from .ratelimit import limiter, QuotaExceeded
+from .retry import classify, default_policy, AUTH, PERMANENT
+from .stats import timed
+from .cognitive_services import (bing_image_search, download,
+                                 first_acceptable_image, IMAGE_CONTENT_TYPES)
 from .updateraddon import Addon, FieldUpdater, AnySourceFieldUpdater
+from .media import add_file
 from .sanitise import sanitise
 
 
+DIRECTORY = os.path.dirname(__file__)
+
+_search_cache = None
+_image_cache = None
+
+def search_cache():
+    """Returns the cache of image search results.
+
+    Maps (provider, locale, query) to result metadata. Size and time to
+    live are read from the 'cache' section of the config.
+
+    """
+    global _search_cache
+    if _search_cache is None:
+        entries = store.get_int('cache', 'search cache entries', 100000,
+                                minimum=1)
+        days = store.get_float('cache', 'search cache ttl days', 30,
+                               minimum=0)
+        path = os.path.join(DIRECTORY, 'cache', 'search.sqlite')
+        _search_cache = MetadataCache(path, entries, days * 86400.0)
+    return _search_cache
+
+def image_cache():
+    """Returns the on-disk cache of downloaded images, keyed by url."""
+    global _image_cache
+    if _image_cache is None:
+        directory = os.path.join(DIRECTORY, 'cache', 'images')
+        _image_cache = DiskCache(directory, store.cache_bytes('image', 512))
+    return _image_cache
+
+def _cache_config_changed(section, option, value):
+    global _search_cache, _image_cache
+    if option.startswith('search cache'):
+        _search_cache = None
+    elif option == 'image cache size mb':
+        _image_cache = None
+
+store.subscribe(_cache_config_changed, 'cache')
+
+def max_image_bytes():
+    """Returns the size above which images aren't downloaded.
+
+    Read from 'max image size mb' in the 'downloads' section of the config.
+
+    """
+    megabytes = store.get_float('downloads', 'max image size mb', 5,
+                                minimum=0)
+    return int(megabytes * 1024 * 1024)
+
+def cached_download(url, suffix):
+    """Returns the path to a cached copy of `url`, downloading on a miss.
+
+    Raises:
+        DownloadError: if the url isn't an image or is too large.
+
+    """
+    cache = image_cache()
+    key = make_key(url)
+    path = cache.get(key)
+    if path is None:
+        temp = download(url, suffix, max_image_bytes(), IMAGE_CONTENT_TYPES,
+                        cache.staging_directory())
+        path = cache.put(key, temp, suffix)
+    return path
+
+
 class GoogleImageFieldUpdater(FieldUpdater):
     """Downloads an image from Google and sets a field accordingly.
     
@@ -39,6 +114,9 @@ class GoogleImageFieldUpdater(FieldUpdater):
         self._query_fields = query_field_names
         self._target_field = target_field_name
 
+    def sourceFields(self): return self._query_fields
+    def targetFields(self): return [self._target_field]
+
     def shouldModify(self, model):
         """Tests whether a model should be modified.
 
@@ -91,10 +169,9 @@ class GoogleImageFieldUpdater(FieldUpdater):
             showInfo("Image not found.")
             return False
 
-        mw.col.media.addFile(os.path.abspath(unicode(filename)))
-        os.remove(filename)
+        name = add_file(filename, mw.col.media.dir())
 
-        dst_text = u'<img src="{}" />'.format(os.path.basename(filename))
+        dst_text = u'<img src="{}" />'.format(name)
         note[self._target_field] = dst_text
 
         return True
@@ -108,15 +185,14 @@ class GoogleImageFieldUpdater(FieldUpdater):
             url (str): Takes a query and returns a url of a jpg image.
 
         Returns:
-            (str) The filename of the saved image, NOT_FOUND_FILENAME on fail.
+            (str | None) The path of the image in the image cache, or None
+                on failure.
             
         """
         result = None
-        name = url.split('/')[-1]
-        filename = os.path.join(clazz.DIRECTORY, name)
+        name = url.split('/')[-1].split('?')[0]
         try:
-            urllib.urlretrieve(url, filename)
-            result = filename
+            result = cached_download(url, os.path.splitext(name)[1])
         finally:
             return result
 
@@ -131,15 +207,26 @@ class GoogleImageFieldUpdater(FieldUpdater):
             (str | None) The url of the image, or None if failure.
             
         """
+        key = make_key('google', '', query)
+        cached = search_cache().get(key)
+        if cached:
+            return cached['link']
+
         params = { 'q': query.encode('utf-8')
                  , 'key': clazz.API_KEY
                  , 'cx': clazz.CX
                  , 'searchType': 'image'
                  }
 
-        url = clazz.SEARCH_URL + '?' + urllib.urlencode(params)
         try:
-            response = urllib2.urlopen(url)
+            with timed('google search', 'search'):
+                response = default_policy.call(
+                        default_client.request, 'GET', clazz.SEARCH_URL,
+                        params, limiter=limiter('google search'))
+                result = json.loads(response.read())
+        except QuotaExceeded as e:
+            showInfo(str(e) + " Try again tomorrow.")
+            return None
         except urllib2.HTTPError as e:
             if e.code == 403:
                 showInfo("403 Forbidden. You're probably out of google \
@@ -147,10 +234,14 @@ requests. Try again tomorrow.")
                 return None
             else:
                 raise
-        result = json.load(response)
-        return result['items'][0]['link']
+        link = result['items'][0]['link']
+        search_cache().put(key, {'link': link})
+        return link
 
 class BingImageFieldUpdater(AnySourceFieldUpdater):
+    pipelined = True
+    overwrites = False
+
     def __init__(self, query_field_names, target_field_name, locale):
         """Initialiser.
 
@@ -167,19 +258,14 @@ class BingImageFieldUpdater(AnySourceFieldUpdater):
         AnySourceFieldUpdater.__init__(self, query_field_names, target_field_name)
         self.locale = locale
 
-        parser = ConfigParser()
-        section = 'cognitive services'
-        option = 'bing search api key'
-        if parser.read(CONFIG_FILE) and parser.has_option(section, option):
-            self.api_key = parser.get(section, option)
-        else:
+        self.api_key = store.api_key('bing search')
+        if not self.api_key:
             prompt = 'Please input API key for the Bing Search API.'
             self.api_key = getText(prompt)[0].encode('utf-8')
-            if not parser.has_section(section):
-                parser.add_section(section)
-            parser.set(section, option, self.api_key)
-            with open(CONFIG_FILE, 'w') as f:
-                parser.write(f)
+            store.set_api_key('bing search', self.api_key)
+
+    def settingsKey(self):
+        return 'bing {}'.format(self.locale)
 
     def modifyFields(self, note):
         """Modifies the fields of note.
@@ -196,32 +282,96 @@ class BingImageFieldUpdater(AnySourceFieldUpdater):
             (bool) True iff the note was modified.
 
         """
-        for f in filter(lambda f: f in note, self.sourceFields()):
-            query = sanitise(mw.col.media.strip(note[f]))
-            if query:
-                break
+        query = self.queryFor(note)
+        if query is None:
+            return False
+        return self.applyFetched(note, query, self.fetch(query))
+
+    def queryFor(self, note):
+        """Returns the search query for note, or None if blank."""
+        query = None
+        with timed('text', 'sanitise'):
+            for f in filter(lambda f: f in note, self.sourceFields()):
+                query = sanitise(mw.col.media.strip(note[f]))
+                if query:
+                    break
 
         if not query:
-            return False
+            return None
 
         if note[self.target_field]:
-            return False
+            return None
 
-        filepath = self.get_file(query.encode('utf-8'))
-        mw.col.media.addFile(os.path.abspath(unicode(filepath)))
-        dest = u'<img src="{}" />'.format(os.path.basename(filepath))
-        note[self.targetFields()[0]] = dest
+        return query
+
+    def fetch(self, query):
+        """Downloads an image for query and returns the path to the file.
 
-        if os.path.isfile(filepath):
-            os.remove(filepath)
+        Returns None if there is no acceptable image.
+
+        """
+        try:
+            return self.get_file(query.encode('utf-8'))
+        except DownloadError:
+            return None
+
+    def applyFetched(self, note, query, filepath):
+        if filepath is None:
+            return False
+        name = add_file(filepath, mw.col.media.dir())
+        dest = u'<img src="{}" />'.format(name)
+        note[self.targetFields()[0]] = dest
 
         return True
 
     def get_file(self, text):
-        return bing_image(self.api_key, self.locale, text)
+        """Returns the path to a cached image for text, fetching on a miss.
+
+        If the image url has gone, e.g. with a 404, or no longer serves an
+        acceptable image, the search result is forgotten so that the next
+        attempt searches again.
+
+        Raises:
+            DownloadError: if no result is an acceptable image, or the
+                image is gone.
+
+        """
+        key = make_key('bing', self.locale, text)
+        image = search_cache().get(key)
+        if image is None:
+            results = bing_image_search(self.api_key, self.locale, text)
+            result = first_acceptable_image(results, max_image_bytes())
+            if result is None:
+                raise DownloadError('No image for {!r} is small enough.'
+                                    .format(text))
+            image = { 'contentUrl': result['contentUrl']
+                    , 'encodingFormat': result['encodingFormat']
+                    }
+            search_cache().put(key, image)
+        suffix = '.' + image['encodingFormat']
+        try:
+            return cached_download(image['contentUrl'], suffix)
+        except DownloadError:
+            # e.g. now too large, or not an image
+            search_cache().delete(key)
+            raise
+        except urllib2.HTTPError as e:
+            # the image's host isn't the provider: a 401 or 403 from it
+            # won't go away by refreshing our credentials
+            if classify(e) not in (PERMANENT, AUTH):
+                raise
+            search_cache().delete(key)
+            raise DownloadError('Image for {!r} is gone: {}.'
+                                .format(text, e))
+
+def field_updater(source_fields=['picture_src'], target_field='picture',
+        locale='en-GB'):
+    return BingImageFieldUpdater(source_fields, target_field, locale)
 
 def initialise(name='autopicture', source_fields=['picture_src'], 
         target_field='picture', locale='en-GB', model_name_substring=None,
-        on_focus_lost=False):
-    field_updater = BingImageFieldUpdater(source_fields, target_field, locale)
-    Addon(field_updater, name, model_name_substring, on_focus_lost)
+        on_focus_lost=False, fetch_workers=None,
+        async_focus_lost=None):
+    Addon(field_updater(source_fields, target_field, locale), name,
+          model_name_substring, on_focus_lost, fetch_workers,
+          async_focus_lost)
@@ -1,16 +1,30 @@
 #!/usr/bin/env python
 # -*- encoding: utf-8 -*-
+import httplib
 import urllib
+import urllib2
 import json
 import os
 import random
+import socket
 import unicodedata
 
-from aqt import mw
-from aqt.utils import showInfo, getText
-
-from .config import CONFIG_FILE, ConfigParser
-from .cognitive_services import get_jwt, bing_tts, HTTPError, MALE, FEMALE
+try:
+    from aqt import mw
+    from aqt.utils import showInfo, getText
+except ImportError:
+    mw = showInfo = getText = None  # no GUI; see headless.install
+
+from .cache import DiskCache, make_key
+from .config import store
+from .httpclient import retrieve, DownloadError
+from .media import add_file, write_file
+from .ratelimit import limiter, QuotaExceeded
+from .retry import default_policy, TransientError
+from .stats import timed
+from .cognitive_services import get_jwt, refresh_jwt, bing_tts
+from .cognitive_services import MALE, FEMALE
+from .cognitive_services import TTS_OUTPUT_FORMAT, VOICES
 from .updateraddon import Addon, AnySourceFieldUpdater
 from .sanitise import sanitise
 
@@ -49,6 +63,28 @@ LANGUAGES = { "catalan": "ca-ES"
             , "swedish (sweden)": "sv-SE"
             }
 
+_tts_cache = None
+
+def tts_cache():
+    """Returns the on-disk cache of synthesised speech.
+
+    Shared by all BingTTSFieldUpdaters. The size cap is 'tts cache size
+    mb' in the 'cache' section of the config.
+
+    """
+    global _tts_cache
+    if _tts_cache is None:
+        directory = os.path.join(DIRECTORY, 'cache', 'tts')
+        _tts_cache = DiskCache(directory, store.cache_bytes('tts', 256))
+    return _tts_cache
+
+def _cache_config_changed(section, option, value):
+    global _tts_cache
+    if option == 'tts cache size mb':
+        _tts_cache = None
+
+store.subscribe(_cache_config_changed, 'cache')
+
 class VoiceRSSFieldUpdater(AnySourceFieldUpdater):
     """Downloads TTS from VoiceRSS and sets a field accordingly.
     
@@ -87,6 +123,9 @@ class VoiceRSSFieldUpdater(AnySourceFieldUpdater):
         else:
             raise ValueError('Not a valid language.')
 
+    def settingsKey(self):
+        return 'voicerss {}'.format(self._language_code)
+
     def modifyFields(self, note):
         """Modifies the fields of note.
 
@@ -105,6 +144,7 @@ class VoiceRSSFieldUpdater(AnySourceFieldUpdater):
             (bool) True iff the note was modified.
 
         """
+        query = None
         for f in filter(lambda f: f in note, self.sourceFields()):
             query = mw.col.media.strip(note[f])
             if query:
@@ -127,30 +167,37 @@ class VoiceRSSFieldUpdater(AnySourceFieldUpdater):
             query = query.replace(u"～", replacement)
 
         voice_url = self.buildUrl(query)
-        filepath = os.path.join(self.DIRECTORY, query + '.mp3')
-        tries = 3
-        while tries > 0:
+
+        def attempt(filepath):
             self.downloadFromURL(voice_url, filepath)
-            try:
-                assert os.path.getsize(filepath) > 512
-                break
-            except (AssertionError, os.error):
-                tries -= 1
-        if tries == 0:
+            if os.path.getsize(filepath) <= 512:
+                raise TransientError('Audio for {!r} is too short.'
+                                     .format(query))
+
+        def download(filepath):
+            default_policy.call(attempt, filepath)
+
+        try:
+            with timed('voicerss', 'synthesize'):
+                name = write_file(mw.col.media.dir(), self.fileName(query),
+                                  download)
+        except (TransientError, DownloadError, QuotaExceeded,
+                urllib2.URLError, httplib.HTTPException, socket.error,
+                os.error):
             showInfo("Failed to download audio for query {}.".format(query))
-            if os.path.isfile(filepath):
-                os.remove(filepath)
             return False
 
-        mw.col.media.addFile(os.path.abspath(unicode(filepath)))
-        if os.path.isfile(filepath):
-            os.remove(filepath)
-
-        dst_text = u'[sound:{}]'.format(os.path.basename(filepath))
+        dst_text = u'[sound:{}]'.format(name)
         note[self.targetFields()[0]] = dst_text
 
         return True
 
+    def fileName(self, query):
+        """Returns the media file name for the reading of `query`, which
+        differs with anything that changes the audio."""
+        key = make_key(self._language_code, self.FORMAT, self.RATE, query)
+        return key + u'.mp3'
+
     def buildUrl(self, query):
         """Fetches the url of an mp3 reading of `query`.
 
@@ -179,9 +226,12 @@ class VoiceRSSFieldUpdater(AnySourceFieldUpdater):
             filepath (str): The path of the destination file.
             
         """
-        urllib.urlretrieve(url, filepath)
+        retrieve(url, filepath, limiter=limiter('voicerss'))
 
 class BingTTSFieldUpdater(AnySourceFieldUpdater):
+    pipelined = True
+    overwrites = False
+
     def __init__(self, query_field_names, target_field_name, language):
         """Initialiser.
 
@@ -205,21 +255,14 @@ class BingTTSFieldUpdater(AnySourceFieldUpdater):
         else:
             raise ValueError('Not a valid language.')
 
-        self._jwt = None
-
-        parser = ConfigParser()
-        section = 'cognitive services'
-        option = 'bing speech api key'
-        if parser.read(CONFIG_FILE) and parser.has_option(section, option):
-            self.api_key = parser.get(section, option)
-        else:
+        self.api_key = store.api_key('bing speech')
+        if not self.api_key:
             prompt = 'Please input API key for the Bing Speech API.'
             self.api_key = getText(prompt)[0].encode('utf-8')
-            if not parser.has_section(section):
-                parser.add_section(section)
-            parser.set(section, option, self.api_key)
-            with open(CONFIG_FILE, 'w') as f:
-                parser.write(f)
+            store.set_api_key('bing speech', self.api_key)
+
+    def settingsKey(self):
+        return 'bing {} {}'.format(self._language_code, TTS_OUTPUT_FORMAT)
 
     def modifyFields(self, note):
         """Modifies the fields of note.
@@ -236,42 +279,82 @@ class BingTTSFieldUpdater(AnySourceFieldUpdater):
             (bool) True iff the note was modified.
 
         """
-        for f in filter(lambda f: f in note, self.sourceFields()):
-            query = sanitise(mw.col.media.strip(note[f]))
-            if query:
-                break
+        query = self.queryFor(note)
+        if query is None:
+            return False
+        return self.applyFetched(note, query, self.fetch(query))
+
+    def queryFor(self, note):
+        """Returns the text to synthesise for note, or None if blank."""
+        query = None
+        with timed('text', 'sanitise'):
+            for f in filter(lambda f: f in note, self.sourceFields()):
+                query = sanitise(mw.col.media.strip(note[f]))
+                if query:
+                    break
 
         if not query:
-            return False
+            return None
 
         if note[self.target_field]:
-            return False
+            return None
 
-        gender = MALE if random.randrange(0, 2) else FEMALE
-        filepath = self.get_file(gender, query)
-        mw.col.media.addFile(os.path.abspath(unicode(filepath)))
+        return query
 
-        dst_text = u'[sound:{}]'.format(os.path.basename(filepath))
-        note[self.targetFields()[0]] = dst_text
+    def fetch(self, query):
+        """Returns the path to TTS for query, downloading it if necessary.
+
+        A random voice is used, but cached speech in either voice is
+        preferred to a download.
+
+        """
+        genders = [g for g in (MALE, FEMALE)
+                   if (self._language_code, g) in VOICES]
+        random.shuffle(genders)
+        gender = genders[0] if genders else MALE
+
+        cache = tts_cache()
+        for g in genders:
+            path = cache.get(self.cache_key(g, query))
+            if path:
+                return path
+
+        filepath = self.get_file(gender, query, cache.staging_directory())
+        return cache.put(self.cache_key(gender, query), filepath, '.mp3')
+
+    def cache_key(self, gender, text):
+        voice = VOICES[self._language_code, gender]
+        return make_key(self._language_code, voice, TTS_OUTPUT_FORMAT, text)
+
+    def applyFetched(self, note, query, filepath):
+        name = add_file(filepath, mw.col.media.dir())
 
-        if os.path.isfile(filepath):
-            os.remove(filepath)
+        dst_text = u'[sound:{}]'.format(name)
+        note[self.targetFields()[0]] = dst_text
 
         return True
 
-    def get_file(self, gender, text):
-        if not self._jwt:
-            self._jwt = get_jwt(self.api_key)
+    def get_file(self, gender, text, directory=None):
+        """Downloads TTS for text, refreshing the token if it is refused."""
+        jwt = [get_jwt(self.api_key)]
 
-        try:
-            return bing_tts(self._jwt, self._language_code, gender, text)
-        except HTTPError as e:
-            if e.code in (403, 401):
-                self._jwt = get_jwt(self.api_key)
-                return bing_tts(self._jwt, self._language_code, gender, text)
+        def attempt():
+            return bing_tts(jwt[0], self._language_code, gender, text,
+                            directory)
+
+        def reauthorise(error):
+            jwt[0] = refresh_jwt(self.api_key, jwt[0])
+
+        return default_policy.call(attempt, on_auth=reauthorise)
+
+def field_updater(language='english', source_fields=['voice_src'],
+        target_field='voice'):
+    return BingTTSFieldUpdater(source_fields, target_field, language)
 
 def initialise(name='autovoice', language='english', 
         source_fields=['voice_src'], target_field='voice',
-        model_name_substring=None, on_focus_lost=False):
-    field_updater = BingTTSFieldUpdater(source_fields, target_field, language)
-    Addon(field_updater, name, model_name_substring, on_focus_lost)
+        model_name_substring=None, on_focus_lost=False, fetch_workers=None,
+        async_focus_lost=None):
+    Addon(field_updater(language, source_fields, target_field), name,
+          model_name_substring, on_focus_lost, fetch_workers,
+          async_focus_lost)
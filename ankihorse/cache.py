@@ -0,0 +1,240 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+"""
+cache
+=====
+
+Persistent caches for downloaded media, so that regenerating a note or
+seeing the same text twice doesn't cost another request.
+
+"""
+import hashlib
+import json
+import os
+import shutil
+import sqlite3
+import threading
+import time
+
+
+def make_key(*parts):
+    """Hashes `parts` into a key suitable for a file name.
+
+    Args:
+        *parts (str | unicode): the things that determine the content.
+
+    Returns:
+        (str) a hex digest.
+
+    """
+    digest = hashlib.sha1()
+    for part in parts:
+        if isinstance(part, unicode):
+            part = part.encode('utf-8')
+        digest.update(str(part))
+        digest.update('\x00')
+    return digest.hexdigest()
+
+
+class DiskCache(object):
+    """A directory of files keyed by content hash, evicted LRU by size.
+
+    Entries are stored as `<key><suffix>`. Recency is kept in each file's
+    mtime so that it survives restarts. Safe to use from several threads.
+
+    """
+
+    def __init__(self, directory, max_bytes):
+        """Initialiser.
+
+        Args:
+            directory (str): where to keep the files. Created on demand.
+            max_bytes (int): evict least recently used entries once the
+                total size exceeds this.
+
+        """
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._entries = None  # key -> [filename, size, last used]
+        self._size = 0
+
+    def _load(self):
+        if self._entries is not None:
+            return
+        self._entries = {}
+        self._size = 0
+        if not os.path.isdir(self.directory):
+            return
+        for filename in os.listdir(self.directory):
+            path = os.path.join(self.directory, filename)
+            if filename.startswith('.') or not os.path.isfile(path):
+                continue
+            stat = os.stat(path)
+            key = filename.split('.', 1)[0]
+            self._entries[key] = [filename, stat.st_size, stat.st_mtime]
+            self._size += stat.st_size
+
+    def get(self, key):
+        """Returns the path of the entry for `key`, or None if absent."""
+        with self._lock:
+            self._load()
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            path = os.path.join(self.directory, entry[0])
+            try:
+                os.utime(path, None)
+            except OSError:
+                self._forget(key)
+                return None
+            entry[2] = time.time()
+            return path
+
+    def staging_directory(self):
+        """Returns a directory to download files into before putting them.
+
+        It is on the same file system as the cache, so that `put` moves
+        files by renaming them rather than copying.
+
+        """
+        path = os.path.join(self.directory, '.staging')
+        if not os.path.isdir(path):
+            try:
+                os.makedirs(path)
+            except OSError:
+                if not os.path.isdir(path):
+                    raise
+        return path
+
+    def put(self, key, path, suffix='', copy=False):
+        """Moves the file at `path` into the cache under `key`.
+
+        If another thread stored `key` first, `path` is deleted and the
+        existing entry is returned instead.
+
+        Args:
+            key (str): from `make_key`.
+            path (str): a file that the cache may take ownership of.
+            suffix (str): appended to the file name, e.g. '.mp3'.
+            copy (bool): if True, copy the file and leave `path` alone.
+
+        Returns:
+            (str) the path of the cached file.
+
+        """
+        with self._lock:
+            self._load()
+            if key in self._entries:
+                if not copy:
+                    os.remove(path)
+                return os.path.join(self.directory, self._entries[key][0])
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            filename = key + suffix
+            destination = os.path.join(self.directory, filename)
+            if copy:
+                shutil.copyfile(path, destination)
+            else:
+                shutil.move(path, destination)
+            size = os.path.getsize(destination)
+            self._entries[key] = [filename, size, time.time()]
+            self._size += size
+            self._evict(keep=key)
+            return destination
+
+    def _forget(self, key):
+        filename, size, _ = self._entries.pop(key)
+        self._size -= size
+        return os.path.join(self.directory, filename)
+
+    def _evict(self, keep):
+        if self._size <= self.max_bytes:
+            return
+        by_age = sorted(self._entries, key=lambda k: self._entries[k][2])
+        for key in by_age:
+            if self._size <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            path = self._forget(key)
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+class MetadataCache(object):
+    """A persistent mapping from keys to JSON values with a time to live.
+
+    Backed by a sqlite database. Holds at most `max_entries` entries,
+    evicting the least recently used. Safe to use from several threads.
+
+    """
+
+    def __init__(self, path, max_entries, ttl):
+        """Initialiser.
+
+        Args:
+            path (str): the database file. Created on demand.
+            max_entries (int): the maximum number of entries to keep.
+            ttl (float): seconds after which an entry is stale.
+
+        """
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._db = None
+
+    def _connect(self):
+        if self._db is None:
+            directory = os.path.dirname(self.path)
+            if directory and not os.path.isdir(directory):
+                os.makedirs(directory)
+            self._db = sqlite3.connect(self.path, check_same_thread=False)
+            # it's only a cache; losing the tail of it in a crash is fine
+            self._db.execute('pragma synchronous = off')
+            self._db.execute('create table if not exists entries '
+                             '(key text primary key, value text, '
+                             'created real, used real)')
+            self._db.execute('create index if not exists entries_used '
+                             'on entries (used)')
+        return self._db
+
+    def get(self, key):
+        """Returns the value stored under `key`, or None if absent or stale."""
+        with self._lock:
+            db = self._connect()
+            row = db.execute('select value, created from entries '
+                             'where key = ?', (key,)).fetchone()
+            if row is None:
+                return None
+            now = time.time()
+            if now - row[1] > self.ttl:
+                db.execute('delete from entries where key = ?', (key,))
+                db.commit()
+                return None
+            db.execute('update entries set used = ? where key = ?',
+                       (now, key))
+            db.commit()
+            return json.loads(row[0])
+
+    def delete(self, key):
+        """Forgets the value stored under `key`, if any."""
+        with self._lock:
+            db = self._connect()
+            db.execute('delete from entries where key = ?', (key,))
+            db.commit()
+
+    def put(self, key, value):
+        """Stores the JSON-serialisable `value` under `key`."""
+        with self._lock:
+            db = self._connect()
+            now = time.time()
+            db.execute('insert or replace into entries values (?, ?, ?, ?)',
+                       (key, json.dumps(value), now, now))
+            db.execute('delete from entries where key in (select key from '
+                       'entries order by used desc limit -1 offset ?)',
+                       (self.max_entries,))
+            db.commit()
@@ -1,19 +1,26 @@
 # -*- encoding: utf-8 -*-
+import httplib
 import json
 import os
 import tempfile
+import threading
+import time
 import uuid
-import urllib
-import urllib2
 from urllib2 import HTTPError
 from xml.etree import ElementTree as ET
 
-from . import NAMESPACE_UUID
+from . import NAMESPACE_UUID, ratelimit, stats
+from .config import store
+from .httpclient import (default_client, check_response, copy_response,
+                         DownloadError)
+from .retry import default_policy
 
 APP_ID = uuid.uuid3(NAMESPACE_UUID, 'autovoice')
 CLIENT_ID = uuid.uuid4()
 M = MALE = 0  # I know, right? So binary normative.
 F = FEMALE = 1
+TTS_OUTPUT_FORMAT = 'audio-16khz-128kbitrate-mono-mp3'
+IMAGE_CONTENT_TYPES = ('image/',)
 _VOICE_PREFIX = 'Microsoft Server Speech Text to Speech Voice '
 VOICES = { ('ar-EG', F): _VOICE_PREFIX + '(ar-EG, Hoda)'
          , ('de-DE', F): _VOICE_PREFIX + '(de-DE, Hedda)'
@@ -45,23 +52,50 @@ VOICES = { ('ar-EG', F): _VOICE_PREFIX + '(ar-EG, Hoda)'
          , ('zh-TW', M): _VOICE_PREFIX + '(zh-TW, Zhiwei, Apollo)'
          }
 
-_ = urllib2.urlopen('http://api.ipify.org')
-X_MSEdge_ClientIP = _.read()
-del _
+CLIENT_IP_URL = 'http://api.ipify.org'
+CLIENT_IP_TTL = 60 * 60
+CLIENT_IP_TIMEOUT = 5
 
+_client_ip = None  # (ip or None, time fetched)
+_client_ip_lock = threading.Lock()
 
-def get(url, params={}, headers={}):
-    url += '?' + urllib.urlencode(params)
-    request = urllib2.Request(url, headers=headers)
-    return urllib2.urlopen(request)
 
-def post(url, data=' ', params={}, headers={}):
-    url += urllib.urlencode(params)
-    request = urllib2.Request(url, data, headers=headers)
-    return urllib2.urlopen(request)
+def get(url, params={}, headers={}, timeout=None, limiter=None):
+    return default_client.request('GET', url, params, headers=headers,
+                                  timeout=timeout, limiter=limiter)
 
-def get_jwt(api_key):
-    """Gets a JSON web token for authorization.
+def post(url, data=' ', params={}, headers={}, timeout=None, limiter=None):
+    return default_client.request('POST', url, params, data, headers,
+                                  timeout=timeout, limiter=limiter)
+
+def client_ip():
+    """Gets this machine's public IP, for the X-MSEdge-Client-IP header.
+
+    Looked up on first use and again every CLIENT_IP_TTL seconds. Set
+    'send client ip' to false in the 'cognitive services' section of the
+    config file to skip the lookup.
+
+    Returns:
+        (str | None) the IP, or None if disabled or the lookup failed.
+
+    """
+    global _client_ip
+    with _client_ip_lock:
+        if _client_ip and time.time() - _client_ip[1] < CLIENT_IP_TTL:
+            return _client_ip[0]
+        ip = None
+        if store.get_bool('cognitive services', 'send client ip', True):
+            try:
+                ip = get(CLIENT_IP_URL, timeout=CLIENT_IP_TIMEOUT).read()
+            except (EnvironmentError, httplib.HTTPException):
+                pass
+        _client_ip = (ip.strip() if ip else None, time.time())
+        return _client_ip[0]
+
+def issue_jwt(api_key):
+    """Fetches a new JSON web token for authorization.
+
+    Most callers want `get_jwt`, which shares tokens between callers.
 
     Args:
         api_key (str): The API key for the service to auth with.
@@ -75,20 +109,143 @@ def get_jwt(api_key):
     """
     url = 'https://api.cognitive.microsoft.com/sts/v1.0/issueToken'
     key_header = 'Ocp-Apim-Subscription-Key'
-    return post(url, headers={key_header: api_key}).read()
+    with stats.timed('cognitive services', 'token'):
+        return default_policy.call(
+                lambda: post(url, headers={key_header: api_key}).read())
+
+JWT_LIFETIME = 15 * 60
+JWT_REFRESH_AFTER = 9 * 60
+
+class TokenManager(object):
+    """Shares JSON web tokens between callers, one per API key.
+
+    Concurrent callers wait on a single fetch instead of each requesting
+    their own. A token that was used is refreshed on a background timer
+    before it expires, so callers rarely wait at all.
+
+    """
+
+    def __init__(self, issue, lifetime=JWT_LIFETIME,
+            refresh_after=JWT_REFRESH_AFTER):
+        """Initialiser.
+
+        Args:
+            issue (Callable[[str], str]): fetches a new token for a key.
+            lifetime (float): seconds for which a token is valid.
+            refresh_after (float): seconds after which to refresh a token
+                in the background. Should be comfortably below `lifetime`.
+
+        """
+        self._issue = issue
+        self.lifetime = lifetime
+        self.refresh_after = refresh_after
+        self._lock = threading.Lock()
+        self._key_locks = {}
+        self._tokens = {}  # api key -> (token, time issued)
+        self._used = set()
+        self._timers = {}
+
+    def _key_lock(self, api_key):
+        with self._lock:
+            return self._key_locks.setdefault(api_key, threading.Lock())
+
+    def get(self, api_key):
+        """Returns a valid token for `api_key`, fetching one if necessary."""
+        token, issued = self._tokens.get(api_key, (None, 0))
+        self._used.add(api_key)
+        if token and time.time() - issued < self.refresh_after:
+            return token
+        return self.refresh(api_key, token)
+
+    def refresh(self, api_key, stale=None):
+        """Replaces the token `stale`, e.g. after the server rejected it.
 
-def _save_to_temp_file(response, suffix):
-    handle, path = tempfile.mkstemp(suffix, prefix='ankihorse_')
-    with os.fdopen(handle, 'wb') as f:
-        f.write(response.read())
-    #os.close(handle)
+        If another thread has already replaced it, returns the replacement
+        instead of fetching again.
+
+        Args:
+            api_key (str): The API key the token is for.
+            stale (str | None): The token to replace.
+
+        Returns:
+            (str) A fresh token.
+
+        Raises:
+            HTTPError: if the web token could not be fetched.
+
+        """
+        with self._key_lock(api_key):
+            token, issued = self._tokens.get(api_key, (None, 0))
+            if (token and token != stale
+                and time.time() - issued < self.refresh_after):
+                return token
+            token = self._issue(api_key)
+            self._tokens[api_key] = (token, time.time())
+            self._schedule(api_key)
+            return token
+
+    def _schedule(self, api_key):
+        with self._lock:
+            if api_key in self._timers:
+                self._timers[api_key].cancel()
+            timer = threading.Timer(self.refresh_after, self._background,
+                                    [api_key])
+            timer.daemon = True
+            self._timers[api_key] = timer
+        timer.start()
+
+    def _background(self, api_key):
+        # only keep refreshing tokens that are actually being used
+        if api_key not in self._used:
+            return
+        self._used.discard(api_key)
+        try:
+            self.refresh(api_key, self._tokens[api_key][0])
+        except Exception:
+            pass  # the next call to get will try again
+
+tokens = TokenManager(issue_jwt)
+
+def get_jwt(api_key):
+    """Gets a JSON web token for authorization.
+
+    Tokens are shared by all callers with the same key and refreshed
+    before they expire.
+
+    Args:
+        api_key (str): The API key for the service to auth with.
+
+    Returns:
+        (str) The web token.
+
+    Raises:
+        HTTPError: if the web token could not be fetched.
+    
+    """
+    return tokens.get(api_key)
+
+def refresh_jwt(api_key, stale):
+    """Gets a new token after the server rejected `stale`."""
+    return tokens.refresh(api_key, stale)
+
+def _save_to_temp_file(response, suffix, max_bytes=None, content_types=None,
+        directory=None):
+    check_response(response, max_bytes, content_types)
+    handle, path = tempfile.mkstemp(suffix, prefix='ankihorse_',
+                                    dir=directory)
+    try:
+        with os.fdopen(handle, 'wb') as f:
+            copy_response(response, f, max_bytes)
+    except:
+        os.remove(path)
+        raise
     return path
 
 # match japanese punctuation, which bing tts insists on reading out
 import re
 _punctuation = re.compile(u'[。？、.?]')
 
-def bing_tts(jwt, locale, gender, text):
+def bing_tts(jwt, locale, gender, text, directory=None):
     """TTS from the Microsoft Cognitive Services Bing Speech API.
 
     Downloads a 16khz 128k bitrate mono mp3 to a temporary file and 
@@ -105,6 +262,8 @@ def bing_tts(jwt, locale, gender, text):
         text (str | xml.etree.ElementTree.Element): The text to 
             translate. May contain ``break``, ``emphasis``, and 
             ``prosody`` elements; see the `SSML Specifiation`_.
+        directory (str | None): where to create the file; defaults to the
+            system temporary directory.
 
     Returns:
         (str): The path to the downloaded file.
@@ -122,7 +281,7 @@ def bing_tts(jwt, locale, gender, text):
     url = 'https://speech.platform.bing.com/synthesize'
     headers = { 'Authorization': 'Bearer ' + jwt
               , 'Content-Type': 'application/ssml+xml'
-              , 'X-Microsoft-OutputFormat': 'audio-16khz-128kbitrate-mono-mp3'
+              , 'X-Microsoft-OutputFormat': TTS_OUTPUT_FORMAT
               , 'X-Search-AppID': APP_ID.hex
               , 'X-Search-ClientID': CLIENT_ID.hex
               , 'User-Agent': 'AnkiSRS-AnkiHorse-Plugin'
@@ -138,14 +297,13 @@ def bing_tts(jwt, locale, gender, text):
     else:
         voice.text = text
 
-    resp = post(url, headers=headers, data=ET.tostring(speak))
-    return _save_to_temp_file(resp, '.mp3')
-
-def bing_image(api_key, locale, query):
-    """Images from the Microsoft Cognitive Services Bing Image Search API.
+    with stats.timed('bing speech', 'synthesize'):
+        resp = post(url, headers=headers, data=ET.tostring(speak),
+                    limiter=ratelimit.limiter('bing speech'))
+        return _save_to_temp_file(resp, '.mp3', directory=directory)
 
-    Downloads the first image result to a temporary file and returns the 
-    path to it.
+def bing_image_search(api_key, locale, query):
+    """Searches with the Microsoft Cognitive Services Bing Image Search API.
 
     Args:
         api_key (str): The api key for the Bing Image Search API.
@@ -154,23 +312,98 @@ def bing_image(api_key, locale, query):
         query (str): The query to search for.
 
     Returns:
-        (str): The path to the downloaded file.
+        (List[dict]): The image results, best first. Each has at least
+            'contentUrl' and 'encodingFormat' keys.
 
     """
-    global X_MSEdge_ClientID
-
     url = 'https://api.cognitive.microsoft.com/bing/v5.0/images/search'
     headers = { 'Ocp-Apim-Subscription-Key': api_key
               , 'User-Agent': 'AnkiSRS-AnkiHorse-Plugin'
-              , 'X-MSEdge-Client-IP': X_MSEdge_ClientIP
               }
+    ip = client_ip()
+    if ip:
+        headers['X-MSEdge-Client-IP'] = ip
 
     params = { 'q': query
              , 'mkt': locale
              }
 
-    resp = get(url, params=params, headers=headers)
-    content = json.loads(resp.read())
-    image = content['value'][0]
-    resp_ = get(image['contentUrl'])
-    return _save_to_temp_file(resp_, '.' + image['encodingFormat'])
+    def search():
+        resp = get(url, params=params, headers=headers,
+                   limiter=ratelimit.limiter('bing search'))
+        return json.loads(resp.read())
+    with stats.timed('bing search', 'search'):
+        return default_policy.call(search)['value']
+
+def download(url, suffix, max_bytes=None, content_types=None,
+        directory=None):
+    """Downloads `url` to a temporary file and returns the path to it.
+
+    Args:
+        url (str): the url to fetch.
+        suffix (str): the file extension, e.g. '.jpeg'.
+        max_bytes (int | None): refuse bodies larger than this.
+        content_types (Sequence[str] | None): refuse other content types.
+        directory (str | None): where to create the file; defaults to the
+            system temporary directory.
+
+    Raises:
+        DownloadError: if the download is refused.
+
+    """
+    def attempt():
+        return _save_to_temp_file(get(url), suffix, max_bytes, content_types,
+                                  directory)
+    with stats.timed('images', 'download'):
+        return default_policy.call(attempt)
+
+def image_size(image):
+    """Returns the size in bytes of a Bing image result, or None if unknown.
+
+    Bing reports it as a string like '123456 B'.
+
+    """
+    size = image.get('contentSize', '').split(' ')[0]
+    return int(size) if size.isdigit() else None
+
+def first_acceptable_image(images, max_bytes=None):
+    """Returns the first Bing image result no larger than `max_bytes`.
+
+    Results of unknown size are accepted; the download itself is capped.
+    Returns None if no result is acceptable.
+
+    """
+    for image in images:
+        size = image_size(image)
+        if max_bytes is None or size is None or size <= max_bytes:
+            return image
+    return None
+
+def bing_image(api_key, locale, query, max_bytes=None):
+    """Images from the Microsoft Cognitive Services Bing Image Search API.
+
+    Downloads the first image result to a temporary file and returns the 
+    path to it.
+
+    Args:
+        api_key (str): The api key for the Bing Image Search API.
+        locale (str): A local string of the form 'aa-AA', for example
+            'en-GB', 'ja-JP', ...
+        query (str): The query to search for.
+        max_bytes (int | None): skip results larger than this.
+
+    Returns:
+        (str): The path to the downloaded file.
+
+    Raises:
+        DownloadError: if no result is small enough, or the download is
+            refused.
+
+    """
+    images = bing_image_search(api_key, locale, query)
+    image = first_acceptable_image(images, max_bytes)
+    if image is None:
+        raise DownloadError('No image for {!r} under {} bytes.'
+                            .format(query, max_bytes))
+    return download(image['contentUrl'], '.' + image['encodingFormat'],
+                    max_bytes, IMAGE_CONTENT_TYPES)
@@ -1,40 +1,217 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+"""
+config
+======
+
+The add-on's settings, kept in CONFIG_FILE as a JSON object of sections,
+each an object of options.
+
+`store` is the one Config shared by every module. It reads the file once,
+on first use, checks it, and writes it back atomically whenever a setting
+is changed. Modules that cache something derived from a setting subscribe
+to be told when it changes.
+
+"""
+import copy
 import json
 import os
+import threading
 
+from .atomic import write_atomically
 
 CONFIG_FILE = os.path.join(os.path.dirname(__file__), 'config.json')
 
+DEFAULT_FETCH_WORKERS = 4
+
+
+class ConfigError(Exception):
+    """Raised when the config file, or a setting in it, is malformed."""
+
+
+class Config(object):
+    """A config file, loaded once and shared. Safe to use from several
+    threads."""
+
+    def __init__(self, path=CONFIG_FILE):
+        """Initialiser.
 
-class ConfigParser(object):
-    def __init__(self):
-        self.contents = {}
+        Args:
+            path (str): the JSON file. Need not exist until a setting is
+                changed.
 
-    def read(self, *files):
-        success = []
-        for f in files:
-            try:
-                with open(f, 'r') as fp:
-                    self.contents.update(json.load(fp))
-                success.append(f)
-            except IOError:
-                pass
-        return success
+        """
+        self.path = path
+        self._lock = threading.RLock()
+        self._contents = None
+        self._subscribers = []  # (section or None, callback)
 
-    def write(self, fp):
-        json.dump(self.contents, fp, indent=2)
+    def _sections(self):
+        with self._lock:
+            if self._contents is None:
+                self._contents = self._read()
+            return self._contents
 
-    def add_section(self, section):
-        self.contents[section] = {}
+    def _read(self):
+        try:
+            with open(self.path, 'r') as f:
+                contents = json.load(f)
+        except IOError:
+            return {}
+        except ValueError as e:
+            raise ConfigError('{} is not valid JSON: {}'.format(self.path, e))
+        if not isinstance(contents, dict):
+            raise ConfigError('{} should hold an object of sections.'
+                              .format(self.path))
+        for section, options in contents.items():
+            if not isinstance(options, dict):
+                raise ConfigError('Section {!r} of {} should be an object.'
+                                  .format(section, self.path))
+        return contents
 
-    def has_section(self, section):
-        return section in self.contents
+    def _write(self, contents):
+        def write(path):
+            with open(path, 'w') as f:
+                json.dump(contents, f, indent=2, sort_keys=True)
+        write_atomically(self.path, write, prefix='.config')
 
-    def has_option(self, section, option):
-        return section in self.contents and option in self.contents[section]
+    def reload(self, path=None):
+        """Re-reads the file, or switches to the file at `path`.
 
-    def get(self, section, option):
-        return self.contents[section][option]
+        Subscribers are told about every option that changed.
+
+        """
+        with self._lock:
+            old = self._sections() if self._contents is not None else {}
+            if path is not None:
+                self.path = path
+            self._contents = None
+            new = self._sections()
+        for section in set(old) | set(new):
+            before, after = old.get(section, {}), new.get(section, {})
+            for option in set(before) | set(after):
+                if before.get(option) != after.get(option):
+                    self._notify(section, option, after.get(option))
+
+    def get(self, section, option, default=None):
+        """Returns the value of an option, or `default` if it's unset."""
+        return self._sections().get(section, {}).get(option, default)
 
     def set(self, section, option, value):
-        self.contents[section][option] = value
+        """Changes an option and saves the file.
+
+        Subscribers are told if the value changed.
+
+        """
+        with self._lock:
+            contents = copy.deepcopy(self._sections())
+            options = contents.setdefault(section, {})
+            if option in options and options[option] == value:
+                return
+            options[option] = value
+            self._write(contents)
+            self._contents = contents
+        self._notify(section, option, value)
+
+    def subscribe(self, callback, section=None):
+        """Calls `callback(section, option, value)` when an option changes.
+
+        Args:
+            callback (Callable[[str, str, object], None]): called on the
+                thread that made the change.
+            section (str | None): only report changes to this section.
+
+        Returns:
+            (Callable[[], None]) cancels the subscription.
+
+        """
+        entry = (section, callback)
+        with self._lock:
+            self._subscribers.append(entry)
+
+        def unsubscribe():
+            with self._lock:
+                if entry in self._subscribers:
+                    self._subscribers.remove(entry)
+        return unsubscribe
+
+    def _notify(self, section, option, value):
+        with self._lock:
+            subscribers = [callback for s, callback in self._subscribers
+                           if s is None or s == section]
+        for callback in subscribers:
+            callback(section, option, value)
+
+    def _typed(self, section, option, default, types, description,
+            minimum=None):
+        options = self._sections().get(section, {})
+        if option not in options:
+            return default
+        value = options[option]
+        if value is None:
+            return default
+        if isinstance(value, bool) and bool not in types:
+            value = None  # bool is an int, but true isn't a number here
+        if not isinstance(value, types) \
+                or (minimum is not None and value < minimum):
+            expected = description
+            if minimum is not None:
+                expected += ' of at least {}'.format(minimum)
+            raise ConfigError('Option {!r} in section {!r} of {} should be '
+                              '{}.'.format(option, section, self.path,
+                                           expected))
+        return value
+
+    def get_bool(self, section, option, default):
+        return self._typed(section, option, default, (bool,), 'true or false')
+
+    def get_int(self, section, option, default, minimum=None):
+        return self._typed(section, option, default, (int, long),
+                           'a whole number', minimum)
+
+    def get_float(self, section, option, default, minimum=None):
+        value = self._typed(section, option, default, (int, long, float),
+                            'a number', minimum)
+        return None if value is None else float(value)
+
+    def get_str(self, section, option, default):
+        return self._typed(section, option, default, (basestring,), 'text')
+
+    def api_key(self, service):
+        """Returns the API key for `service`, e.g. 'bing speech', or None.
+
+        Keys live in the 'cognitive services' section as '<service> api
+        key'.
+
+        """
+        key = self.get_str('cognitive services', service + ' api key', None)
+        return key.encode('utf-8') if isinstance(key, unicode) else key
+
+    def set_api_key(self, service, key):
+        self.set('cognitive services', service + ' api key', key)
+
+    def rate_limit(self, provider, rate, daily_quota=None):
+        """Returns (requests per second, daily quota or None) for
+        `provider`, from the 'rate limits' section, given the defaults."""
+        rate = self.get_float('rate limits',
+                              provider + ' requests per second', rate,
+                              minimum=0.001)
+        daily_quota = self.get_int('rate limits', provider + ' daily quota',
+                                   daily_quota, minimum=0)
+        return rate, daily_quota
+
+    def cache_bytes(self, cache, megabytes):
+        """Returns the size cap in bytes of `cache`, e.g. 'tts', from
+        '<cache> cache size mb' in the 'cache' section."""
+        megabytes = self.get_float('cache', cache + ' cache size mb',
+                                   megabytes, minimum=0)
+        return int(megabytes * 1024 * 1024)
+
+    def fetch_workers(self, default=DEFAULT_FETCH_WORKERS):
+        """Returns the number of threads to fetch with, from 'fetch
+        workers' in the 'concurrency' section."""
+        return self.get_int('concurrency', 'fetch workers', default,
+                            minimum=1)
+
 
+store = Config()
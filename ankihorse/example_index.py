@@ -0,0 +1,296 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+"""
+example_index
+=============
+
+A compact on-disk index from words to example sentences.
+
+The file is a header, a table of keys sorted by (dictionary, word), the
+utf-8 bytes of the words, and one packed array of postings. It is memory
+mapped and binary searched, so opening it costs nothing and a lookup only
+unpacks the postings for the word asked for.
+
+A posting is (line offset, line length, highlight start, highlight
+length): where an example sentence is in the corpus, how long it is, and
+which characters of it to highlight. Each posting also stores the running
+total of the sampling weights up to it, so that weighted sampling is a
+binary search.
+
+"""
+import hashlib
+import mmap
+import os
+import random
+import struct
+
+from .atomic import write_atomically
+
+MAGIC = 'AHEX'
+# Bump when the layout or the weighting below changes.
+VERSION = 3
+
+# Shorter sentences are preferred: a sentence of MIN_LENGTH characters or
+# fewer is (MAX_LENGTH - MIN_LENGTH + 1) ** POWER times as likely to be
+# sampled as one of MAX_LENGTH characters or more.
+MIN_LENGTH = 25
+MAX_LENGTH = 70
+POWER = 3
+
+# magic, version, corpus checksum, key count, words offset, postings offset
+HEADER = struct.Struct('<4sI20sIII')
+# dictionary, word offset, word length, first posting, posting count
+KEY = struct.Struct('<BIHII')
+# line offset, line length, cumulative weight, highlight start and length
+POSTING = struct.Struct('<IIQHH')
+_MAX_SPAN = 0xffff
+
+
+def weight(length):
+    """Returns the sampling weight of a sentence of `length` characters."""
+    length = min(max(length, MIN_LENGTH), MAX_LENGTH)
+    return (MAX_LENGTH - length + 1) ** POWER
+
+
+def corpus_checksum(data):
+    """Returns the sha1 digest of `data`, a string or mmap."""
+    return hashlib.sha1(data).digest()
+
+
+def write_index(path, dictionaries, checksum):
+    """Writes `dictionaries` to `path`, atomically replacing any old index.
+
+    Args:
+        path (str): the destination file.
+        dictionaries (Sequence[Dict[unicode, List[Tuple[int, ...]]]]):
+            for each dictionary, a map from words to postings, sorted by
+            line length.
+        checksum (str): the corpus checksum to record in the header.
+
+    """
+    keys = []
+    for number, dictionary in enumerate(dictionaries):
+        for word, postings in dictionary.iteritems():
+            keys.append((number, word.encode('utf-8'), postings))
+    keys.sort(key=lambda k: (k[0], k[1]))
+
+    words_offset = HEADER.size + KEY.size * len(keys)
+    words_size = sum(len(word) for _, word, _ in keys)
+    postings_offset = words_offset + words_size
+
+    def write(temp_path):
+        with open(temp_path, 'wb') as f:
+            f.write(HEADER.pack(MAGIC, VERSION, checksum, len(keys),
+                                words_offset, postings_offset))
+            word_position = posting_position = 0
+            for number, word, postings in keys:
+                f.write(KEY.pack(number, word_position, len(word),
+                                 posting_position, len(postings)))
+                word_position += len(word)
+                posting_position += len(postings)
+            for _, word, _ in keys:
+                f.write(word)
+            for _, _, postings in keys:
+                f.write(_pack_postings(postings))
+            f.flush()
+            os.fsync(f.fileno())
+        os.chmod(temp_path, 0o644)
+    write_atomically(path, write, prefix='.index')
+
+
+def _pack_postings(postings):
+    packed = []
+    total = 0
+    for offset, length, start, span in postings:
+        total += weight(length)
+        if start + span > _MAX_SPAN:
+            start = span = 0
+        packed.append(POSTING.pack(offset, length, total, start, span))
+    return ''.join(packed)
+
+
+class ExampleIndex(object):
+    """A read-only view of an index written by `write_index`."""
+
+    def __init__(self, path):
+        """Initialiser.
+
+        Args:
+            path (str): the index file.
+
+        Raises:
+            ValueError: if the file is not an index of this version.
+
+        """
+        with open(path, 'rb') as f:
+            self._data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self._data) < HEADER.size:
+            self.close()
+            raise ValueError('Truncated index.')
+        (magic, version, self.checksum, self._count, self._words,
+         self._postings) = HEADER.unpack_from(self._data)
+        if magic != MAGIC or version != VERSION:
+            self.close()
+            raise ValueError('Not an index of version {}.'.format(VERSION))
+
+    def _key(self, i):
+        number, offset, length, first, count = \
+                KEY.unpack_from(self._data, HEADER.size + KEY.size * i)
+        start = self._words + offset
+        return number, self._data[start:start + length], first, count
+
+    def lookup(self, dictionary, word):
+        """Returns the postings for `word` in `dictionary`.
+
+        Args:
+            dictionary (int): the dictionary number.
+            word (unicode): the word to look up.
+
+        Returns:
+            (Postings | None) the postings, or None if the word isn't in
+                the dictionary.
+
+        """
+        target = (dictionary, word.encode('utf-8'))
+        low, high = 0, self._count
+        while low < high:
+            middle = (low + high) // 2
+            number, key, first, count = self._key(middle)
+            if (number, key) < target:
+                low = middle + 1
+            elif (number, key) > target:
+                high = middle
+            else:
+                start = self._postings + POSTING.size * first
+                return Postings(self._data, start, count)
+        return None
+
+    def close(self):
+        self._data.close()
+
+
+class Postings(object):
+    """The postings for one word, sorted by sentence length.
+
+    A sequence of (line offset, line length, highlight start, highlight
+    length) tuples, unpacked on access.
+
+    """
+
+    def __init__(self, data, start, count):
+        self._data = data
+        self._start = start
+        self._count = count
+
+    def __len__(self):
+        return self._count
+
+    def _unpack(self, i):
+        return POSTING.unpack_from(self._data, self._start + POSTING.size * i)
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += self._count
+        if not 0 <= i < self._count:
+            raise IndexError(i)
+        return self._posting(i)
+
+    def __iter__(self):
+        for i in range(self._count):
+            yield self._posting(i)
+
+    def _posting(self, i):
+        offset, length, _, start, span = self._unpack(i)
+        return offset, length, start, span
+
+    def total_weight(self):
+        """Returns the sum of the sampling weights of all the postings."""
+        return self._unpack(self._count - 1)[2] if self._count else 0
+
+    def find_weight(self, target):
+        """Returns the index of the posting whose weight covers `target`.
+
+        That is, the first posting whose cumulative weight exceeds
+        `target`, found by binary search.
+
+        """
+        low, high = 0, self._count - 1
+        while low < high:
+            middle = (low + high) // 2
+            if self._unpack(middle)[2] > target:
+                high = middle
+            else:
+                low = middle + 1
+        return low
+
+
+def weighted_sample(postings, n):
+    """Samples `n` distinct postings by weight.
+
+    Each draw picks a posting with probability proportional to its weight
+    among the postings not drawn yet. A draw costs O(log n): it is a binary
+    search over the stored cumulative weights, retried if it lands on a
+    posting already drawn, which leaves the distribution unchanged. If
+    retries pile up, falls back to a linear scan over the rest.
+
+    Args:
+        postings (Postings): the postings to sample from.
+        n (int): how many to sample; at most len(postings).
+
+    Returns:
+        (List[Tuple[int, int, int, int]]) the postings, in the order
+            drawn.
+
+    """
+    total = postings.total_weight()
+    chosen = []
+    drawn = set()
+    retries = 0
+    while len(chosen) < n:
+        i = postings.find_weight(total * random.random())
+        if i in drawn:
+            retries += 1
+            if retries > 4 * n + 16:
+                break
+            continue
+        drawn.add(i)
+        chosen.append(postings[i])
+
+    if len(chosen) < n:
+        rest = [(weight(posting[1]), posting)
+                for i, posting in enumerate(postings) if i not in drawn]
+        remaining = float(sum(w for w, _ in rest))
+        while len(chosen) < n:
+            g = remaining * random.random()
+            for j, (w, posting) in enumerate(rest):
+                if g < w:
+                    break
+                g -= w
+            chosen.append(posting)
+            remaining -= w
+            del rest[j]
+    return chosen
+
+
+def open_index(path, checksum):
+    """Opens the index at `path` if it is valid for the given corpus.
+
+    Args:
+        path (str): the index file.
+        checksum (str): the checksum of the current corpus.
+
+    Returns:
+        (ExampleIndex | None) the index, or None if it is missing, corrupt,
+            of another version or built from a different corpus.
+
+    """
+    if not os.path.exists(path):
+        return None
+    try:
+        index = ExampleIndex(path)
+    except (ValueError, EnvironmentError, struct.error):
+        return None
+    if index.checksum != checksum:
+        index.close()
+        return None
+    return index
@@ -0,0 +1,203 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+"""
+headless
+========
+
+Runs the field updaters over a collection file without Anki's GUI, e.g. to
+pre-generate media for a large deck on a server:
+
+    cd ~/Anki/addons
+    python -m ankihorse.headless ~/Anki/User\ 1/collection.anki2
+
+The addons run are the ones ankihorse_.py declares in ADDONS. Only notes
+that changed since they were last regenerated are visited, and progress is
+saved chunk by chunk, so an interrupted run picks up where it stopped when
+run again. Anki itself must not have the collection open. Only Anki's
+`anki` package is needed, not the GUI (`aqt` and PyQt).
+
+Fetches run on a pool of threads, as in the GUI, rather than in separate
+processes: the work waits on the network, which threads do in parallel
+despite the GIL; the collection can only be written safely from one
+place; and the rate limiters, tokens and caches that keep us within the
+providers' limits are shared by threads but would be duplicated by every
+process.
+
+"""
+from __future__ import print_function, division
+import argparse
+import importlib
+import os
+import sys
+import time
+
+from anki.storage import Collection
+
+from . import config, stats
+from .updateraddon import Regenerator
+
+# options of `initialise` that only matter in the editor
+EDITOR_OPTIONS = ('on_focus_lost', 'async_focus_lost', 'focus_lost_delay')
+
+
+class ProfileManager(object):
+    """Stands in for aqt.mw.pm. The profile folder is the one the
+    collection is in, as in Anki."""
+
+    def __init__(self, folder):
+        self._folder = folder
+
+    def profileFolder(self):
+        return self._folder
+
+    def addonFolder(self):
+        return os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class HeadlessWindow(object):
+    """Stands in for aqt.mw: just the collection and the profile."""
+
+    def __init__(self, col):
+        self.col = col
+        self.pm = ProfileManager(os.path.dirname(os.path.abspath(col.path)))
+
+
+def _show_info(text, *args, **kwargs):
+    print(text, file=sys.stderr)
+
+def _get_text(prompt, *args, **kwargs):
+    raise RuntimeError('Cannot ask without the GUI: {} Set it in the '
+                       'config file instead.'.format(prompt))
+
+def install(window):
+    """Points the loaded ankihorse modules at `window` instead of aqt.mw.
+
+    Dialogs are replaced too: messages go to stderr, and prompts for input
+    fail.
+
+    """
+    package = Regenerator.__module__.split('.')[0]
+    for name, module in sys.modules.items():
+        if module is None or name.split('.')[0] != package:
+            continue
+        if hasattr(module, 'mw'):
+            module.mw = window
+        if hasattr(module, 'showInfo'):
+            module.showInfo = _show_info
+        if hasattr(module, 'getText'):
+            module.getText = _get_text
+
+
+def regenerators(addons, names=None, fetch_workers=None):
+    """Builds a Regenerator for each addon declared in `addons`.
+
+    Args:
+        addons (Sequence[Tuple[module, dict]]): as ADDONS in ankihorse_.py.
+        names (Container[str] | None): only build these addons.
+        fetch_workers (int | None): overrides each addon's fetch_workers.
+
+    Yields:
+        (Regenerator) one per addon.
+
+    """
+    for module, options in addons:
+        options = dict(options)
+        for option in EDITOR_OPTIONS:
+            options.pop(option, None)
+        name = options.pop('name', module.__name__.split('.')[-1])
+        if names and name not in names:
+            continue
+        kwargs = {}
+        for option in ('model_name_substring', 'fetch_workers'):
+            if option in options:
+                kwargs[option] = options.pop(option)
+        if fetch_workers:
+            kwargs['fetch_workers'] = fetch_workers
+        updater = module.field_updater(**options)
+        yield Regenerator(updater, name, **kwargs)
+
+
+def progress_printer(name, out=sys.stderr):
+    """Returns a progress callback for Regenerator.regenerate that prints
+    the notes done, the rate and the time left."""
+    start = time.time()
+
+    def progress(done, total):
+        elapsed = time.time() - start
+        rate = done / elapsed if elapsed else 0
+        left = (total - done) / rate if rate else 0
+        print('{}: {}/{} notes, {:.1f} notes/s, {:.0f}s left'
+              .format(name, done, total, rate, left), file=out)
+        out.flush()
+    return progress
+
+
+def run(col, addons, names=None, changed_only=True, fetch_workers=None,
+        out=sys.stderr):
+    """Runs the addons over `col`.
+
+    Returns:
+        (int) the number of notes whose fields changed.
+
+    """
+    install(HeadlessWindow(col))
+    written = 0
+    for regenerator in regenerators(addons, names, fetch_workers):
+        name = regenerator.name
+        nids, unmodified = regenerator.candidates(changed_only)
+        print('{}: {} notes to regenerate'.format(name, len(nids)), file=out)
+        if not nids and not unmodified:
+            continue
+        changed = regenerator.regenerate(nids, unmodified,
+                                         progress_printer(name, out))
+        print('{}: {} notes changed'.format(name, changed), file=out)
+        written += changed
+    return written
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+            prog='python -m ankihorse.headless',
+            description='Runs the ankihorse field updaters over a '
+                        'collection without the GUI.')
+    parser.add_argument('collection', help='the .anki2 collection file')
+    parser.add_argument('--addon', action='append', dest='names',
+                        metavar='NAME',
+                        help='only run this addon; may be repeated')
+    parser.add_argument('--all', action='store_true',
+                        help='revisit every note, not just changed ones')
+    parser.add_argument('--workers', type=int,
+                        help='fetch threads per addon')
+    parser.add_argument('--addons-module', default='ankihorse_',
+                        help='the module declaring ADDONS')
+    parser.add_argument('--stats', action='store_true',
+                        help='print timing statistics at the end')
+    parser.add_argument('--config', metavar='PATH',
+                        help='read settings from PATH instead of the '
+                             "add-on's config.json")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.config:
+        config.store.reload(os.path.abspath(args.config))
+    if args.stats:
+        stats.set_enabled(True)
+    addons = importlib.import_module(args.addons_module).ADDONS
+    col = Collection(os.path.abspath(args.collection))
+    try:
+        run(col, addons, args.names, not args.all, args.workers)
+    except KeyboardInterrupt:
+        print('Interrupted. Finished chunks are saved; run again to resume.',
+              file=sys.stderr)
+        return 1
+    finally:
+        col.close()
+        if args.stats:
+            print(stats.report(), file=sys.stderr)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
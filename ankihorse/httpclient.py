@@ -0,0 +1,381 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+"""
+httpclient
+==========
+
+A shared HTTP client that keeps connections alive between requests.
+
+Every provider goes through `default_client`, so that consecutive requests
+to the same host reuse one TLS connection instead of paying for a new
+handshake each time.
+
+"""
+import errno
+import httplib
+import os
+import socket
+import threading
+import urllib
+import urlparse
+import zlib
+from StringIO import StringIO
+from urllib2 import HTTPError
+
+from .ratelimit import THROTTLED, parse_retry_after
+
+DEFAULT_TIMEOUT = 30
+MAX_IDLE_PER_HOST = 8
+MAX_REDIRECTS = 5
+CHUNK_SIZE = 64 * 1024
+_REDIRECTS = (301, 302, 303, 307, 308)
+# safe to send again if the server may or may not have seen them
+IDEMPOTENT = ('GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE')
+
+
+class DownloadError(Exception):
+    """Raised when a response body is refused, e.g. for being too large."""
+
+
+class Response(object):
+    """The response to a request made with HTTPClient.
+
+    The body is read from a pooled connection, which goes back to the pool
+    once the body has been read to the end. Gzipped bodies are decoded
+    transparently.
+
+    """
+
+    def __init__(self, client, key, connection, response, url):
+        self.url = url
+        self.status = self.code = response.status
+        self.reason = response.reason
+        self.headers = response.msg
+        self._client = client
+        self._key = key
+        self._connection = connection
+        self._response = response
+        self._decoder = None
+        if (response.getheader('content-encoding') or '').lower() == 'gzip':
+            self._decoder = zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+    def getheader(self, name, default=None):
+        return self.headers.getheader(name, default)
+
+    def info(self):
+        return self.headers
+
+    def getcode(self):
+        return self.status
+
+    def read(self, amt=None):
+        """Reads the body.
+
+        Args:
+            amt (int | None): read about this many bytes; None reads the
+                rest of the body. Decoding a gzipped body may return
+                slightly more than asked for.
+
+        Returns:
+            (str) the data, or '' once the body is exhausted.
+
+        """
+        if self._response is None:
+            return ''
+        if amt is None:
+            data = self._decode(self._response.read(), final=True)
+            self._release()
+            return data
+        while True:
+            raw = self._response.read(amt)
+            if not raw:
+                data = self._decode('', final=True)
+                self._release()
+                return data
+            data = self._decode(raw)
+            if data:
+                return data
+
+    def _decode(self, data, final=False):
+        if self._decoder is None:
+            return data
+        data = self._decoder.decompress(data)
+        if final:
+            data += self._decoder.flush()
+        return data
+
+    def _release(self):
+        response, self._response = self._response, None
+        if response is not None:
+            reusable = not response.will_close
+            self._client._release(self._key, self._connection, reusable)
+
+    def close(self):
+        """Closes the response, discarding any unread body."""
+        if self._response is not None:
+            self._response.close()
+            self._response = None
+            self._client._release(self._key, self._connection, False)
+
+
+class HTTPClient(object):
+    """Pools keep-alive connections per host.
+
+    Safe to use from several threads; each request has exclusive use of
+    its connection until the response body has been read.
+
+    """
+
+    def __init__(self, timeout=DEFAULT_TIMEOUT, max_idle=MAX_IDLE_PER_HOST):
+        """Initialiser.
+
+        Args:
+            timeout (float): the default per-request timeout in seconds.
+            max_idle (int): the most idle connections to keep per host.
+
+        """
+        self.timeout = timeout
+        self.max_idle = max_idle
+        self._idle = {}  # (scheme, host, port) -> [connection]
+        self._lock = threading.Lock()
+        self._stats = { 'requests': 0
+                      , 'connections_opened': 0
+                      , 'connections_reused': 0
+                      }
+
+    def stats(self):
+        """Returns a copy of the request and connection counters."""
+        with self._lock:
+            return dict(self._stats)
+
+    def _count(self, name):
+        with self._lock:
+            self._stats[name] += 1
+
+    def _acquire(self, key, timeout):
+        with self._lock:
+            idle = self._idle.get(key)
+            if idle:
+                self._stats['connections_reused'] += 1
+                connection = idle.pop()
+                if connection.sock is not None:
+                    connection.sock.settimeout(timeout)
+                return connection, True
+            self._stats['connections_opened'] += 1
+        scheme, host, port = key
+        if scheme == 'https':
+            return httplib.HTTPSConnection(host, port, timeout=timeout), False
+        return httplib.HTTPConnection(host, port, timeout=timeout), False
+
+    def _release(self, key, connection, reusable):
+        with self._lock:
+            idle = self._idle.setdefault(key, [])
+            if reusable and len(idle) < self.max_idle:
+                idle.append(connection)
+                return
+        connection.close()
+
+    def close(self):
+        """Closes all idle connections."""
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for connections in idle.values():
+            for connection in connections:
+                connection.close()
+
+    def request(self, method, url, params=None, data=None, headers=None,
+            timeout=None, limiter=None):
+        """Makes a request, following redirects.
+
+        With a limiter, waits for it before sending, and tells it whether
+        the server throttled the request (429 or 503). Retrying is left to
+        the caller; see retry.RetryPolicy.
+
+        Args:
+            method (str): e.g. 'GET' or 'POST'.
+            url (str): an http or https url.
+            params (dict | None): appended to the url as a query string.
+            data (str | None): the request body.
+            headers (dict | None): extra request headers.
+            timeout (float | None): seconds to wait on the socket; defaults
+                to the client's timeout.
+            limiter (ratelimit.RateLimiter | None): the provider's limiter.
+
+        Returns:
+            (Response) the response. Read it to the end or close it, or
+                its connection is not reused.
+
+        Raises:
+            HTTPError: if the server responds with an error status.
+            socket.error: if the connection fails.
+            ratelimit.QuotaExceeded: if the limiter's daily quota is used
+                up.
+
+        """
+        if params:
+            separator = '&' if '?' in url else '?'
+            url += separator + urllib.urlencode(params)
+        headers = dict(headers or {})
+        headers.setdefault('Accept-Encoding', 'gzip')
+        timeout = self.timeout if timeout is None else timeout
+
+        if limiter is not None:
+            limiter.acquire()
+        try:
+            response = self._follow(method, url, data, headers, timeout)
+        except HTTPError as e:
+            if limiter is not None and e.code in THROTTLED:
+                limiter.throttled(parse_retry_after(
+                        e.hdrs.getheader('retry-after')))
+            raise
+        if limiter is not None:
+            limiter.succeeded()
+        return response
+
+    def _follow(self, method, url, data, headers, timeout):
+        for _ in range(MAX_REDIRECTS + 1):
+            response = self._request(method, url, data, headers, timeout)
+            if response.status not in _REDIRECTS:
+                break
+            location = response.getheader('location')
+            response.read()
+            if not location:
+                break
+            url = urlparse.urljoin(url, location)
+            if response.status == 303 or (response.status in (301, 302)
+                                          and method == 'POST'):
+                method, data = 'GET', None
+
+        if response.status >= 400:
+            body = StringIO(response.read())
+            raise HTTPError(url, response.status, response.reason,
+                            response.headers, body)
+        return response
+
+    def _request(self, method, url, data, headers, timeout):
+        parts = urlparse.urlsplit(url)
+        scheme = parts.scheme.lower()
+        default_port = 443 if scheme == 'https' else 80
+        key = (scheme, parts.hostname, parts.port or default_port)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+
+        self._count('requests')
+        while True:
+            connection, reused = self._acquire(key, timeout)
+            sent = False
+            try:
+                connection.request(method, path, data, headers)
+                sent = True
+                response = connection.getresponse()
+            except (httplib.HTTPException, socket.error) as e:
+                connection.close()
+                if reused and _dropped_idle(e, method, sent):
+                    continue
+                raise
+            return Response(self, key, connection, response, url)
+
+
+def _dropped_idle(error, method, sent):
+    """Tests whether a request on a reused connection failed because the
+    server had closed it while idle, so that it is safe to send again.
+
+    Timeouts are never retried here: the server may be working on the
+    request, and retrying is RetryPolicy's job. Once the request is sent,
+    only an idempotent one is retried, and only for the errors a closed
+    connection gives.
+
+    """
+    if isinstance(error, socket.timeout):
+        return False
+    if not sent:
+        return True
+    if method not in IDEMPOTENT:
+        return False
+    return isinstance(error, httplib.BadStatusLine) \
+        or getattr(error, 'errno', None) in (errno.ECONNRESET, errno.EPIPE)
+
+
+default_client = HTTPClient()
+
+
+def check_response(response, max_bytes=None, content_types=None):
+    """Refuses `response` before its body is read, if it can tell.
+
+    Args:
+        response (Response): an unread response.
+        max_bytes (int | None): refuse a Content-Length larger than this.
+        content_types (Sequence[str] | None): refuse a Content-Type that
+            doesn't start with one of these, e.g. ('image/',).
+
+    Raises:
+        DownloadError: if the response is refused. It is closed first.
+
+    """
+    if content_types is not None:
+        content_type = (response.getheader('content-type') or '').lower()
+        if not any(content_type.startswith(t) for t in content_types):
+            response.close()
+            raise DownloadError('Unexpected content type {!r} from {}.'
+                                .format(content_type, response.url))
+    if max_bytes is not None:
+        length = response.getheader('content-length') or ''
+        if length.isdigit() and int(length) > max_bytes:
+            response.close()
+            raise DownloadError('{} is {} bytes, more than {}.'
+                                .format(response.url, length, max_bytes))
+
+
+def copy_response(response, f, max_bytes=None):
+    """Streams the body of `response` to the file object `f`.
+
+    Args:
+        response (Response): the response to read.
+        f (file): where to write the body.
+        max_bytes (int | None): give up once the body exceeds this, which
+            catches servers that send no or a false Content-Length.
+
+    Raises:
+        DownloadError: if the body is too large. The response is closed,
+            but what was written so far is left in `f`.
+
+    """
+    size = 0
+    while True:
+        chunk = response.read(CHUNK_SIZE)
+        if not chunk:
+            return
+        size += len(chunk)
+        if max_bytes is not None and size > max_bytes:
+            response.close()
+            raise DownloadError('{} is more than {} bytes.'
+                                .format(response.url, max_bytes))
+        f.write(chunk)
+
+
+def retrieve(url, filename, timeout=None, max_bytes=None, content_types=None,
+        limiter=None):
+    """Downloads `url` to `filename` with the default client.
+
+    Args:
+        url (str): the url to fetch.
+        filename (str): the path of the destination file. Removed again if
+            the download fails.
+        timeout, limiter: see HTTPClient.request.
+        max_bytes, content_types: see check_response.
+
+    Raises:
+        DownloadError: if the response is refused.
+
+    """
+    response = default_client.request('GET', url, timeout=timeout,
+                                      limiter=limiter)
+    check_response(response, max_bytes, content_types)
+    try:
+        with open(filename, 'wb') as f:
+            copy_response(response, f, max_bytes)
+    except:
+        if os.path.exists(filename):
+            os.remove(filename)
+        raise
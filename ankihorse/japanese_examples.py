@@ -8,22 +8,48 @@
 #
 # Stolen from https://github.com/javdejong/japanese-examples
 # Integrated into the ankihorse framework by Blaine Rogers
-from aqt import mw
-from aqt.qt import *
+from anki.hooks import addHook
+try:
+    from aqt import mw
+except ImportError:
+    mw = None  # no GUI; see headless.install
 
 import os
-import codecs
-import cPickle
+import itertools
+import mmap
 import random
 import re
+import threading
 from operator import itemgetter
 
+from .example_index import corpus_checksum, open_index, write_index
+from .example_index import weighted_sample
+from .pipeline import background
 from .updateraddon import Addon, AnySourceAllTargetFieldUpdater
 
-FNAME = os.path.join(mw.pm.addonFolder(), "ankihorse", "japanese_examples.utf")
-FILE_PICKLE = os.path.join(mw.pm.addonFolder(), "ankihorse", "japanese_examples.pickle")
+DIRECTORY = os.path.dirname(__file__)
+FNAME = os.path.join(DIRECTORY, "japanese_examples.utf")
+FILE_INDEX = os.path.join(DIRECTORY, "japanese_examples.index")
+# Replaced by FILE_INDEX; deleted if found.
+FILE_PICKLE = os.path.join(DIRECTORY, "japanese_examples.pickle")
+
+HIGHLIGHT = u'<FONT COLOR="#ff0000">%s</FONT>'
+SPLITTER = re.compile(r'\s|\[|\]|\(|\{|\)|\}')
+# A word in an indexed (B) line: headword(reading)[sense]{form in sentence}~
+TOKEN = re.compile(r'^([^(\[{~]+)(?:\(([^)]*)\))?(?:\[\d+\])*(?:\{([^}]*)\})?~?$')
+ALTERNATIVES = re.compile(u"(.*?)[／/]")
+PARENTHESISED = re.compile(u"(.*?)[(（](.+?)[)）]")
 
 class JapaneseExamplesFieldUpdater(AnySourceAllTargetFieldUpdater):
+    """Fills fields with example sentences from the Tanaka Corpus.
+
+    The corpus and its index are loaded on a background thread, started
+    by `warm` or by the first lookup, so that creating the updater costs
+    nothing however large the corpus is. Lookups wait for the load.
+
+    """
+    overwrites = False
+
     def __init__(self, query_field_names, target_field_names, weighted=True):
         """Initialiser.
 
@@ -39,24 +65,53 @@ class JapaneseExamplesFieldUpdater(AnySourceAllTargetFieldUpdater):
                 .__init__(self, query_field_names, target_field_names)
 
         self.weighted = weighted
+        self.content = None
+        self.index = None
+        self._loading = None
+        self._loading_lock = threading.Lock()
+
+    def warm(self):
+        """Starts loading the corpus in the background, if not already
+        started.
+
+        Returns:
+            (pipeline.Future) done once the corpus is loaded.
+
+        """
+        with self._loading_lock:
+            if self._loading is None:
+                self._loading = background(self._load)
+            return self._loading
+
+    def wait(self):
+        """Blocks until the corpus is loaded, starting the load if needed.
+
+        Raises:
+            EnvironmentError: if the corpus or index couldn't be read.
 
-        f = codecs.open(FNAME, 'r', 'utf8')
-        self.content = f.readlines()
+        """
+        self.warm().result()
+
+    def _load(self):
+        # The corpus is mapped rather than read, so lines are only decoded
+        # when an example is actually needed.
+        f = open(FNAME, 'rb')
+        self.content = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
         f.close()
 
-        # Load or generate the dictionaries
-        if  (os.path.exists(FILE_PICKLE) and
-            os.stat(FILE_PICKLE).st_mtime > os.stat(FNAME).st_mtime):
-            f = open(FILE_PICKLE, 'rb')
-            self.dictionaries = cPickle.load(f)
-            f.close()
-        else:
-            self.dictionaries = ({}, {})
-            self.build_dictionaries()
-            f = open(FILE_PICKLE, 'wb')
-            cPickle.dump(self.dictionaries, f, cPickle.HIGHEST_PROTOCOL)
-            f.close()
-                
+        # Load or generate the index
+        checksum = corpus_checksum(self.content)
+        index = open_index(FILE_INDEX, checksum)
+        if index is None:
+            write_index(FILE_INDEX, self.build_dictionaries(), checksum)
+            index = open_index(FILE_INDEX, checksum)
+        if os.path.exists(FILE_PICKLE):
+            os.remove(FILE_PICKLE)
+        self.index = index
+
+    def settingsKey(self):
+        return 'examples {}'.format(self.weighted)
+
     def modifyFields(self, note):
         """Modifies the fields of note.
 
@@ -95,8 +150,19 @@ class JapaneseExamplesFieldUpdater(AnySourceAllTargetFieldUpdater):
         return True
 
     def build_dictionaries(self):
+        """Indexes the corpus.
+
+        Returns:
+            (Tuple[dict, dict]) the priority and normal dictionaries, each
+                mapping words to postings sorted by length. A posting is
+                (line offset, line length, highlight start, highlight
+                length); see `highlight_span`.
+
+        """
+        dictionaries = ({}, {})
+
         def splitter(txt):
-            txt = re.compile('\s|\[|\]|\(|\{|\)|\}').split(txt)
+            txt = SPLITTER.split(txt)
             for i in range(0,len(txt)):
                 if txt[i] == "~":
                     txt[i-2] = txt[i-2] + "~"
@@ -104,122 +170,162 @@ class JapaneseExamplesFieldUpdater(AnySourceAllTargetFieldUpdater):
                     txt[i] = ""
             return [x for x in txt if x]
 
-        for i, line in enumerate(self.content[1::2]):
+        lines = self.lines()
+        for (offset, a_line), (_, line) in itertools.izip(lines, lines):
+            a_line = a_line.decode('utf-8')
+            line = line.decode('utf-8')
             words = set(splitter(line)[1:-1])
-            linelength = len(self.content[2*i][3:].split("#ID=")[0])
+            example = a_line[3:].split("#ID=")[0]
+            linelength = len(example)
+            japanese = example.split('\t')[0]
+            forms = sentence_forms(line)
             for word in words:
                 # Choose the appropriate dictionary; priority (0) or normal (1)
                 if word.endswith("~"):
-                    dictionary = self.dictionaries[0]
+                    dictionary = dictionaries[0]
                     word = word[:-1]
                 else:
-                    dictionary = self.dictionaries[1]
-
-                if word in dictionary and not word.isdigit():
-                    dictionary[word].append((2*i,linelength))
-                elif not word.isdigit():
-                    dictionary[word]=[]
-                    dictionary[word].append((2*i,linelength))
+                    dictionary = dictionaries[1]
+
+                if word.isdigit():
+                    continue
+                start, length = highlight_span(japanese, word, forms)
+                posting = (offset, linelength, start, length)
+                if word in dictionary:
+                    dictionary[word].append(posting)
+                else:
+                    dictionary[word] = [posting]
 
         # Sort all the entries based on their length
-        for dictionary in self.dictionaries:
+        for dictionary in dictionaries:
             for d in dictionary:
                 dictionary[d] = sorted(dictionary[d], key=itemgetter(1))
+        return dictionaries
+
+    def lines(self):
+        """Yields (byte offset, line) for each line of the corpus."""
+        offset = 0
+        end = len(self.content)
+        while offset < end:
+            newline = self.content.find('\n', offset)
+            if newline == -1:
+                newline = end
+            yield offset, self.content[offset:newline]
+            offset = newline + 1
+
+    def line_at(self, offset):
+        """Returns the line starting at byte `offset`.
+
+        Returns:
+            (Tuple[unicode, int]) the decoded line and the offset of the
+                line after it.
+
+        """
+        newline = self.content.find('\n', offset)
+        if newline == -1:
+            newline = len(self.content)
+        line = self.content[offset:newline].decode('utf-8')
+        return line, newline + 1
 
     def find_examples(self, expression, maxitems):
+        self.wait()
         examples = []
 
-        for dictionary in self.dictionaries:
-            if expression in dictionary:
-                index = dictionary[expression]
+        for dictionary in (0, 1):
+            index = self.index.lookup(dictionary, expression)
+            if index is not None:
                 if self.weighted:
                     index = weighted_sample(index, min(len(index),maxitems))
                 else:
                     index = random.sample(index, min(len(index),maxitems))
-                    index = [a for a,b in index]
 
                 maxitems -= len(index)
-                for j in index:
-                    example = self.content[j].split("#ID=")[0][3:]
-                    if dictionary is self.dictionaries[0]:
+                for offset, _, start, length in index:
+                    example = self.line_at(offset)[0].split("#ID=")[0][3:]
+                    japanese, tab, english = example.partition('\t')
+                    if length:
+                        end = start + length
+                        japanese = u''.join((japanese[:start],
+                                             HIGHLIGHT % japanese[start:end],
+                                             japanese[end:]))
+                    # as before the spans, e.g. for a word in Latin script
+                    english = english.replace(expression,
+                                              HIGHLIGHT % expression)
+                    example = japanese + tab + english
+                    if dictionary == 0:
                         example = example + " {CHECKED}"
-                    example = example.replace(expression,'<FONT COLOR="#ff0000">%s</FONT>' %expression)
-                    color_example = self.content[j+1]
-                    regexp = "(?:\(*%s\)*)(?:\([^\s]+?\))*(?:\[\d+\])*\{(.+?)\}" %expression
-                    match = re.compile("%s" %regexp).search(color_example)
-                    regexp_reading = "(?:\s([^\s]*?))(?:\(%s\))" % expression
-                    match_reading = re.search(regexp_reading, color_example)
-                    if match:
-                        expression_bis = match.group(1)
-                        example = example.replace(expression_bis,'<FONT COLOR="#ff0000">%s</FONT>' %expression_bis)
-                    elif match_reading:
-                        expression_bis = match_reading.group(1)
-                        example = example.replace(expression_bis,'<FONT COLOR="#ff0000">%s</FONT>' %expression_bis) 
-                    else:
-                        example = example.replace(expression,'<FONT COLOR="#ff0000">%s</FONT>' %expression)
                     examples.append(tuple(example.split('\t')))
             else:
-                match = re.search(u"(.*?)[／/]", expression)
+                match = ALTERNATIVES.search(expression)
                 if match:
-                    res = find_examples(match.group(1), maxitems)
+                    res = self.find_examples(match.group(1), maxitems)
                     maxitems -= len(res)
                     examples.extend(res)
 
-                match = re.search(u"(.*?)[(（](.+?)[)）]", expression)
+                match = PARENTHESISED.search(expression)
                 if match:
                     if match.group(1).strip():
-                        res = find_examples("%s%s" % (match.group(1), match.group(2)), maxitems)
+                        res = self.find_examples("%s%s" % (match.group(1), match.group(2)), maxitems)
                         maxitems -= len(res)
                         examples.extend(res)
 
         return examples
 
+def sentence_forms(line):
+    """Maps each word of an indexed (B) line to the text to highlight.
+
+    Headwords and readings map to the form in which the word appears in
+    the sentence, or failing that to the headword; sentence forms map to
+    themselves. The first occurrence of a word wins.
+
+    Args:
+        line (unicode): a B line of the corpus.
+
+    Returns:
+        (Dict[unicode, unicode]) the forms.
+
+    """
+    forms = {}
+    for token in line.split()[1:]:
+        match = TOKEN.match(token)
+        if not match:
+            continue
+        head, reading, surface = match.groups()
+        forms.setdefault(head, surface or head)
+        if reading:
+            forms.setdefault(reading, surface or head)
+        if surface:
+            forms.setdefault(surface, surface)
+    return forms
+
+def highlight_span(japanese, word, forms):
+    """Finds the text to highlight for `word` in an example sentence.
+
+    Args:
+        japanese (unicode): the Japanese half of the example.
+        word (unicode): the indexed word.
+        forms (Dict[unicode, unicode]): from `sentence_forms`.
+
+    Returns:
+        (Tuple[int, int]) the start and length of the text in `japanese`,
+            or (0, 0) if neither the word nor its form appears.
+
+    """
+    for target in (forms.get(word, word), word):
+        start = japanese.find(target)
+        if start != -1 and target:
+            return start, len(target)
+    return 0, 0
+
+def field_updater(source_fields=['Expression'],
+        target_fields=['Sentence', 'Sentence-Clozed'], weighted=True):
+    return JapaneseExamplesFieldUpdater(source_fields, target_fields,
+                                        weighted)
+
 def initialise(name='japanese_examples', source_fields=['Expression'], 
         target_fields=['Sentence', 'Sentence-Clozed'], weighted=True,
         model_name_substring=None, on_focus_lost=False):
-    field_updater = JapaneseExamplesFieldUpdater(
-            source_fields, target_fields, weighted)
-    Addon(field_updater, name, model_name_substring, on_focus_lost)
-
-class Node:
-    pass
-
-def weighted_sample(somelist, n):
-    # TODO: See if http://stackoverflow.com/questions/2140787/select-random-k-elements-from-a-list-whose-elements-have-weights is faster for some practical use-cases.
-    # This method is O(n²), but is straightforward and simple.
-
-    # Magic numbers:
-    minlength = 25
-    maxlength = 70
-    power = 3
-
-    #
-    l = []   # List containing nodes with their (constantly) updated weights
-    ret = [] # Array of return values
-    tw = 0.0 # Total weight
-
-    for a,b in somelist:
-        bold = b
-        b = max(b,minlength)
-        b = min(b,maxlength)
-        b = b - minlength
-        b = maxlength - minlength - b + 1
-        b = b**power
-        z = Node()
-        z.w = b
-        z.v = a
-        tw += b
-        l.append(z)
-
-    for j in range(n):
-        g = tw * random.random()
-        for z in l:
-            if g < z.w:
-                ret.append(z.v)
-                tw -= z.w
-                z.w = 0.0
-                break
-            else:
-                g -= z.w
-
-    return ret
+    updater = field_updater(source_fields, target_fields, weighted)
+    # load once Anki is up rather than while it is starting
+    addHook('profileLoaded', updater.warm)
+    Addon(updater, name, model_name_substring, on_focus_lost)
@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+"""
+manifest
+========
+
+Remembers what each addon last generated each note from, so that bulk
+regeneration can skip notes whose sources haven't changed.
+
+"""
+import os
+import sqlite3
+
+
+class Manifest(object):
+    """A persistent map from (addon name, note id) to a source hash."""
+
+    def __init__(self, path):
+        """Initialiser.
+
+        Args:
+            path (str): the database file. Created if missing.
+
+        """
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        self._db = sqlite3.connect(path)
+        self._db.execute('create table if not exists notes '
+                         '(addon text, nid integer, hash text, '
+                         'primary key (addon, nid))')
+
+    def hashes(self, addon):
+        """Returns a dict from note id to the recorded hash for `addon`."""
+        rows = self._db.execute('select nid, hash from notes where addon = ?',
+                                (addon,))
+        return dict(rows)
+
+    def update(self, addon, hashes):
+        """Records hashes for `addon`.
+
+        Args:
+            addon (str): the addon name.
+            hashes (Iterable[Tuple[int, str]]): (note id, hash) pairs.
+
+        """
+        self._db.executemany('insert or replace into notes values (?, ?, ?)',
+                             ((addon, nid, h) for nid, h in hashes))
+        self._db.commit()
+
+    def close(self):
+        self._db.close()
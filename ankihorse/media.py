@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+"""
+media
+=====
+
+Puts files into the collection's media folder.
+
+`MediaManager.addFile` copies the file in, checksumming it against any
+file of the same name and renaming it on a clash. The providers already
+leave their downloads in a cache under a name derived from what was asked
+for, so the file is copied straight in under that name instead. It is
+copied rather than hard linked: the cache keeps recency in its files'
+mtimes, and a linked media file would share those, as well as any edits
+made to it in the media folder.
+
+Anki 2.0 notices new media by scanning the folder, so nothing needs
+registering: a file in the folder is as added as one from addFile. Names
+are cleaned up as addFile would, by `media_name`.
+
+"""
+import os
+import re
+import shutil
+import unicodedata
+
+from .atomic import write_atomically
+from .stats import timed
+
+
+# as MediaManager._illegalCharReg
+ILLEGAL_CHARACTERS = re.compile(r'[][><:"/?*^\\|\0\r\n]')
+
+
+def media_name(name):
+    """Returns `name` as MediaManager.addFile would store it: NFC
+    normalised, without characters that are illegal in media names."""
+    name = unicodedata.normalize('NFC', unicode(name))
+    return ILLEGAL_CHARACTERS.sub(u'', name)
+
+
+def add_file(path, media_dir, name=None):
+    """Puts the file at `path` into `media_dir`.
+
+    Names are assumed to determine content, so if `name` is already in the
+    folder, the existing file is kept.
+
+    Args:
+        path (str): the file to add. Left where it is.
+        media_dir (str): the collection's media folder, from
+            `mw.col.media.dir()`.
+        name (str | None): the name to give it; defaults to the basename
+            of `path`.
+
+    Returns:
+        (unicode) the name of the file in the media folder.
+
+    """
+    name = media_name(name or os.path.basename(path))
+    destination = os.path.join(media_dir, name)
+    with timed('media', 'add file'):
+        if not os.path.exists(destination):
+            shutil.copyfile(path, destination)
+    return name
+
+
+def write_file(media_dir, name, write):
+    """Writes a file straight into `media_dir`.
+
+    The file is written under a hidden temporary name and renamed once
+    complete, so a failed write never leaves a partial file under `name`.
+
+    Args:
+        media_dir (str): the collection's media folder.
+        name (unicode): the final name of the file.
+        write (Callable[[str], None]): writes the content to the path it
+            is given.
+
+    Returns:
+        (unicode) the name of the file in the media folder.
+
+    """
+    name = media_name(name)
+    write_atomically(os.path.join(media_dir, name), write, replace=False)
+    return name
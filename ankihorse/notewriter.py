@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+"""
+notewriter
+==========
+
+Writes modified notes back to the collection in chunks.
+
+`Note.flush` checks, writes and generates cards for one note at a time.
+During bulk regeneration that bookkeeping dominates, so notes are gathered
+here and written with one statement per chunk. The collection is saved
+after each chunk, so an interrupted run keeps the chunks already written.
+
+"""
+from anki.utils import ids2str, intTime
+
+from .stats import timed
+
+DEFAULT_CHUNK_SIZE = 500
+
+
+class NoteWriter(object):
+    """Gathers notes and writes them to the collection in chunks."""
+
+    def __init__(self, col, chunk_size=DEFAULT_CHUNK_SIZE, on_commit=None):
+        """Initialiser.
+
+        Args:
+            col (anki.collection._Collection): the collection to write to.
+            chunk_size (int): the number of notes to gather before writing.
+            on_commit (Callable[[List[anki.notes.Note],
+                List[anki.notes.Note]], None] | None): called with each
+                chunk, and the notes in it that were added as settled,
+                once it has been saved.
+
+        """
+        self._col = col
+        self._chunk_size = max(1, chunk_size)
+        self._on_commit = on_commit
+        self._pending = []
+        self._unsettled = set()  # ids of pending notes that weren't settled
+        self.written = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.commit()
+
+    def add(self, note, settled=True):
+        """Queues `note`, which is only written if its fields changed.
+
+        Args:
+            note (anki.notes.Note): the note.
+            settled (bool): False if the note still needs work, e.g. because
+                a fetch failed, and so shouldn't be recorded as done.
+
+        """
+        self._pending.append(note)
+        if not settled:
+            self._unsettled.add(note.id)
+        if len(self._pending) >= self._chunk_size:
+            self.commit()
+
+    def commit(self):
+        """Writes and saves the queued notes."""
+        notes, self._pending = self._pending, []
+        unsettled, self._unsettled = self._unsettled, set()
+        if not notes:
+            return
+        with timed('collection', 'write'):
+            self._write(notes)
+        if self._on_commit is not None:
+            self._on_commit(notes,
+                            [n for n in notes if n.id not in unsettled])
+
+    def _write(self, notes):
+        col = self._col
+        stored = dict(col.db.all('select id, flds from notes where id in '
+                                 + ids2str(n.id for n in notes)))
+        changed = [n for n in notes if stored.get(n.id) != n.joinedFields()]
+        if changed:
+            mod = intTime()
+            usn = col.usn()
+            for note in changed:
+                note.mod = mod
+                note.usn = usn
+            col.db.executemany('update notes set flds = ?, mod = ?, usn = ? '
+                               'where id = ?',
+                               [(n.joinedFields(), mod, usn, n.id)
+                                for n in changed])
+            nids = [n.id for n in changed]
+            col.updateFieldCache(nids)
+            col.genCards(nids)
+            self.written += len(changed)
+        col.save()
@@ -0,0 +1,193 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+"""
+pipeline
+========
+
+A small thread pool for running network-bound work off the main thread.
+
+Work submitted here must not touch the collection: workers only see the
+arguments they are handed, and results come back to the calling thread
+through a queue.
+
+"""
+import sys
+import threading
+import Queue
+
+
+class Future(object):
+    """The eventual result of a call running on another thread."""
+
+    def __init__(self):
+        self._done = threading.Event()
+        self._result = None
+        self._exc_info = None
+        self._callbacks = []
+        self._lock = threading.Lock()
+
+    def done(self):
+        return self._done.is_set()
+
+    def set_result(self, result):
+        self._result = result
+        self._finish()
+
+    def set_exc_info(self, exc_info):
+        self._exc_info = exc_info
+        self._finish()
+
+    def _finish(self):
+        with self._lock:
+            self._done.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            callback(self)
+
+    def add_done_callback(self, callback):
+        """Calls `callback(self)` once the future is done.
+
+        The callback runs on whichever thread finishes the future, or
+        immediately if it is already done.
+
+        """
+        with self._lock:
+            if not self._done.is_set():
+                self._callbacks.append(callback)
+                return
+        callback(self)
+
+    def result(self, timeout=None):
+        """Waits for and returns the result, re-raising any exception.
+
+        Args:
+            timeout (float | None): seconds to wait; None waits forever.
+
+        Raises:
+            RuntimeError: if the timeout expires first.
+
+        """
+        if not self._done.wait(timeout):
+            raise RuntimeError('Timed out waiting for result.')
+        if self._exc_info is not None:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        return self._result
+
+
+class Executor(object):
+    """A fixed-size pool of daemon worker threads."""
+
+    def __init__(self, workers):
+        """Initialiser.
+
+        Args:
+            workers (int): the number of worker threads.
+
+        """
+        self._tasks = Queue.Queue()
+        self._threads = []
+        for _ in range(max(1, workers)):
+            thread = threading.Thread(target=self._work)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def _work(self):
+        while True:
+            task = self._tasks.get()
+            if task is None:
+                return
+            future, fn, args, kwargs = task
+            try:
+                future.set_result(fn(*args, **kwargs))
+            except BaseException:
+                future.set_exc_info(sys.exc_info())
+
+    def submit(self, fn, *args, **kwargs):
+        """Schedules `fn(*args, **kwargs)` and returns a Future for it."""
+        future = Future()
+        self._tasks.put((future, fn, args, kwargs))
+        return future
+
+    def shutdown(self):
+        """Drops queued work and stops the workers once they are idle."""
+        try:
+            while True:
+                self._tasks.get_nowait()
+        except Queue.Empty:
+            pass
+        for _ in self._threads:
+            self._tasks.put(None)
+
+
+def background(fn, *args, **kwargs):
+    """Runs `fn(*args, **kwargs)` on a new daemon thread.
+
+    For one-off work, like loading a file, that shouldn't hold up the
+    caller.
+
+    Returns:
+        (Future) the eventual result.
+
+    """
+    future = Future()
+
+    def run():
+        try:
+            future.set_result(fn(*args, **kwargs))
+        except BaseException:
+            future.set_exc_info(sys.exc_info())
+
+    thread = threading.Thread(target=run)
+    thread.daemon = True
+    thread.start()
+    return future
+
+
+def imap_unordered(fn, items, workers, max_pending=None):
+    """Maps `fn` over `items` on a pool of worker threads.
+
+    `items` is consumed lazily on the calling thread, so producing an item
+    may safely touch the collection. At most `max_pending` items are in
+    flight at once, which bounds memory however long `items` is.
+
+    Args:
+        fn (Callable[[T], U]): run on a worker thread for each item.
+        items (Iterable[T]): the inputs.
+        workers (int): the number of worker threads.
+        max_pending (int | None): the maximum number of items submitted
+            but not yet yielded; defaults to twice `workers`.
+
+    Yields:
+        (Tuple[T, U]) each item with its result, in completion order.
+
+    Raises:
+        Exception: whatever `fn` raised, on the calling thread. Queued
+            items are abandoned.
+
+    """
+    max_pending = max_pending or 2 * workers
+    finished = Queue.Queue()
+    executor = Executor(workers)
+    items = iter(items)
+    pending = 0
+    exhausted = False
+    try:
+        while True:
+            while not exhausted and pending < max_pending:
+                try:
+                    item = next(items)
+                except StopIteration:
+                    exhausted = True
+                    break
+                future = executor.submit(fn, item)
+                future.add_done_callback(
+                        lambda f, item=item: finished.put((item, f)))
+                pending += 1
+            if pending == 0:
+                return
+            item, future = finished.get()
+            pending -= 1
+            yield item, future.result()
+    finally:
+        executor.shutdown()
@@ -0,0 +1,183 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+"""
+ratelimit
+=========
+
+Per-provider rate limiting, so that bulk runs go as fast as a provider
+allows rather than failing with 429s or running out of daily quota.
+
+Each provider has one shared `RateLimiter`, from `limiter(provider)`. Pass
+it to `HTTPClient.request`, which waits for it before each request and
+reports throttling responses back to it.
+
+"""
+import threading
+import time
+from email.utils import parsedate_tz, mktime_tz
+
+from .config import store
+
+# (requests per second, requests per day or None)
+DEFAULT_LIMITS = { 'bing speech': (5, None)
+                 , 'bing search': (3, None)
+                 , 'google search': (1, 100)
+                 , 'voicerss': (2, 350)
+                 }
+THROTTLED = (429, 503)
+
+
+class QuotaExceeded(Exception):
+    """Raised when a provider's daily quota is used up."""
+
+
+class RateLimiter(object):
+    """A token bucket that slows down when the provider pushes back.
+
+    Lets requests through at up to `rate` per second, in bursts of up to
+    `burst`. When the provider throttles a request, the rate is halved, no
+    request is let through until the provider's Retry-After has passed,
+    and each success then raises the rate by a tenth of the configured
+    rate until it is back to normal. Safe to use from several threads.
+
+    """
+
+    def __init__(self, name, rate, burst=None, daily_quota=None,
+            clock=time.time, sleep=time.sleep):
+        """Initialiser.
+
+        Args:
+            name (str): the provider, for error messages.
+            rate (float): the most requests per second.
+            burst (int | None): the most requests let through at once after
+                a quiet spell; defaults to one second's worth.
+            daily_quota (int | None): the most requests per UTC day, or None
+                for no limit. Counted per process.
+            clock, sleep: for testing.
+
+        """
+        self.name = name
+        self.max_rate = float(rate)
+        self.min_rate = self.max_rate / 16
+        self.rate = self.max_rate
+        self.burst = burst or max(1, int(rate))
+        self.daily_quota = daily_quota
+        self._clock = clock
+        self._sleep = sleep
+        self._lock = threading.Lock()
+        self._tokens = float(self.burst)
+        self._updated = clock()
+        self._paused_until = 0
+        self._day = None
+        self._used_today = 0
+
+    def acquire(self):
+        """Blocks until a request may be made.
+
+        Raises:
+            QuotaExceeded: if the daily quota is used up.
+
+        """
+        while True:
+            with self._lock:
+                now = self._clock()
+                self._check_quota(now)
+                self._refill(now)
+                wait = self._paused_until - now
+                if wait <= 0:
+                    if self._tokens >= 1:
+                        self._tokens -= 1
+                        self._used_today += 1
+                        return
+                    wait = (1 - self._tokens) / self.rate
+            self._sleep(wait)
+
+    def _check_quota(self, now):
+        day = time.gmtime(now)[:3]
+        if day != self._day:
+            self._day = day
+            self._used_today = 0
+        if self.daily_quota is not None \
+                and self._used_today >= self.daily_quota:
+            raise QuotaExceeded('The daily quota of {} requests to {} is '
+                                'used up.'.format(self.daily_quota, self.name))
+
+    def _refill(self, now):
+        elapsed = max(0, now - self._updated)
+        self._tokens = min(self.burst, self._tokens + elapsed * self.rate)
+        self._updated = max(now, self._updated)
+
+    def throttled(self, retry_after=None):
+        """Slows down after the provider refused a request.
+
+        Args:
+            retry_after (float | None): seconds the provider asked us to
+                wait; defaults to one request interval.
+
+        """
+        with self._lock:
+            now = self._clock()
+            self.rate = max(self.min_rate, self.rate / 2)
+            if retry_after is None:
+                retry_after = 1 / self.rate
+            self._paused_until = max(self._paused_until, now + retry_after)
+            # no tokens build up during the pause
+            self._tokens = 0
+            self._updated = self._paused_until
+
+    def succeeded(self):
+        """Speeds back up after a request went through."""
+        with self._lock:
+            self.rate = min(self.max_rate, self.rate + self.max_rate / 10)
+
+
+def parse_retry_after(value, now=None):
+    """Parses a Retry-After header.
+
+    Args:
+        value (str | None): either a number of seconds or an HTTP date.
+        now (float | None): the current time, for dates; defaults to now.
+
+    Returns:
+        (float | None) seconds to wait, or None if absent or unparseable.
+
+    """
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+    parsed = parsedate_tz(value)
+    if parsed is None:
+        return None
+    now = time.time() if now is None else now
+    return max(0.0, mktime_tz(parsed) - now)
+
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+def limiter(provider):
+    """Returns the shared RateLimiter for `provider`.
+
+    Limits are read from the 'rate limits' section of the config, as
+    '<provider> requests per second' and '<provider> daily quota', falling
+    back to DEFAULT_LIMITS. Changing them replaces the limiter.
+
+    """
+    with _limiters_lock:
+        if provider not in _limiters:
+            rate, quota = store.rate_limit(
+                    provider, *DEFAULT_LIMITS.get(provider, (5, None)))
+            _limiters[provider] = RateLimiter(provider, rate,
+                                              daily_quota=quota)
+        return _limiters[provider]
+
+def _limits_changed(section, option, value):
+    # the next request to the provider builds a limiter with the new limits
+    with _limiters_lock:
+        for provider in list(_limiters):
+            if option.startswith(provider + ' '):
+                del _limiters[provider]
+
+store.subscribe(_limits_changed, 'rate limits')
@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+"""
+retry
+=====
+
+One retry policy for every provider.
+
+Failures are classified as auth (the credentials need refreshing),
+throttled (the provider asked us to slow down), transient (worth trying
+again) or permanent. Throttled and transient failures are retried with
+exponential backoff and jitter until the attempts or the time budget run
+out; auth failures are retried once, after the caller refreshes its
+credentials.
+
+"""
+import httplib
+import random
+import socket
+import time
+import urllib2
+
+from .ratelimit import THROTTLED as THROTTLED_CODES, parse_retry_after
+
+AUTH = 'auth'
+THROTTLED = 'throttled'
+TRANSIENT = 'transient'
+PERMANENT = 'permanent'
+
+
+class TransientError(Exception):
+    """Raise to mark a failure as worth retrying, e.g. a truncated file."""
+
+
+def classify(error):
+    """Returns AUTH, THROTTLED, TRANSIENT or PERMANENT for `error`."""
+    if isinstance(error, urllib2.HTTPError):
+        if error.code in (401, 403):
+            return AUTH
+        if error.code in THROTTLED_CODES:
+            return THROTTLED
+        if error.code == 408 or error.code >= 500:
+            return TRANSIENT
+        return PERMANENT
+    if isinstance(error, (TransientError, socket.error, httplib.HTTPException,
+                          urllib2.URLError)):
+        return TRANSIENT
+    return PERMANENT
+
+
+def _retry_after(error):
+    headers = getattr(error, 'hdrs', None)
+    if headers is None:
+        return None
+    return parse_retry_after(headers.getheader('retry-after'))
+
+
+class RetryPolicy(object):
+    """Retries calls with exponential backoff, jitter and a deadline."""
+
+    def __init__(self, attempts=4, base_delay=0.5, max_delay=8.0,
+            deadline=30.0, clock=time.time, sleep=time.sleep,
+            random=random.random):
+        """Initialiser.
+
+        Args:
+            attempts (int): the most times to call, including the first.
+            base_delay (float): the backoff before the first retry, in
+                seconds; doubled for each retry after that.
+            max_delay (float): the most to back off between attempts.
+            deadline (float): the most seconds to spend on one call, all
+                attempts included. A retry that would start later than this
+                isn't made.
+            clock, sleep, random: for testing.
+
+        """
+        self.attempts = attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.deadline = deadline
+        self._clock = clock
+        self._sleep = sleep
+        self._random = random
+
+    def delay(self, retry, error=None):
+        """Returns the seconds to wait before retry number `retry`.
+
+        Full jitter: uniformly random up to the exponential backoff, but
+        never less than a Retry-After the provider sent.
+
+        """
+        backoff = min(self.max_delay, self.base_delay * 2 ** retry)
+        delay = backoff * self._random()
+        retry_after = _retry_after(error) if error is not None else None
+        if retry_after is not None:
+            delay = max(delay, retry_after)
+        return delay
+
+    def call(self, fn, *args, **kwargs):
+        """Calls `fn(*args, **kwargs)`, retrying as the failures allow.
+
+        Args:
+            fn (Callable): the call to make.
+            on_auth (Callable[[Exception], None] | None): keyword only. If
+                given, called on the first auth failure, e.g. to refresh a
+                token, after which the call is retried at once. Without it,
+                auth failures are permanent.
+
+        Returns:
+            whatever `fn` returns.
+
+        Raises:
+            Exception: the last failure, once it is permanent or the
+                attempts or the deadline are used up.
+
+        """
+        on_auth = kwargs.pop('on_auth', None)
+        start = self._clock()
+        retry = 0
+        while True:
+            try:
+                return fn(*args, **kwargs)
+            except Exception as e:
+                kind = classify(e)
+                if kind == AUTH and on_auth is not None:
+                    on_auth(e)
+                    on_auth = None
+                    continue
+                retry += 1
+                if kind not in (THROTTLED, TRANSIENT) \
+                        or retry >= self.attempts:
+                    raise
+                delay = self.delay(retry - 1, e)
+                if self._clock() + delay - start > self.deadline:
+                    raise
+                self._sleep(delay)
+
+
+default_policy = RetryPolicy()
@@ -0,0 +1,225 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+"""
+stats
+=====
+
+Per-stage timing, to find out where a slow run spends its time.
+
+Timings are grouped by scope (an addon name, or a provider such as
+'bing speech') and stage (e.g. 'fetch', 'search', 'download'). Each keeps
+a count, a total and a histogram of durations.
+
+Recording is off unless 'enabled' is true in the 'stats' section of the
+config, or `set_enabled(True)` is called. While it is off, `timed` hands
+out one shared do-nothing context manager and `instrument` returns the
+updater it is given, so the hooks cost next to nothing.
+
+"""
+from __future__ import division
+import json
+import threading
+import time
+
+from .config import store
+
+# upper bounds of the histogram buckets, in milliseconds
+BUCKETS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000,
+              float('inf'))
+
+_enabled = None
+_timers = {}  # (scope, stage) -> Timer
+_lock = threading.Lock()
+
+
+def enabled():
+    """Returns True if timings are being recorded."""
+    global _enabled
+    if _enabled is None:
+        _enabled = store.get_bool('stats', 'enabled', False)
+    return _enabled
+
+def set_enabled(flag):
+    """Turns recording on or off, overriding the config."""
+    global _enabled
+    _enabled = bool(flag)
+
+def _config_changed(section, option, value):
+    global _enabled
+    if option == 'enabled':
+        _enabled = None
+
+store.subscribe(_config_changed, 'stats')
+
+
+class Timer(object):
+    """The timings of one stage in one scope."""
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.histogram = [0] * len(BUCKETS_MS)
+
+    def add(self, seconds):
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+        milliseconds = seconds * 1000
+        for i, bound in enumerate(BUCKETS_MS):
+            if milliseconds <= bound:
+                self.histogram[i] += 1
+                break
+
+    def percentile(self, fraction):
+        """Returns the upper bound in ms of the bucket holding the
+        `fraction` quantile, or None if nothing was recorded."""
+        if not self.count:
+            return None
+        rank = fraction * self.count
+        seen = 0
+        for bound, n in zip(BUCKETS_MS, self.histogram):
+            seen += n
+            if seen >= rank:
+                return bound
+        return BUCKETS_MS[-1]
+
+    def as_dict(self):
+        return { 'count': self.count
+               , 'total_s': self.total
+               , 'mean_ms': self.total / self.count * 1000 if self.count
+                            else None
+               , 'max_ms': self.max * 1000
+               , 'histogram_ms': [[_bound(b), n] for b, n
+                                  in zip(BUCKETS_MS, self.histogram) if n]
+               }
+
+
+def record(scope, stage, seconds):
+    """Records one timing of `stage` in `scope`, if recording is on."""
+    if not enabled():
+        return
+    with _lock:
+        timer = _timers.get((scope, stage))
+        if timer is None:
+            timer = _timers[scope, stage] = Timer()
+        timer.add(seconds)
+
+
+class _Timing(object):
+    __slots__ = ('scope', 'stage', 'start')
+
+    def __init__(self, scope, stage):
+        self.scope = scope
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        record(self.scope, self.stage, time.time() - self.start)
+
+
+class _NoTiming(object):
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+_no_timing = _NoTiming()
+
+def timed(scope, stage):
+    """Returns a context manager that times its body as `stage` of `scope`.
+
+    Failed attempts are timed too, since they cost just as much.
+
+    """
+    if not enabled():
+        return _no_timing
+    return _Timing(scope, stage)
+
+
+class InstrumentedUpdater(object):
+    """Wraps a FieldUpdater, timing its modify, query, fetch and apply
+    stages under the addon's name."""
+
+    def __init__(self, updater, scope):
+        self._updater = updater
+        self._scope = scope
+
+    def __getattr__(self, name):
+        return getattr(self._updater, name)
+
+    def modifyFields(self, note):
+        with _Timing(self._scope, 'modify'):
+            return self._updater.modifyFields(note)
+
+    def queryFor(self, note):
+        with _Timing(self._scope, 'query'):
+            return self._updater.queryFor(note)
+
+    def fetch(self, query):
+        with _Timing(self._scope, 'fetch'):
+            return self._updater.fetch(query)
+
+    def applyFetched(self, note, query, result):
+        with _Timing(self._scope, 'apply'):
+            return self._updater.applyFetched(note, query, result)
+
+def instrument(updater, scope):
+    """Returns `updater` wrapped to record timings, or as is if recording
+    is off."""
+    if not enabled():
+        return updater
+    return InstrumentedUpdater(updater, scope)
+
+
+def snapshot():
+    """Returns the timings so far as {scope: {stage: figures}}."""
+    with _lock:
+        result = {}
+        for (scope, stage), timer in _timers.items():
+            result.setdefault(scope, {})[stage] = timer.as_dict()
+        return result
+
+def reset():
+    """Forgets all timings."""
+    with _lock:
+        _timers.clear()
+
+def dump(path):
+    """Writes the timings to `path` as JSON."""
+    with open(path, 'w') as f:
+        json.dump(snapshot(), f, indent=2, sort_keys=True)
+
+def report():
+    """Returns the timings as a plain-text table, slowest total first."""
+    with _lock:
+        rows = sorted(_timers.items(), key=lambda item: -item[1].total)
+        lines = []
+        for (scope, stage), timer in rows:
+            lines.append(u'{:<32} {:<12} {:>7} {:>9.2f} {:>9.1f} {:>7} {:>7}'
+                         .format(scope[:32], stage[:12], timer.count,
+                                 timer.total,
+                                 timer.total / timer.count * 1000,
+                                 _bound(timer.percentile(0.5)),
+                                 _bound(timer.percentile(0.99))))
+    if not lines:
+        if not enabled():
+            return (u'Timing statistics are off. Set "enabled" to true in '
+                    u'the "stats" section of the config to record them.')
+        return u'No timings recorded yet.'
+    header = u'{:<32} {:<12} {:>7} {:>9} {:>9} {:>7} {:>7}'.format(
+            u'scope', u'stage', u'count', u'total s', u'mean ms',
+            u'p50 ms', u'p99 ms')
+    return u'\n'.join([header] + lines)
+
+def _bound(milliseconds):
+    """Formats a bucket bound; the last bucket has no upper bound."""
+    if milliseconds == float('inf'):
+        return '>{}'.format(BUCKETS_MS[-2])
+    return milliseconds
@@ -13,18 +13,46 @@ from __future__ import print_function
 import abc
 from functools import wraps, partial
 import os
+import Queue
+import weakref
 
 from anki.hooks import addHook, wrap
-from aqt import mw
-from aqt.editor import Editor
-from aqt.utils import shortcut, showInfo, askUser
-from aqt.qt import *
+from anki.utils import splitFields
+try:
+    from aqt import mw
+    from aqt.editor import Editor
+    from aqt.utils import shortcut, showInfo, showText, askUser
+    from aqt.qt import *
+except ImportError:
+    # No GUI, e.g. under the headless runner, which sets mw and showInfo
+    # itself. Only Addon needs the rest.
+    mw = showInfo = None
+
+from . import stats
+from .cache import make_key
+from .config import store
+from .manifest import Manifest
+from .notewriter import NoteWriter, DEFAULT_CHUNK_SIZE
+from .pipeline import Executor, imap_unordered
+from .sanitise import sanitise
+
+MANIFEST_FILE = 'ankihorse_manifest.sqlite'
+STATS_FILE = 'ankihorse_stats.json'
 
 
 class FieldUpdater():
     """Updates some note fields based on the content of others."""
     __metaclass__ = abc.ABCMeta
 
+    # True if the updater implements queryFor, fetch and applyFetched, which
+    # lets slow fetches run on worker threads during bulk regeneration.
+    # Checked when the updater is given to a Regenerator.
+    pipelined = False
+
+    # False if modifyFields leaves notes with a filled target field alone,
+    # which lets bulk regeneration skip them without loading them.
+    overwrites = True
+
     def requiredFields(self):
         return set(self.sourceFields()) | set(self.targetFields())
 
@@ -64,6 +92,25 @@ class FieldUpdater():
         fields = mw.col.models.fieldNames(model)
         return all(f in fields for f in self.requiredFields())
 
+    def needsModification(self, fields):
+        """Tests whether a note may need modifying, from its raw fields.
+
+        Used to pick candidates for bulk regeneration straight from the
+        notes table. May return True for notes that turn out to need
+        nothing, but must not return False for notes that do.
+
+        Args:
+            fields (Mapping[str, unicode]): the note's fields by name.
+
+        Returns:
+            (bool) False if modifyFields would certainly not modify the note.
+
+        """
+        if not any(fields.get(f) for f in self.sourceFields()):
+            return False
+        return self.overwrites or not any(fields.get(f)
+                                          for f in self.targetFields())
+
     @abc.abstractmethod
     def modifyFields(self, note):
         """Return a container of names of target fields.
@@ -80,6 +127,85 @@ class FieldUpdater():
         """
         pass
 
+    def settingsKey(self):
+        """Return a string that changes whenever the updater's output would.
+
+        Notes whose source fields are unchanged since they were last
+        regenerated are only skipped if this is unchanged too, so include
+        anything that affects the result, e.g. a voice or a locale.
+
+        """
+        return self.__class__.__name__
+
+    def queryFor(self, note):
+        """Return whatever `fetch` needs to update `note`, or None.
+
+        Called on the main thread. Must not modify the note. Only needed if
+        `pipelined` is True. Notes with equal queries may share one fetch,
+        so the query must be hashable.
+
+        Args:
+            note (anki.notes.Note): dictionary-like.
+
+        Returns:
+            (object | None) the query, or None if the note needs no update.
+
+        """
+        raise NotImplementedError
+
+    def fetch(self, query):
+        """Do the slow part of an update, e.g. a network request.
+
+        Called on a worker thread, so must not touch the collection. Only
+        needed if `pipelined` is True.
+
+        Args:
+            query (object): a value returned by `queryFor`.
+
+        Returns:
+            (object) a result to pass to `applyFetched`.
+
+        """
+        raise NotImplementedError
+
+    def applyFetched(self, note, query, result):
+        """Update `note` with the result of `fetch`.
+
+        Called on the main thread. Only needed if `pipelined` is True.
+
+        Args:
+            note (anki.notes.Note): dictionary-like.
+            query (object): the value returned by `queryFor` for `note`.
+            result (object): the value returned by `fetch` for `query`.
+
+        Returns:
+            (bool) True iff the note was modified.
+
+        """
+        raise NotImplementedError
+
+
+PIPELINE_METHODS = ('queryFor', 'fetch', 'applyFetched')
+
+def check_pipelined(field_updater):
+    """Checks that a pipelined updater implements the pipeline methods.
+
+    Raises:
+        TypeError: if `field_updater.pipelined` is True but it doesn't
+            override queryFor, fetch and applyFetched.
+
+    """
+    if not isinstance(field_updater, FieldUpdater) \
+            or not field_updater.pipelined:
+        return  # only FieldUpdater's own methods are stubs
+    cls = type(field_updater)
+    missing = [name for name in PIPELINE_METHODS
+               if getattr(cls, name).im_func
+               is getattr(FieldUpdater, name).im_func]
+    if missing:
+        raise TypeError('{} is pipelined but does not implement {}.'
+                        .format(cls.__name__, ', '.join(missing)))
+
 
 class AnySourceFieldUpdater(FieldUpdater):
     def __init__(self, query_field_names, target_field_name):
@@ -147,12 +273,267 @@ class AnySourceAllTargetFieldUpdater(FieldUpdater):
         return (any(f in fields for f in self.source_fields)
                 and all(f in fields for f in self.target_fields))
 
-class Addon():
+class ModelInfo(object):
+    """What addons need to know about one version of a model.
+
+    Attributes:
+        name (unicode): the model name, lower case.
+        field_names (List[unicode]): the field names, by ordinal.
+        ords (Dict[unicode, int]): field ordinals by name.
+        eligible (Dict[Addon, bool]): each addon's shouldModify verdict.
+
+    """
+
+    def __init__(self, model):
+        self.name = model['name'].lower()
+        # Anki keeps each field's 'ord' equal to its index in 'flds'
+        self.field_names = [f['name'] for f in model['flds']]
+        self.ords = dict((name, i) for i, name in enumerate(self.field_names))
+        self.eligible = {}
+
+
+_model_infos = {}  # model id -> (mod, ModelInfo)
+
+def model_info(model):
+    """Returns the ModelInfo for `model`, computing it once per version.
+
+    Anki updates a model's 'mod' whenever the model is saved, so editing a
+    note type invalidates its entry. Models without an id or mod, which
+    have never been saved, aren't cached.
+
+    """
+    mid, mod = model.get('id'), model.get('mod')
+    if mid is None or mod is None:
+        return ModelInfo(model)
+    entry = _model_infos.get(mid)
+    if entry is None or entry[0] != mod:
+        entry = _model_infos[mid] = (mod, ModelInfo(model))
+    return entry[1]
+
+
+class Regenerator(object):
+    """Regenerates the fields of many notes at once.
+
+    The part of an addon that needs no GUI: picking the notes to
+    regenerate, running the field updater over them and recording what
+    each was generated from. Uses `mw.col` for the collection and
+    `mw.pm.profileFolder()` for the manifest.
+
+    """
+
+    def __init__(self, field_updater, addon_name, model_name_substring=None,
+            fetch_workers=None):
+        """Initialiser.
+
+        Args:
+            field_updater (FieldUpdater): a strategy for updating fields.
+            addon_name (str): the name of the addon.
+            model_name_substring (str): if not None, only models that have
+                this string in their name will be modified.
+            fetch_workers (int | None): the number of threads to fetch
+                with, if the field updater is pipelined. 1 fetches
+                serially. If None, 'fetch workers' in the 'concurrency'
+                section of the config.
+
+        Raises:
+            TypeError: if the field updater is pipelined but doesn't
+                implement the pipeline methods.
+
+        """
+        check_pipelined(field_updater)
+        self._field_updater = field_updater
+        self._source_fields = frozenset(field_updater.sourceFields())
+        self._model_name_substring = model_name_substring
+        self._fetch_workers = fetch_workers
+        self.name = addon_name
+
+    def fetchWorkers(self):
+        """Returns the number of threads to fetch with."""
+        if self._fetch_workers is not None:
+            return self._fetch_workers
+        return store.fetch_workers()
+
+    def shouldModify(self, model):
+        """Tests whether a model should be modified.
+
+        Checks the name of the model, then delegates to the FieldUpdater.
+        The verdict is remembered until the model changes.
+
+        Args:
+            model (anki.models.Model): the model to check membership of.
+
+        Returns:
+            (bool) True iff the model should be modified.
+            
+        """
+        info = model_info(model)
+        verdict = info.eligible.get(self)
+        if verdict is None:
+            verdict = True
+            if self._model_name_substring != None:
+                verdict = self._model_name_substring in info.name
+            verdict = verdict and self._field_updater.shouldModify(model)
+            info.eligible[self] = verdict
+        return verdict
+
+    def _updater(self):
+        """Returns the field updater, instrumented if stats are on."""
+        return stats.instrument(self._field_updater, self.name)
+
+    def sourceHash(self, fields):
+        """Hashes everything a regeneration of a note depends on.
+
+        That is the updater's settings, the sanitised source fields and
+        which target fields are empty, so that clearing a target field
+        makes the note count as changed.
+
+        Args:
+            fields (Mapping[str, unicode]): the note's fields by name, e.g.
+                an anki.notes.Note.
+
+        Returns:
+            (str) a hex digest.
+
+        """
+        updater = self._field_updater
+        parts = [updater.settingsKey()]
+        for f in updater.sourceFields():
+            value = fields[f] if f in fields else u''
+            parts.append(sanitise(mw.col.media.strip(value)) if value else u'')
+        for f in updater.targetFields():
+            parts.append('1' if f in fields and fields[f] else '0')
+        return make_key(*parts)
+
+    def _manifest(self):
+        return Manifest(os.path.join(mw.pm.profileFolder(), MANIFEST_FILE))
+
+    def _noteFields(self, model):
+        """Reads the fields of the notes of `model` from the notes table.
+
+        Much cheaper than getNote, which also loads the note's tags and
+        model and builds a field map for each note.
+
+        Yields:
+            (Tuple[int, Dict[str, unicode]]) each note id with its fields by
+                name.
+
+        """
+        names = model_info(model).field_names
+        rows = mw.col.db.all('select id, flds from notes where mid = ?',
+                             model['id'])
+        for nid, flds in rows:
+            yield nid, dict(zip(names, splitFields(flds)))
+
+    def _candidates(self, models, changed_only):
+        """Picks the notes in `models` to regenerate.
+
+        Notes are skipped without being loaded if the updater says they
+        need no modification or, if `changed_only`, if their source hash is
+        the one recorded in the manifest.
+
+        Returns:
+            (Tuple[List[int], List[Tuple[int, str]]]) the notes to
+                regenerate, and (note id, source hash) for the notes that
+                need no modification.
+
+        """
+        known = {}
+        if changed_only:
+            manifest = self._manifest()
+            try:
+                known = manifest.hashes(self.name)
+            finally:
+                manifest.close()
+        updater = self._field_updater
+        nids, unmodified = [], []
+        for model in models:
+            for nid, fields in self._noteFields(model):
+                needed = updater.needsModification(fields)
+                if needed and not changed_only:
+                    nids.append(nid)
+                    continue
+                source_hash = self.sourceHash(fields)
+                if known.get(nid) == source_hash:
+                    continue
+                if needed:
+                    nids.append(nid)
+                else:
+                    unmodified.append((nid, source_hash))
+        return nids, unmodified
+
+    def candidates(self, changed_only):
+        """Picks the notes to regenerate from the eligible models.
+
+        See `_candidates`, which this calls with every model `shouldModify`
+        accepts.
+
+        """
+        models = [m for m in mw.col.models.all() if self.shouldModify(m)]
+        with stats.timed(self.name, 'candidates'):
+            return self._candidates(models, changed_only)
+
+    def regenerate(self, nids, unmodified=(), progress=None):
+        """Regenerates the notes `nids` and records their source hashes.
+
+        Modified notes are written in chunks of 'write chunk size' notes
+        (section 'regeneration' of the config), and the collection is saved
+        after each. Hashes are recorded as each chunk is saved, so an
+        interrupted run keeps both the notes and the hashes of the chunks
+        already written, and regenerating the changed notes afterwards
+        picks up where it stopped. Hashes are only recorded for notes that
+        were modified or need no modification, so notes whose fetch failed
+        are tried again next time.
+
+        Args:
+            nids (Sequence[int]): the notes to regenerate.
+            unmodified (Iterable[Tuple[int, str]]): (note id, source hash)
+                to record for notes that needed no regeneration.
+            progress (Callable[[int, int], None] | None): called after each
+                chunk with the number of notes done and the total.
+
+        Returns:
+            (int) the number of notes whose fields changed.
+
+        """
+        manifest = self._manifest()
+        done = [0]
+        try:
+            manifest.update(self.name, unmodified)
+
+            def on_commit(notes, settled):
+                manifest.update(self.name,
+                                [(n.id, self.sourceHash(n)) for n in settled])
+                done[0] += len(notes)
+                if progress is not None:
+                    progress(done[0], len(nids))
+
+            chunk_size = store.get_int('regeneration', 'write chunk size',
+                                       DEFAULT_CHUNK_SIZE, minimum=1)
+            with stats.timed(self.name, 'regenerate'), \
+                    NoteWriter(mw.col, chunk_size, on_commit) as writer:
+                if self._field_updater.pipelined and self.fetchWorkers() > 1:
+                    self._regeneratePipelined(nids, writer)
+                else:
+                    self._regenerateSerial(nids, writer)
+        finally:
+            manifest.close()
+        return writer.written
+
+    def _regenerateSerial(self, nids, writer):
+        regenerate_serial(mw.col, self._updater(), nids, writer)
+
+    def _regeneratePipelined(self, nids, writer):
+        regenerate_pipelined(mw.col, self._updater(), nids, writer,
+                             self.fetchWorkers())
+
+
+class Addon(Regenerator):
     """An addon that updates note fields based on the content of others."""
     _initialised = False
 
     def __init__(self, field_updater, addon_name, model_name_substring=None,
-            on_focus_lost=False):
+            on_focus_lost=False, fetch_workers=None, async_focus_lost=None,
+            focus_lost_delay=300):
         """Initialises the addon.
 
         Adds a hook to 'editFocusLost' and adds a (re)generate all button to
@@ -164,6 +545,16 @@ class Addon():
             model_name_substring (str): if not None, only models that have
                 this string in their name will be modifi
                 on_focus_lost (bool): if True, add a hook to editFocusLost.
+            fetch_workers (int | None): the number of threads to fetch with
+                during regenerateAll, if the field updater is pipelined. 1
+                fetches serially. If None, read from the config.
+            async_focus_lost (bool | None): if True and the field updater
+                is pipelined, fetch in the background on editFocusLost
+                instead of blocking the editor. If None, 'async focus
+                lost' in the 'editor' section of the config, off by
+                default.
+            focus_lost_delay (int): with async_focus_lost, milliseconds to
+                wait for further edits before fetching.
 
         """
         global button_action, menu_action
@@ -176,41 +567,46 @@ class Addon():
                              mw)
             mw.connect(action, SIGNAL("triggered()"), menu_action)
             mw.form.menuTools.addAction(action)
+            action = QAction("All field updater addons: timing statistics",
+                             mw)
+            mw.connect(action, SIGNAL("triggered()"), showStats)
+            mw.form.menuTools.addAction(action)
+            patchEditor()
 
         # state 
-        self._field_updater = field_updater
-        self._model_name_substring = model_name_substring
-        self.name = addon_name
+        Regenerator.__init__(self, field_updater, addon_name,
+                             model_name_substring, fetch_workers)
+        self._focus_lost_delay = focus_lost_delay
+
+        # async focus lost state
+        self._executor = None
+        self._generations = {}  # note id -> number of the latest edit
+        self._results = Queue.Queue()
+        self._pending = 0
+        self._poll_timer = None
+        self._editors = weakref.WeakSet()
 
         # add hook
         button_action.register_callback(self.buttonCallback, addon_name)
-        if on_focus_lost:
+        if async_focus_lost is None:
+            async_focus_lost = store.get_bool('editor', 'async focus lost',
+                                              False)
+        if on_focus_lost and async_focus_lost and field_updater.pipelined:
+            addHook('editFocusLost', self.onFocusLostAsync)
+            addHook('loadNote', self._onLoadNote)
+        elif on_focus_lost:
             addHook('editFocusLost', self.onFocusLost)
 
-        # add menu item
+        # add menu items
         menu_action.register_callback(self.regenerateAll, addon_name)
         menu_item = "{} addon: regenerate all fields".format(addon_name)
         action = QAction(menu_item, mw)
         mw.connect(action, SIGNAL("triggered()"), self.regenerateAll)
         mw.form.menuTools.addAction(action)
-
-    def shouldModify(self, model):
-        """Tests whether a model should be modified.
-
-        Checks the name of the model, then delegates to the FieldUpdater.
-
-        Args:
-            model (anki.models.Model): the model to check membership of.
-
-        Returns:
-            (bool) True iff the model should be modified.
-            
-        """
-        name_check = True
-        if self._model_name_substring != None:
-            model_name = model['name'].lower()
-            name_check = self._model_name_substring in model_name
-        return name_check and self._field_updater.shouldModify(model)
+        menu_item = "{} addon: regenerate changed fields".format(addon_name)
+        action = QAction(menu_item, mw)
+        mw.connect(action, SIGNAL("triggered()"), self.regenerateChanged)
+        mw.form.menuTools.addAction(action)
 
     def modifyFields(self, note):
         """Modifies the fields of `note`.
@@ -223,13 +619,14 @@ class Addon():
 
         """
         if self.shouldModify(note.model()):
-            return self._field_updater.modifyFields(note)
+            return self._updater().modifyFields(note)
         else:
             return False
 
     def buttonCallback(self, note):
         result = self.modifyFields(note)
-        note.flush()
+        with stats.timed(self.name, 'flush'):
+            note.flush()
         return result
 
     def onFocusLost(self, flag, note, current_field_index):
@@ -248,12 +645,100 @@ class Addon():
             (bool) True if the note was modified, else `flag`.
 
         """
-        if current_field_index != None and self.shouldModify(note.model()):
-            field_name = note.model()['flds'][current_field_index]['name']
-            if field_name not in self._field_updater.sourceFields():
-                return flag
-            else:
-                return flag or self.modifyFields(note)
+        if self._isSourceField(note, current_field_index):
+            return flag or self.modifyFields(note)
+        return flag
+
+    def _isSourceField(self, note, field_index):
+        model = note.model()
+        if field_index is None or not self.shouldModify(model):
+            return False
+        field_name = model_info(model).field_names[field_index]
+        return field_name in self._source_fields
+
+    def onFocusLostAsync(self, flag, note, current_field_index):
+        """Hook for 'editFocusLost' that fetches in the background.
+
+        The fetch is dispatched once the field has been left alone for
+        `focus_lost_delay` milliseconds, so quickly editing a field several
+        times costs one fetch. When the result arrives the note is updated,
+        saved if it is already in the collection, and reloaded in its
+        editor. Results for an older value of the field are discarded.
+
+        Args:
+            as for onFocusLost.
+
+        Returns:
+            (bool) `flag`, since the note is only modified later.
+
+        """
+        if self._isSourceField(note, current_field_index):
+            generation = self._generations.get(note.id, 0) + 1
+            self._generations[note.id] = generation
+            mw.progress.timer(self._focus_lost_delay,
+                              partial(self._dispatch, note, generation), False)
+        return flag
+
+    def _onLoadNote(self, editor):
+        self._editors.add(editor)
+
+    def _dispatch(self, note, generation):
+        if self._generations.get(note.id) != generation:
+            return  # edited again since; a later timer will dispatch
+        updater = self._updater()
+        query = updater.queryFor(note)
+        if query is None:
+            del self._generations[note.id]
+            return
+        if self._executor is None:
+            self._executor = Executor(self.fetchWorkers())
+        future = self._executor.submit(updater.fetch, query)
+        self._pending += 1
+        future.add_done_callback(lambda f: self._results.put(
+                (note, generation, query, f)))
+        if self._poll_timer is None:
+            self._poll_timer = mw.progress.timer(50, self._drainResults, True)
+
+    def _drainResults(self):
+        """Applies the results of finished background fetches.
+
+        Runs on the main thread, polled by a timer while fetches are
+        pending. A failed fetch is reported, and the others still applied.
+
+        """
+        try:
+            while True:
+                try:
+                    note, generation, query, future = self._results.get_nowait()
+                except Queue.Empty:
+                    return
+                self._pending -= 1
+                if self._generations.get(note.id) != generation:
+                    continue
+                del self._generations[note.id]
+                try:
+                    result = future.result()
+                except Exception as e:
+                    showInfo(u'{} failed to update a note for {}: {}'
+                             .format(self.name, query, e))
+                    continue
+                if self._field_updater.queryFor(note) != query:
+                    continue  # the field changed without losing focus
+                self._applyAsyncResult(note, query, result)
+        finally:
+            if self._pending == 0 and self._poll_timer is not None:
+                self._poll_timer.stop()
+                self._poll_timer = None
+
+    def _applyAsyncResult(self, note, query, result):
+        if not self._updater().applyFetched(note, query, result):
+            return
+        if mw.col.db.scalar('select 1 from notes where id = ?', note.id):
+            with stats.timed(self.name, 'flush'):
+                note.flush()
+        for editor in list(self._editors):
+            if editor.note is note:
+                editor.loadNote()
 
     def regenerateAll(self):
         """Applies the modification to each valid card in the database."""
@@ -261,19 +746,121 @@ class Addon():
                         'This may take some time and will overwrite the '
                         'destination fields.').format(self.name)):
             return
-        models = [m for m in mw.col.models.all() if self.shouldModify(m)]
-        # Find the notes in those models and give them kanji
-        counter = 0
-        for model in models:
-            for nid in mw.col.models.nids(model):
-                note = mw.col.getNote(nid)
-                self._field_updater.modifyFields(note)
-                note.flush()
-                counter += 1
-        if counter > 0:
+        self._regenerate(*self.candidates(changed_only=False))
+
+    def regenerateChanged(self):
+        """Applies the modification to the notes that changed since the last
+        regeneration.
+
+        A note counts as changed if its source fields or the updater's
+        settings differ from when it was last regenerated, if a target
+        field has been emptied, or if it has never been regenerated.
+
+        """
+        if not askUser(('Do you want {} to regenerate the fields of notes '
+                        'that changed since they were last regenerated?')
+                       .format(self.name)):
+            return
+        self._regenerate(*self.candidates(changed_only=True))
+
+    def _regenerate(self, nids, unmodified=()):
+        """Regenerates `nids`, then refreshes the GUI and reports."""
+        if self.regenerate(nids, unmodified):
             mw.reset()
         showInfo("{} regenerated fields for {} cards."
-                 .format(self.name, counter))
+                 .format(self.name, len(nids)))
+
+
+def regenerate_serial(col, updater, nids, writer):
+    """Regenerates `nids` one at a time.
+
+    Args:
+        col (anki.collection._Collection): the collection the notes are in.
+        updater (FieldUpdater): the updater to apply.
+        nids (Iterable[int]): the notes to regenerate.
+        writer (NoteWriter): every note visited is added to this, settled
+            if it was modified or needs no modification.
+
+    """
+    for nid in nids:
+        note = col.getNote(nid)
+        modified = updater.modifyFields(note)
+        writer.add(note, settled(updater, note, modified))
+
+def regenerate_pipelined(col, updater, nids, writer, workers):
+    """Regenerates with fetches running on a pool of worker threads.
+
+    Notes are loaded, modified and written on the calling thread; only
+    `FieldUpdater.fetch` runs on the workers. Each distinct query is
+    fetched once: notes whose query is already being fetched wait for
+    that fetch, and notes whose query has been fetched reuse its result.
+
+    Args:
+        as for `regenerate_serial`, and
+        workers (int): the number of threads to fetch with.
+
+    """
+    fetched = {}  # query key -> result
+    waiting = {}  # query key -> [(note, query)] behind an active fetch
+
+    def apply(note, query, result):
+        modified = updater.applyFetched(note, query, result)
+        writer.add(note, settled(updater, note, modified))
+
+    def jobs():
+        for nid in nids:
+            note = col.getNote(nid)
+            query = updater.queryFor(note)
+            if query is None:
+                writer.add(note, settled(updater, note, False))
+                continue
+            key = query_key(query)
+            if key in fetched:
+                apply(note, query, fetched[key])
+            elif key in waiting:
+                waiting[key].append((note, query))
+            else:
+                waiting[key] = []
+                yield note, query
+
+    def fetch(job):
+        return updater.fetch(job[1])
+
+    for job, result in imap_unordered(fetch, jobs(), workers):
+        note, query = job
+        key = query_key(query)
+        fetched[key] = result
+        apply(note, query, result)
+        for other_note, other_query in waiting.pop(key):
+            apply(other_note, other_query, result)
+
+def settled(updater, note, modified):
+    """Tests whether `note` is done with: it was modified, or the updater
+    says it needs no modification. Otherwise, e.g. if a fetch failed, it
+    should be regenerated again next time."""
+    if modified:
+        return True
+    fields = dict((name, note[name]) for name in updater.requiredFields()
+                  if name in note)
+    return not updater.needsModification(fields)
+
+def query_key(query):
+    """Normalises a query for deduplication: runs of whitespace in text
+    queries are collapsed."""
+    if isinstance(query, basestring):
+        return u' '.join(query.split())
+    return query
+
+
+def showStats():
+    """Shows the timing statistics, and saves them as JSON to STATS_FILE in
+    the profile folder."""
+    text = stats.report()
+    if stats.enabled():
+        path = os.path.join(mw.pm.profileFolder(), STATS_FILE)
+        stats.dump(path)
+        text += u'\n\nSaved to {}'.format(path)
+    showText(text)
 
 
 class NamedCallbackCollector(object):
@@ -292,7 +879,6 @@ class NamedCallbackCollector(object):
 
 # set up editor button
 button_action = NamedCallbackCollector()
-@wraps(Editor.setupButtons)
 def setupButtons(self):
     """Monkey-patch the button-setter-upper to add a button."""
     def callback():
@@ -321,5 +907,9 @@ def setupButtons(self):
         fullpath = os.path.join(os.path.dirname(__file__), iconpath)
         b.setIcon(QIcon(fullpath))
 
-Editor.setupButtons = wrap(Editor.setupButtons, setupButtons)
+def patchEditor():
+    """Adds the field updater buttons to the editor. Called by the first
+    Addon, so that importing this module doesn't need the GUI."""
+    Editor.setupButtons = wrap(Editor.setupButtons,
+                               wraps(Editor.setupButtons)(setupButtons))
 
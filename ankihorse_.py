@@ -6,43 +6,60 @@ Ankihorse
 
 Adds pictures and vocalisation to japanese cards.
 
+The addons are declared in ADDONS, as a module and the keyword arguments
+for its `initialise`. Anki sets them up when it loads this file; the
+headless runner (`python -m ankihorse.headless`) reads the same list.
+
 """
+try:
+    from aqt import mw
+except ImportError:
+    mw = None  # loaded by the headless runner, without the GUI
+
 from ankihorse import autopicture
 from ankihorse import autovoice
 from ankihorse import japanese_examples
 
 
-autopicture.initialise\
-        ( name='Japanese Autopicture'
-        , source_fields=['Expression', 'Kanji', 'Kana']
-        , target_field='Picture'
-        , locale='ja-JP'
-        , model_name_substring='japanese'
-        ) 
-
-autovoice.initialise\
-        ( name='Japanese Autovoice'
-        , language='japanese'
-        , source_fields=['Pronunciation', 'Expression', 'Kanji', 'Kana']
-        , target_field='Voice'
-        , model_name_substring='japanese'
-        , on_focus_lost=True
-        ) 
-
-japanese_examples.initialise\
-        ( name='Japanese Example Sentences'
-        , source_fields=['Expression']
-        , target_fields=['Sentence', 'Sentence-English', 'Sentence-Clozed']
-        , weighted=True
-        , model_name_substring='japanese'
-        , on_focus_lost=True
-        )
+ADDONS = \
+    [ ( autopicture
+      , dict( name='Japanese Autopicture'
+            , source_fields=['Expression', 'Kanji', 'Kana']
+            , target_field='Picture'
+            , locale='ja-JP'
+            , model_name_substring='japanese'
+            )
+      )
+    , ( autovoice
+      , dict( name='Japanese Autovoice'
+            , language='japanese'
+            , source_fields=['Pronunciation', 'Expression', 'Kanji', 'Kana']
+            , target_field='Voice'
+            , model_name_substring='japanese'
+            , on_focus_lost=True
+            )
+      )
+    , ( japanese_examples
+      , dict( name='Japanese Example Sentences'
+            , source_fields=['Expression']
+            , target_fields=['Sentence', 'Sentence-English', 'Sentence-Clozed']
+            , weighted=True
+            , model_name_substring='japanese'
+            , on_focus_lost=True
+            )
+      )
+    , ( autovoice
+      , dict( name='Japanese Autovoice (Sentences)'
+            , language='japanese'
+            , source_fields=['Sentence']
+            , target_field='Sentence-Voice'
+            , model_name_substring='japanese'
+            , on_focus_lost=True
+            )
+      )
+    ]
 
-autovoice.initialise\
-        ( name='Japanese Autovoice (Sentences)'
-        , language='japanese'
-        , source_fields=['Sentence']
-        , target_field='Sentence-Voice'
-        , model_name_substring='japanese'
-        , on_focus_lost=True
-        ) 
+# mw is only set when Anki's GUI is running
+if mw is not None:
+    for module, options in ADDONS:
+        module.initialise(**options)
@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+"""
+collection
+==========
+
+Builds throwaway Anki collections of synthetic Japanese vocabulary notes.
+
+"""
+import random
+
+from anki.storage import Collection
+
+MODEL_NAME = u'japanese (benchmark)'
+FIELDS = (u'Expression', u'Kana', u'Meaning', u'Picture', u'Voice')
+KANA = (u'あいうえおかきくけこさしすせそたちつてとなにぬねのはひふへほ'
+        u'まみむめもやゆよらりるれろわをん')
+
+
+def words(count, distinct=1.0, seed=0):
+    """Returns `count` made-up words, of which about `distinct` are unique.
+
+    Repeats let the benchmark exercise deduplication of queries.
+
+    """
+    rng = random.Random(seed)
+    vocabulary = max(1, int(count * distinct))
+    pool = []
+    seen = set()
+    while len(pool) < vocabulary:
+        word = u''.join(rng.choice(KANA) for _ in range(rng.randint(2, 5)))
+        if word not in seen:
+            seen.add(word)
+            pool.append(word)
+    return [pool[i] if i < vocabulary else rng.choice(pool)
+            for i in range(count)]
+
+
+def synthetic_collection(path, notes, distinct=1.0, seed=0):
+    """Creates a collection at `path` with `notes` vocabulary notes.
+
+    Each note has its Expression and Kana filled and its Picture and Voice
+    empty, as a freshly imported deck would.
+
+    Args:
+        path (str): where to create the collection; must end in '.anki2'.
+        notes (int): the number of notes.
+        distinct (float): the fraction of notes with a unique expression.
+        seed (int): seeds the words.
+
+    Returns:
+        (anki.collection._Collection) the open collection.
+
+    """
+    col = Collection(path)
+    models = col.models
+    model = models.new(MODEL_NAME)
+    for name in FIELDS:
+        models.addField(model, models.newField(name))
+    template = models.newTemplate(u'Recognition')
+    template['qfmt'] = u'{{Expression}}'
+    template['afmt'] = u'{{FrontSide}}<hr id=answer>{{Kana}} {{Voice}}'
+    models.addTemplate(model, template)
+    models.add(model)
+    models.setCurrent(model)
+
+    for word in words(notes, distinct, seed):
+        note = col.newNote()
+        note[u'Expression'] = word
+        note[u'Kana'] = word
+        col.addNote(note)
+    col.save()
+    return col
@@ -0,0 +1,264 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+"""
+run
+===
+
+End-to-end throughput benchmark for the field updaters.
+
+Builds a synthetic collection, points the providers at a local stand-in
+server, runs each updater over every note and reports notes per second,
+per-note latency and the traffic it caused. Needs Anki's `anki` and `aqt`
+packages on the path, e.g. run from an Anki source checkout:
+
+    PYTHONPATH=/path/to/anki python -m benchmarks.run --notes 500
+
+The serial mode is what the editor's focus-lost hook and non-pipelined
+updaters cost per note; the pipelined mode is what regenerating all
+fields does with a pool of fetch workers.
+
+"""
+from __future__ import print_function
+import argparse
+import json
+import math
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from ankihorse import (autopicture, autovoice, config, httpclient, ratelimit,
+                       stats, updateraddon)
+from ankihorse.cache import DiskCache, MetadataCache
+from ankihorse.notewriter import NoteWriter
+from ankihorse.updateraddon import regenerate_pipelined, regenerate_serial
+
+from .collection import synthetic_collection
+from .standin import StandIn, redirect
+
+# name -> (FieldUpdater class, initialiser arguments)
+UPDATERS = { 'bing-tts': ( autovoice.BingTTSFieldUpdater
+                         , ([u'Expression', u'Kana'], u'Voice', 'japanese')
+                         )
+           , 'voicerss': ( autovoice.VoiceRSSFieldUpdater
+                         , ([u'Expression', u'Kana'], u'Voice', 'japanese')
+                         )
+           , 'bing-image': ( autopicture.BingImageFieldUpdater
+                           , ([u'Expression'], u'Picture', 'ja-JP')
+                           )
+           , 'google-image': ( autopicture.GoogleImageFieldUpdater
+                             , ([u'Expression'], u'Picture')
+                             )
+           }
+MODES = ('serial', 'pipelined')
+
+
+class MainWindow(object):
+    """Just enough of aqt.mw for the updaters: the collection."""
+
+    def __init__(self, col):
+        self.col = col
+
+
+class Timed(object):
+    """Wraps a FieldUpdater, recording how long each note took.
+
+    For serial runs that is the time spent in modifyFields; for pipelined
+    runs, the time from queryFor to applyFetched, which includes waiting
+    for a worker.
+
+    """
+
+    def __init__(self, updater, clock=time.time):
+        self._updater = updater
+        self._clock = clock
+        self._started = {}
+        self.latencies = []
+
+    def __getattr__(self, name):
+        return getattr(self._updater, name)
+
+    def modifyFields(self, note):
+        start = self._clock()
+        try:
+            return self._updater.modifyFields(note)
+        finally:
+            self.latencies.append(self._clock() - start)
+
+    def queryFor(self, note):
+        self._started[note.id] = self._clock()
+        return self._updater.queryFor(note)
+
+    def applyFetched(self, note, query, result):
+        try:
+            return self._updater.applyFetched(note, query, result)
+        finally:
+            start = self._started.pop(note.id)
+            self.latencies.append(self._clock() - start)
+
+
+def percentile(values, fraction):
+    """Returns the nearest-rank percentile of `values`, or None if empty."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = int(math.ceil(fraction * len(ordered))) - 1
+    return ordered[min(max(index, 0), len(ordered) - 1)]
+
+
+def install(col, directory, rate_limits):
+    """Points the providers at `col` and at throwaway caches and config.
+
+    Args:
+        col (anki.collection._Collection): the benchmark collection.
+        directory (str): a scratch directory for caches and config.
+        rate_limits (bool): if False, lift the providers' rate limits, so
+            that the client rather than the limiter is measured.
+
+    """
+    window = MainWindow(col)
+    for module in (updateraddon, autovoice, autopicture):
+        module.mw = window
+    for module in (autovoice, autopicture):
+        module.showInfo = lambda text: print(text, file=sys.stderr)
+
+    config_file = os.path.join(directory, 'config.json')
+    keys = { 'bing speech api key': 'stand-in'
+           , 'bing search api key': 'stand-in'
+           }
+    with open(config_file, 'w') as f:
+        json.dump({ 'cognitive services': keys
+                  , 'stats': {'enabled': stats.enabled()}
+                  }, f)
+    config.store.reload(config_file)
+
+    cache = os.path.join(directory, 'cache')
+    autovoice._tts_cache = DiskCache(os.path.join(cache, 'tts'), 1 << 30)
+    autopicture._image_cache = DiskCache(os.path.join(cache, 'images'),
+                                         1 << 30)
+    autopicture._search_cache = MetadataCache(
+            os.path.join(cache, 'search.sqlite'), 1 << 20, 86400.0)
+
+    ratelimit._limiters.clear()
+    if not rate_limits:
+        for provider in ratelimit.DEFAULT_LIMITS:
+            ratelimit._limiters[provider] = ratelimit.RateLimiter(provider,
+                                                                  1e6)
+
+
+def run_case(name, mode, args, server):
+    """Runs updater `name` over a fresh collection and returns the figures."""
+    directory = tempfile.mkdtemp(prefix='ankihorse-bench-')
+    try:
+        col = synthetic_collection(os.path.join(directory, 'bench.anki2'),
+                                   args.notes, args.distinct, args.seed)
+        try:
+            install(col, directory, args.rate_limits)
+            cls, init_args = UPDATERS[name]
+            updater = Timed(cls(*init_args))
+            nids = col.db.list('select id from notes')
+            before = server.counters()
+            start = time.time()
+            with NoteWriter(col) as writer:
+                if mode == 'pipelined':
+                    regenerate_pipelined(col, updater, nids, writer,
+                                         args.workers)
+                else:
+                    regenerate_serial(col, updater, nids, writer)
+            elapsed = time.time() - start
+            after = server.counters()
+        finally:
+            col.close()
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+    latencies = updater.latencies
+    return { 'updater': name
+           , 'mode': mode
+           , 'notes': len(nids)
+           , 'written': writer.written
+           , 'seconds': elapsed
+           , 'notes_per_second': len(nids) / elapsed if elapsed else None
+           , 'p50_ms': _ms(percentile(latencies, 0.5))
+           , 'p99_ms': _ms(percentile(latencies, 0.99))
+           , 'requests': after['requests'] - before['requests']
+           , 'bytes': (after['bytes_sent'] - before['bytes_sent']
+                       + after['bytes_received'] - before['bytes_received'])
+           }
+
+def _ms(seconds):
+    return None if seconds is None else seconds * 1000
+
+
+def report(results, out=sys.stdout):
+    header = ('updater', 'mode', 'notes', 'notes/s', 'p50 ms', 'p99 ms',
+              'requests', 'MB')
+    rows = [header]
+    for r in results:
+        rows.append(( r['updater'], r['mode'], str(r['notes'])
+                    , _format(r['notes_per_second']), _format(r['p50_ms'])
+                    , _format(r['p99_ms']), str(r['requests'])
+                    , '{:.2f}'.format(r['bytes'] / 1e6)
+                    ))
+    widths = [max(len(row[i]) for row in rows) for i in range(len(header))]
+    for row in rows:
+        print('  '.join(cell.ljust(w) for cell, w in zip(row, widths)),
+              file=out)
+
+def _format(value):
+    return '-' if value is None else '{:.1f}'.format(value)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1],
+                                     prog='python -m benchmarks.run')
+    parser.add_argument('--notes', type=int, default=200)
+    parser.add_argument('--distinct', type=float, default=1.0,
+                        help='fraction of notes with a unique expression')
+    parser.add_argument('--latency', type=float, default=0.05,
+                        help='seconds the stand-in waits per request')
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help='fraction of requests answered with a 503')
+    parser.add_argument('--payload-kb', type=float, default=20,
+                        help='size of each audio file and image')
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--updaters', default=','.join(sorted(UPDATERS)))
+    parser.add_argument('--modes', default=','.join(MODES))
+    parser.add_argument('--rate-limits', action='store_true',
+                        help='keep the configured provider rate limits')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--stats', action='store_true',
+                        help='also report time spent per provider stage')
+    parser.add_argument('--json', metavar='PATH',
+                        help='also write the results to PATH as JSON')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    stats.set_enabled(args.stats)
+    server = StandIn(args.latency, args.error_rate,
+                     int(args.payload_kb * 1024), args.seed).start()
+    restore = redirect(httpclient.default_client, server.url)
+    results = []
+    try:
+        for name in args.updaters.split(','):
+            for mode in args.modes.split(','):
+                if mode == 'pipelined' and not UPDATERS[name][0].pipelined:
+                    continue  # it would run serially anyway
+                results.append(run_case(name, mode, args, server))
+    finally:
+        restore()
+        server.stop()
+    report(results)
+    if args.stats:
+        print()
+        print(stats.report())
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,206 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+"""
+standin
+=======
+
+A local HTTP server that stands in for the providers during benchmarks.
+
+It answers the Bing Speech (issueToken, synthesize), Bing Image Search,
+Google Custom Search, VoiceRSS and ipify endpoints, and serves the images
+their search results point to, with a configurable delay, error rate and
+payload size. `redirect` points the shared HTTP client at it, so the
+providers run their real request code unchanged.
+
+"""
+import hashlib
+import json
+import random
+import threading
+import time
+import urlparse
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+
+IMAGE_HOST = 'images.stand-in'
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self.handle_request('GET')
+
+    def do_POST(self):
+        self.handle_request('POST')
+
+    def handle_request(self, method):
+        server = self.server
+        length = int(self.headers.getheader('content-length') or 0)
+        if length:
+            self.rfile.read(length)
+        server.count(received=length + len(self.requestline))
+
+        # paths arrive as /<original host>/<original path>
+        parts = urlparse.urlsplit(self.path)
+        host, _, path = parts.path.lstrip('/').partition('/')
+        path = '/' + path
+        query = dict(urlparse.parse_qsl(parts.query))
+
+        if server.latency:
+            time.sleep(server.latency)
+        if server.fails():
+            self.reply(503, 'Stand-in failure.', 'text/plain',
+                       {'Retry-After': '0'})
+            return
+
+        route = server.routes.get((method, host, path))
+        if route is None and host == IMAGE_HOST and method == 'GET':
+            route = StandIn.image
+        if route is None:
+            self.reply(404, 'No stand-in for {} {}{}.'
+                            .format(method, host, path), 'text/plain')
+            return
+        status, body, content_type = route(server, query)
+        self.reply(status, body, content_type)
+
+    def reply(self, status, body, content_type, headers={}):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+        self.server.count(sent=len(body), requests=1)
+
+
+class StandIn(ThreadingMixIn, HTTPServer):
+    """The stand-in server. Runs on a background thread once started.
+
+    Attributes:
+        requests (int): the number of responses sent.
+        bytes_sent (int): response body bytes sent.
+        bytes_received (int): request line and body bytes received.
+
+    """
+    daemon_threads = True
+
+    def __init__(self, latency=0.05, error_rate=0.0, payload_bytes=20000,
+            seed=0):
+        """Initialiser.
+
+        Args:
+            latency (float): seconds to wait before answering each request.
+            error_rate (float): the fraction of requests to answer with a
+                503, which the providers retry.
+            payload_bytes (int): the size of each audio file and image.
+            seed (int): seeds the choice of requests that fail.
+
+        """
+        HTTPServer.__init__(self, ('127.0.0.1', 0), Handler)
+        self.latency = latency
+        self.error_rate = error_rate
+        self.payload = 'ID3' + 'x' * max(0, payload_bytes - 3)
+        self.routes = { ('POST', 'api.cognitive.microsoft.com',
+                         '/sts/v1.0/issueToken'): StandIn.token
+                      , ('POST', 'speech.platform.bing.com', '/synthesize'):
+                        StandIn.speech
+                      , ('GET', 'api.cognitive.microsoft.com',
+                         '/bing/v5.0/images/search'): StandIn.bing_search
+                      , ('GET', 'www.googleapis.com', '/customsearch/v1'):
+                        StandIn.google_search
+                      , ('GET', 'api.voicerss.org', '/'): StandIn.speech
+                      , ('GET', 'api.ipify.org', '/'): StandIn.client_ip
+                      }
+        self.requests = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def url(self):
+        return 'http://{}:{}'.format(*self.server_address)
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def fails(self):
+        with self._lock:
+            return self._random.random() < self.error_rate
+
+    def count(self, sent=0, received=0, requests=0):
+        with self._lock:
+            self.bytes_sent += sent
+            self.bytes_received += received
+            self.requests += requests
+
+    def counters(self):
+        """Returns a copy of the request and byte counters."""
+        with self._lock:
+            return { 'requests': self.requests
+                   , 'bytes_sent': self.bytes_sent
+                   , 'bytes_received': self.bytes_received
+                   }
+
+    def token(self, query):
+        return 200, 'stand-in-token', 'text/plain'
+
+    def speech(self, query):
+        return 200, self.payload, 'audio/mpeg'
+
+    def client_ip(self, query):
+        return 200, '127.0.0.1', 'text/plain'
+
+    def image(self, query):
+        return 200, self.payload, 'image/jpeg'
+
+    def image_url(self, text):
+        name = hashlib.sha1(text).hexdigest()
+        return 'http://{}/{}.jpeg'.format(IMAGE_HOST, name)
+
+    def bing_search(self, query):
+        result = { 'contentUrl': self.image_url(query.get('q', ''))
+                 , 'encodingFormat': 'jpeg'
+                 , 'contentSize': '{} B'.format(len(self.payload))
+                 }
+        return 200, json.dumps({'value': [result]}), 'application/json'
+
+    def google_search(self, query):
+        result = {'link': self.image_url(query.get('q', ''))}
+        return 200, json.dumps({'items': [result]}), 'application/json'
+
+
+def redirect(client, base_url):
+    """Sends every request `client` makes to the stand-in at `base_url`.
+
+    The original host becomes the first path segment, which is how the
+    stand-in tells the providers apart.
+
+    Returns:
+        (Callable[[], None]) undoes the redirection.
+
+    """
+    original = client._request
+
+    def _request(method, url, data, headers, timeout):
+        parts = urlparse.urlsplit(url)
+        local = '{}/{}{}'.format(base_url, parts.netloc, parts.path or '/')
+        if parts.query:
+            local += '?' + parts.query
+        return original(method, local, data, headers, timeout)
+
+    client._request = _request
+    return lambda: setattr(client, '_request', original)
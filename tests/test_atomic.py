@@ -0,0 +1,44 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+"""Unit tests for atomic.py"""
+import pytest
+
+from ankihorse.atomic import write_atomically
+
+
+def writer(content):
+    def write(path):
+        with open(path, 'wb') as f:
+            f.write(content)
+    return write
+
+def test_write(tmpdir):
+    path = tmpdir.join('horse.txt')
+    write_atomically(str(path), writer('neigh'))
+    assert tmpdir.listdir() == [path]
+    assert path.read() == 'neigh'
+
+def test_write_replaces(tmpdir):
+    path = tmpdir.join('horse.txt')
+    path.write('neigh')
+    write_atomically(str(path), writer('whinny'))
+    assert tmpdir.listdir() == [path]
+    assert path.read() == 'whinny'
+
+def test_write_keeps_existing(tmpdir):
+    path = tmpdir.join('horse.txt')
+    path.write('neigh')
+    write_atomically(str(path), writer('whinny'), replace=False)
+    assert tmpdir.listdir() == [path]
+    assert path.read() == 'neigh'
+
+def test_write_failure(tmpdir):
+    path = tmpdir.join('horse.txt')
+    path.write('neigh')
+    def write(temp_path):
+        writer('whin')(temp_path)
+        raise IOError
+    with pytest.raises(IOError):
+        write_atomically(str(path), write)
+    assert tmpdir.listdir() == [path]
+    assert path.read() == 'neigh'
@@ -4,13 +4,17 @@
 import os
 import random
 import string
-import urllib
+
+import urllib2
 
 import pytest
 import mock
 
 from ankihorse import autopicture
-from ankihorse.autopicture import GoogleImageFieldUpdater
+from ankihorse.autopicture import (BingImageFieldUpdater,
+                                   GoogleImageFieldUpdater)
+from ankihorse.cache import MetadataCache
+from ankihorse.config import Config
 
 
 @pytest.fixture
@@ -21,6 +25,12 @@ def patches(monkeypatch):
         monkeypatch.setattr(autopicture, name, patches[name])
     return patches
 
+@pytest.fixture
+def media_dir(patches, tmpdir):
+    media_dir = tmpdir.mkdir('media')
+    patches['mw'].col.media.dir.return_value = str(media_dir)
+    return media_dir
+
 @pytest.fixture
 def source_field(): return randomstring(9)
 
@@ -31,7 +41,7 @@ def target_field(): return randomstring(9)
 def filename(): return randomstring(10)
 
 @pytest.fixture
-def patched_field_updater(monkeypatch, patches, tmpdir, filename,
+def patched_field_updater(monkeypatch, patches, media_dir, tmpdir, filename,
         source_field, target_field):
     field_updater = GoogleImageFieldUpdater([source_field], [target_field])
     for name in ('downloadImageFromURL', 'firstImageFromGoogle'):
@@ -81,18 +91,19 @@ def test_modified_correctly(patched_field_updater, note,
     image_tag = u'<img src="{}" />'.format(filename)
     assert note.__setitem__.called_once_with(target_field, image_tag)
 
-def test_add_to_media_database(patches, patched_field_updater, note):
+def test_add_to_media_folder(patched_field_updater, note, media_dir,
+        filename):
     assert patched_field_updater.modifyFields(note)
-    assert patches['mw'].col.media.addFile.called
+    assert media_dir.join(filename).check()
 
-def test_temp_file_removed(patched_field_updater, tmpdir, filename, note):
+def test_cached_file_kept(patched_field_updater, tmpdir, filename, note):
     patched_field_updater.modifyFields(note)
-    assert not tmpdir.join(filename).check()
+    assert tmpdir.join(filename).check()
 
 def test_download(monkeypatch, tmpdir):
-    mock_retrieve = mock.MagicMock()
-    monkeypatch.setattr(urllib, 'urlretrieve', mock_retrieve)
-    monkeypatch.setattr(GoogleImageFieldUpdater, 'DIRECTORY', str(tmpdir))
+    mock_download = mock.MagicMock()
+    mock_download.return_value = str(tmpdir.join('cached.jpg'))
+    monkeypatch.setattr(autopicture, 'cached_download', mock_download)
 
     website = 'http://' + randomstring(10) + '.com/'
     remote_image = randomstring(10) + '.jpg'
@@ -100,4 +111,46 @@ def test_download(monkeypatch, tmpdir):
     
     filename = GoogleImageFieldUpdater.downloadImageFromURL(url)
     
-    assert filename == str(tmpdir.join(remote_image))
+    mock_download.assert_called_once_with(url, '.jpg')
+    assert filename == str(tmpdir.join('cached.jpg'))
+
+
+@pytest.fixture
+def bing(monkeypatch, tmpdir):
+    store = Config(str(tmpdir.join('config.json')))
+    store.set_api_key('bing search', 'key')
+    monkeypatch.setattr(autopicture, 'store', store)
+    monkeypatch.setattr(autopicture, '_search_cache', MetadataCache(
+            str(tmpdir.join('search.sqlite')), 10, 60))
+    search = mock.MagicMock(return_value=[])
+    monkeypatch.setattr(autopicture, 'bing_image_search', search)
+    monkeypatch.setattr(autopicture, 'first_acceptable_image', lambda r, m:
+            {'contentUrl': 'http://horse.jp/a.jpg', 'encodingFormat': 'jpeg'})
+    return BingImageFieldUpdater(['src'], 'tgt', 'ja-JP')
+
+@pytest.mark.parametrize('code', [403, 404, 410])
+def test_bing_gone_image(monkeypatch, bing, code):
+    error = urllib2.HTTPError('http://horse.jp/a.jpg', code, 'Gone', None,
+                              None)
+    download = mock.MagicMock(side_effect=error)
+    monkeypatch.setattr(autopicture, 'cached_download', download)
+    assert bing.fetch(u'horse') is None
+    assert bing.fetch(u'horse') is None
+    assert autopicture.bing_image_search.call_count == 2
+
+def test_bing_server_error_raises(monkeypatch, bing):
+    error = urllib2.HTTPError('http://horse.jp/a.jpg', 503, 'Busy', None,
+                              None)
+    monkeypatch.setattr(autopicture, 'cached_download',
+                        mock.MagicMock(side_effect=error))
+    with pytest.raises(urllib2.HTTPError):
+        bing.fetch(u'horse')
+    bing_key = autopicture.make_key('bing', 'ja-JP', 'horse')
+    assert autopicture.search_cache().get(bing_key) is not None
+
+def test_bing_unacceptable_image(monkeypatch, bing):
+    download = mock.MagicMock(side_effect=autopicture.DownloadError('big'))
+    monkeypatch.setattr(autopicture, 'cached_download', download)
+    assert bing.fetch(u'horse') is None
+    assert bing.fetch(u'horse') is None
+    assert autopicture.bing_image_search.call_count == 2
@@ -6,7 +6,10 @@ import mock
 
 import os
 import random
+import shutil
 import string
+import tempfile
+import urllib2
 
 from ankihorse import autovoice
 from ankihorse.autovoice import VoiceRSSFieldUpdater
@@ -74,14 +77,20 @@ class modifyFieldsTestCase(unittest.TestCase):
         ## create test object and patch methods
         self.g = VoiceRSSFieldUpdater(randomstring(9), randomstring(9),
                                       'english')
-        self.g.downloadFromURL = mock.MagicMock()
+        def download(url, filepath):
+            with open(filepath, 'wb') as f:
+                f.write('x' * 1024)
+        self.g.downloadFromURL = mock.MagicMock(side_effect=download)
         self.g.build_url = mock.MagicMock()
         self.note = mock.MagicMock()
+        self.note.__contains__.return_value = True
+        self.media_dir = tempfile.mkdtemp()
 
     def tearDown(self):
         ## delete temp file if it's still there
         if os.path.isfile(self.temp_path):
             os.remove(self.temp_path)
+        shutil.rmtree(self.media_dir)
 
     def testNotModifiedOnBlankQuery(self, mock_mw):
         mock_mw.col.media.strip.return_value = ''
@@ -91,23 +100,48 @@ class modifyFieldsTestCase(unittest.TestCase):
 
     def testModifiedCorrectly(self, mock_mw):
         mock_mw.col.media.strip.return_value = self.query
+        mock_mw.col.media.dir.return_value = self.media_dir
         self.assertTrue(self.g.modifyFields(self.note))
 
         target = self.g.targetFields()[0]
-        filename = os.path.basename(self.temp_path)
+        filename = self.g.fileName(self.query)
         image_tag = u'[sound:{}]'.format(filename)
-        self.assertTrue(self.note.__setitem__.called_once_with \
-                        (target, image_tag))
+        self.note.__setitem__.assert_called_once_with(target, image_tag)
 
-    def testAddToMediaDatabase(self, mock_mw):
+    def testAddToMediaFolder(self, mock_mw):
         mock_mw.col.media.strip.return_value = self.query
+        mock_mw.col.media.dir.return_value = self.media_dir
         self.assertTrue(self.g.modifyFields(self.note))
-        self.assertTrue(mock_mw.col.media.addFile.called)
+        filename = self.g.fileName(self.query)
+        self.assertTrue(os.path.isfile(os.path.join(self.media_dir, filename)))
 
-    def testTempFileRemoved(self, mock_mw):
+    def testFileNameDiffersBySettings(self, mock_mw):
+        other = VoiceRSSFieldUpdater('src', 'tgt', 'japanese')
+        self.assertNotEqual(self.g.fileName(u'horse'),
+                            other.fileName(u'horse'))
+        self.assertTrue(self.g.fileName(u'a/b?').endswith(u'.mp3'))
+        self.assertNotIn(u'/', self.g.fileName(u'a/b?'))
+
+    def testNoPartialFileOnFailure(self, mock_mw):
+        mock_mw.col.media.strip.return_value = self.query
+        mock_mw.col.media.dir.return_value = self.media_dir
+        self.g.downloadFromURL.side_effect = None
+        self.assertFalse(self.g.modifyFields(self.note))
+        self.assertEqual(os.listdir(self.media_dir), [])
+
+
+    @mock.patch('{}.autovoice.showInfo'.format(__name__))
+    @mock.patch('{}.autovoice.retrieve'.format(__name__))
+    def testHTTPErrorReported(self, mock_retrieve, mock_show_info, mock_mw):
         mock_mw.col.media.strip.return_value = self.query
-        self.g.modifyFields(self.note)
-        self.assertFalse(os.path.isfile(self.temp_path))
+        mock_mw.col.media.dir.return_value = self.media_dir
+        mock_retrieve.side_effect = urllib2.HTTPError(
+                VoiceRSSFieldUpdater.URL, 404, 'Not Found', None, None)
+        g = VoiceRSSFieldUpdater(randomstring(9), randomstring(9), 'english')
+        self.assertFalse(g.modifyFields(self.note))
+        self.assertTrue(mock_show_info.called)
+        self.assertEqual(mock_retrieve.call_count, 1)
+        self.assertEqual(os.listdir(self.media_dir), [])
 
 
 class buildUrlTestCase(unittest.TestCase):
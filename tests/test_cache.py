@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+"""Unit tests for cache.py"""
+import os
+import time
+
+import pytest
+
+from ankihorse.cache import DiskCache, MetadataCache, make_key
+
+
+@pytest.fixture
+def cache(tmpdir):
+    return DiskCache(str(tmpdir.join('cache')), max_bytes=100)
+
+def write(tmpdir, name, size):
+    path = tmpdir.join(name)
+    path.write('x' * size)
+    return str(path)
+
+def test_key_depends_on_every_part():
+    assert make_key('ja-JP', 'voice', u'馬') != make_key('ja-JP', 'voice', u'犬')
+    assert make_key('a', 'bc') != make_key('ab', 'c')
+    assert make_key(u'馬') == make_key(u'馬'.encode('utf-8'))
+
+def test_miss(cache):
+    assert cache.get(make_key('horse')) is None
+
+def test_put_then_get(cache, tmpdir):
+    key = make_key('horse')
+    path = cache.put(key, write(tmpdir, 'horse', 10), '.mp3')
+    assert path.endswith(key + '.mp3')
+    assert cache.get(key) == path
+    assert not tmpdir.join('horse').check()
+
+def test_persists(cache, tmpdir):
+    key = make_key('horse')
+    path = cache.put(key, write(tmpdir, 'horse', 10), '.mp3')
+    assert DiskCache(cache.directory, 100).get(key) == path
+
+def test_duplicate_put_keeps_first(cache, tmpdir):
+    key = make_key('horse')
+    first = cache.put(key, write(tmpdir, 'a', 10))
+    second = cache.put(key, write(tmpdir, 'b', 20))
+    assert first == second
+    assert os.path.getsize(first) == 10
+    assert not tmpdir.join('b').check()
+
+def test_evicts_least_recently_used(cache, tmpdir):
+    keys = [make_key(i) for i in range(3)]
+    for i, key in enumerate(keys):
+        cache.put(key, write(tmpdir, str(i), 40))
+    assert cache.get(keys[0]) is None
+    assert cache.get(keys[1]) is not None
+
+    cache.put(make_key(3), write(tmpdir, '3', 40))
+    assert cache.get(keys[1]) is not None
+    assert cache.get(keys[2]) is None
+
+def test_never_evicts_new_entry(tmpdir):
+    cache = DiskCache(str(tmpdir.join('cache')), max_bytes=0)
+    key = make_key('horse')
+    path = cache.put(key, write(tmpdir, 'horse', 10))
+    assert os.path.isfile(path)
+
+@pytest.fixture
+def metadata(tmpdir):
+    return MetadataCache(str(tmpdir.join('search.sqlite')), 2, ttl=60)
+
+def test_metadata_miss(metadata):
+    assert metadata.get(make_key('horse')) is None
+
+def test_metadata_roundtrip(metadata):
+    metadata.put('horse', {'link': u'http://馬.jp/a.png'})
+    assert metadata.get('horse') == {'link': u'http://馬.jp/a.png'}
+
+def test_metadata_delete(metadata):
+    metadata.put('horse', [1, 2])
+    metadata.delete('horse')
+    metadata.delete('pony')
+    assert metadata.get('horse') is None
+
+def test_metadata_persists(metadata):
+    metadata.put('horse', [1, 2])
+    assert MetadataCache(metadata.path, 2, 60).get('horse') == [1, 2]
+
+def test_metadata_expires(metadata, monkeypatch):
+    metadata.put('horse', 1)
+    now = time.time()
+    monkeypatch.setattr(time, 'time', lambda: now + 61)
+    assert metadata.get('horse') is None
+
+def test_metadata_evicts_least_recently_used(metadata, monkeypatch):
+    clock = [1000.0]
+    monkeypatch.setattr(time, 'time', lambda: clock[0])
+    for key in ('a', 'b'):
+        clock[0] += 1
+        metadata.put(key, key)
+    clock[0] += 1
+    metadata.get('a')
+    clock[0] += 1
+    metadata.put('c', 'c')
+    assert metadata.get('b') is None
+    assert metadata.get('a') == 'a'
+    assert metadata.get('c') == 'c'
+
+def test_staging_directory_is_not_an_entry(cache):
+    staging = cache.staging_directory()
+    assert os.path.isdir(staging)
+    path = os.path.join(staging, 'horse')
+    with open(path, 'w') as f:
+        f.write('x' * 10)
+    key = make_key('horse')
+    cache.put(key, path, '.mp3')
+    assert DiskCache(cache.directory, 100).get(key) is not None
+    assert DiskCache(cache.directory, 100).get('.staging') is None
@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+"""Unit tests for cognitive_services.py"""
+import socket
+import threading
+import time
+
+import pytest
+import mock
+
+from ankihorse import cognitive_services
+from ankihorse.config import Config
+from ankihorse.cognitive_services import TokenManager, first_acceptable_image
+
+
+@pytest.fixture
+def ipify(monkeypatch):
+    ipify = mock.MagicMock()
+    ipify.return_value.read.return_value = '203.0.113.7\n'
+    monkeypatch.setattr(cognitive_services.default_client, 'request', ipify)
+    monkeypatch.setattr(cognitive_services, '_client_ip', None)
+    return ipify
+
+@pytest.fixture
+def send_client_ip(monkeypatch, tmpdir):
+    store = Config(str(tmpdir.join('config.json')))
+    monkeypatch.setattr(cognitive_services, 'store', store)
+    return store
+
+def test_client_ip_is_lazy(ipify, send_client_ip):
+    assert not ipify.called
+    assert cognitive_services.client_ip() == '203.0.113.7'
+    assert ipify.call_count == 1
+
+def test_client_ip_cached(ipify, send_client_ip):
+    cognitive_services.client_ip()
+    cognitive_services.client_ip()
+    assert ipify.call_count == 1
+
+def test_client_ip_expires(ipify, send_client_ip, monkeypatch):
+    cognitive_services.client_ip()
+    later = time.time() + cognitive_services.CLIENT_IP_TTL + 1
+    monkeypatch.setattr(time, 'time', lambda: later)
+    cognitive_services.client_ip()
+    assert ipify.call_count == 2
+
+def test_client_ip_disabled(ipify, send_client_ip):
+    send_client_ip.set('cognitive services', 'send client ip', False)
+    assert cognitive_services.client_ip() is None
+    assert not ipify.called
+
+def test_client_ip_offline(ipify, send_client_ip):
+    ipify.side_effect = socket.error('offline')
+    assert cognitive_services.client_ip() is None
+
+@pytest.fixture
+def issue():
+    count = [0]
+    def issue(api_key):
+        count[0] += 1
+        time.sleep(0.01)
+        return '{}-{}'.format(api_key, count[0])
+    issue.count = count
+    return issue
+
+def test_tokens_shared(issue):
+    tokens = TokenManager(issue, lifetime=60, refresh_after=30)
+    assert tokens.get('key') == tokens.get('key') == 'key-1'
+    assert tokens.get('other') == 'other-2'
+
+def test_tokens_no_stampede(issue):
+    tokens = TokenManager(issue, lifetime=60, refresh_after=30)
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(
+                   tokens.get('key'))) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert results == ['key-1'] * 8
+    assert issue.count[0] == 1
+
+def test_tokens_refresh_replaces_stale_once(issue):
+    tokens = TokenManager(issue, lifetime=60, refresh_after=30)
+    stale = tokens.get('key')
+    assert tokens.refresh('key', stale) == 'key-2'
+    assert tokens.refresh('key', stale) == 'key-2'
+    assert issue.count[0] == 2
+
+def test_tokens_refreshed_in_background(issue):
+    tokens = TokenManager(issue, lifetime=0.5, refresh_after=0.05)
+    tokens.get('key')
+    time.sleep(0.2)
+    assert issue.count[0] == 2
+    assert tokens._tokens['key'][0] == 'key-2'
+
+def test_unused_tokens_not_refreshed(issue):
+    tokens = TokenManager(issue, lifetime=0.5, refresh_after=0.05)
+    tokens.get('key')
+    time.sleep(0.3)
+    assert issue.count[0] == 2
+
+def test_first_acceptable_image():
+    images = [ {'contentUrl': 'big', 'contentSize': '5000000 B'}
+             , {'contentUrl': 'unknown'}
+             , {'contentUrl': 'small', 'contentSize': '1000 B'}
+             ]
+    assert first_acceptable_image(images)['contentUrl'] == 'big'
+    assert first_acceptable_image(images, 4000)['contentUrl'] == 'unknown'
+    assert first_acceptable_image(images[::2], 4000)['contentUrl'] == 'small'
+    assert first_acceptable_image(images[:1], 4000) is None
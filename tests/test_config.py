@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+"""Unit tests for config.py"""
+import json
+import os
+
+import mock
+import pytest
+
+from ankihorse.config import Config, ConfigError
+
+
+@pytest.fixture
+def path(tmpdir):
+    return str(tmpdir.join('config.json'))
+
+def write(path, contents):
+    with open(path, 'w') as f:
+        json.dump(contents, f)
+
+
+def test_missing_file_is_empty(path):
+    store = Config(path)
+    assert store.get('cache', 'tts cache size mb', 256) == 256
+    assert not os.path.exists(path)
+
+def test_reads_once(path):
+    write(path, {'cache': {'tts cache size mb': 10}})
+    store = Config(path)
+    assert store.get('cache', 'tts cache size mb') == 10
+    write(path, {'cache': {'tts cache size mb': 20}})
+    assert store.get('cache', 'tts cache size mb') == 10
+
+def test_invalid_json(path):
+    with open(path, 'w') as f:
+        f.write('{"cache": ')
+    with pytest.raises(ConfigError):
+        Config(path).get('cache', 'tts cache size mb')
+
+def test_section_not_an_object(path):
+    write(path, {'cache': 5})
+    with pytest.raises(ConfigError):
+        Config(path).get('cache', 'tts cache size mb')
+
+def test_typed_getters(path):
+    write(path, { 'a': { 'flag': True, 'count': 3, 'ratio': 2
+                       , 'name': u'horse', 'unset': None
+                       }
+                })
+    store = Config(path)
+    assert store.get_bool('a', 'flag', False) is True
+    assert store.get_int('a', 'count', 1, minimum=1) == 3
+    assert store.get_float('a', 'ratio', 1.0) == 2.0
+    assert isinstance(store.get_float('a', 'ratio', 1.0), float)
+    assert store.get_str('a', 'name', None) == u'horse'
+    assert store.get_int('a', 'unset', 7) == 7
+    assert store.get_int('a', 'missing', 7) == 7
+
+@pytest.mark.parametrize('getter,option,kwargs',
+    [ ('get_int', 'flag', {})
+    , ('get_int', 'ratio', {})
+    , ('get_int', 'count', {'minimum': 4})
+    , ('get_float', 'name', {})
+    , ('get_bool', 'count', {})
+    , ('get_str', 'count', {})
+    ])
+def test_typed_getters_validate(path, getter, option, kwargs):
+    write(path, {'a': {'flag': True, 'count': 3, 'ratio': 0.5,
+                       'name': 'horse'}})
+    with pytest.raises(ConfigError):
+        getattr(Config(path), getter)('a', option, None, **kwargs)
+
+def test_set_writes_atomically(path):
+    write(path, {'cache': {'tts cache size mb': 10}})
+    store = Config(path)
+    store.set('stats', 'enabled', True)
+    with open(path) as f:
+        assert json.load(f) == { 'cache': {'tts cache size mb': 10}
+                               , 'stats': {'enabled': True}
+                               }
+    assert os.listdir(os.path.dirname(path)) == ['config.json']
+
+def test_failed_write_keeps_old_file(path):
+    write(path, {'stats': {'enabled': False}})
+    store = Config(path)
+    with mock.patch('json.dump', side_effect=ValueError):
+        with pytest.raises(ValueError):
+            store.set('stats', 'enabled', True)
+    assert store.get('stats', 'enabled') is False
+    with open(path) as f:
+        assert json.load(f) == {'stats': {'enabled': False}}
+    assert os.listdir(os.path.dirname(path)) == ['config.json']
+
+def test_subscribe(path):
+    store = Config(path)
+    everything, stats = mock.Mock(), mock.Mock()
+    store.subscribe(everything)
+    unsubscribe = store.subscribe(stats, 'stats')
+    store.set('stats', 'enabled', True)
+    store.set('stats', 'enabled', True)  # unchanged
+    store.set('cache', 'tts cache size mb', 5)
+    unsubscribe()
+    store.set('stats', 'enabled', False)
+    assert stats.call_args_list == [mock.call('stats', 'enabled', True)]
+    assert everything.call_args_list == \
+        [ mock.call('stats', 'enabled', True)
+        , mock.call('cache', 'tts cache size mb', 5)
+        , mock.call('stats', 'enabled', False)
+        ]
+
+def test_reload_notifies_changes(path, tmpdir):
+    write(path, {'stats': {'enabled': True}, 'cache': {'a': 1}})
+    store = Config(path)
+    store.get('stats', 'enabled')
+    callback = mock.Mock()
+    store.subscribe(callback)
+    other = str(tmpdir.join('other.json'))
+    write(other, {'stats': {'enabled': True}, 'cache': {'b': 2}})
+    store.reload(other)
+    assert store.path == other
+    assert sorted(callback.call_args_list) == \
+        [ mock.call('cache', 'a', None)
+        , mock.call('cache', 'b', 2)
+        ]
+
+def test_api_key(path):
+    store = Config(path)
+    assert store.api_key('bing speech') is None
+    store.set_api_key('bing speech', 'secret')
+    assert Config(path).api_key('bing speech') == 'secret'
+    assert isinstance(Config(path).api_key('bing speech'), str)
+
+def test_rate_limit(path):
+    write(path, {'rate limits': {'voicerss requests per second': 2,
+                                 'voicerss daily quota': 350}})
+    store = Config(path)
+    assert store.rate_limit('voicerss', 5, None) == (2.0, 350)
+    assert store.rate_limit('bing speech', 5, None) == (5, None)
+
+def test_rate_limit_must_be_positive(path):
+    write(path, {'rate limits': {'voicerss requests per second': 0}})
+    with pytest.raises(ConfigError):
+        Config(path).rate_limit('voicerss', 5)
+
+def test_cache_bytes(path):
+    write(path, {'cache': {'tts cache size mb': 1.5}})
+    store = Config(path)
+    assert store.cache_bytes('tts', 256) == 1536 * 1024
+    assert store.cache_bytes('image', 2) == 2 * 1024 * 1024
+
+def test_fetch_workers(path):
+    store = Config(path)
+    assert store.fetch_workers() == 4
+    store.set('concurrency', 'fetch workers', 8)
+    assert store.fetch_workers() == 8
+    store.set('concurrency', 'fetch workers', 0)
+    with pytest.raises(ConfigError):
+        store.fetch_workers()
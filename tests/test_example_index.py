@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+"""Unit tests for example_index.py"""
+import random
+from collections import Counter
+
+import pytest
+
+from ankihorse import example_index
+from ankihorse.example_index import (
+        ExampleIndex, corpus_checksum, open_index, weight, weighted_sample,
+        write_index)
+
+
+DICTIONARIES = ( { u'猫': [(10, 5, 1, 1), (40, 9, 0, 2)] }
+               , { u'猫': [(0, 3, 0, 0)]
+                 , u'犬': [(20, 4, 0, 1), (30, 6, 2, 1), (50, 12, 3, 3)]
+                 , u'a': [(60, 1, 0, 1)]
+                 }
+               )
+
+@pytest.fixture
+def checksum():
+    return corpus_checksum('A: horse\nB: horse\n')
+
+@pytest.fixture
+def path(tmpdir, checksum):
+    path = str(tmpdir.join('examples.index'))
+    write_index(path, DICTIONARIES, checksum)
+    return path
+
+def test_lookup(path):
+    index = ExampleIndex(path)
+    for number, dictionary in enumerate(DICTIONARIES):
+        for word, postings in dictionary.items():
+            assert list(index.lookup(number, word)) == postings
+
+def test_lookup_missing(path):
+    index = ExampleIndex(path)
+    assert index.lookup(0, u'犬') is None
+    assert index.lookup(1, u'馬') is None
+    assert index.lookup(1, u'') is None
+
+def test_empty_index(tmpdir, checksum):
+    path = str(tmpdir.join('examples.index'))
+    write_index(path, ({}, {}), checksum)
+    assert ExampleIndex(path).lookup(0, u'猫') is None
+
+def test_open_index(path, checksum):
+    index = open_index(path, checksum)
+    assert list(index.lookup(1, u'a')) == [(60, 1, 0, 1)]
+
+def test_open_index_missing(tmpdir, checksum):
+    assert open_index(str(tmpdir.join('nothing')), checksum) is None
+
+def test_open_index_other_corpus(path):
+    assert open_index(path, corpus_checksum('something else')) is None
+
+def test_open_index_corrupt(tmpdir, checksum):
+    path = tmpdir.join('examples.index')
+    path.write('half an ind')
+    assert open_index(str(path), checksum) is None
+
+def test_open_index_other_version(path, checksum, monkeypatch):
+    monkeypatch.setattr(example_index, 'VERSION', example_index.VERSION + 1)
+    assert open_index(path, checksum) is None
+
+def test_write_replaces(path, checksum):
+    write_index(path, ({u'馬': [(1, 2, 0, 1)]}, {}), checksum)
+    index = ExampleIndex(path)
+    assert list(index.lookup(0, u'馬')) == [(1, 2, 0, 1)]
+    assert index.lookup(0, u'猫') is None
+
+def test_write_leaves_no_temporary_files(path, tmpdir):
+    assert [p.basename for p in tmpdir.listdir()] == ['examples.index']
+
+def test_weight():
+    assert weight(0) == weight(25) == 46 ** 3
+    assert weight(70) == weight(200) == 1
+    assert weight(30) > weight(31)
+
+def test_oversized_span_dropped(tmpdir, checksum):
+    path = str(tmpdir.join('examples.index'))
+    write_index(path, ({u'馬': [(1, 2, 70000, 1)]}, {}), checksum)
+    assert list(ExampleIndex(path).lookup(0, u'馬')) == [(1, 2, 0, 0)]
+
+def test_postings_sequence(path):
+    postings = ExampleIndex(path).lookup(1, u'犬')
+    assert len(postings) == 3
+    assert postings[1] == (30, 6, 2, 1)
+    assert postings[-1] == (50, 12, 3, 3)
+    with pytest.raises(IndexError):
+        postings[3]
+
+def test_find_weight(path):
+    postings = ExampleIndex(path).lookup(1, u'犬')
+    assert postings.total_weight() == sum(weight(p[1]) for p in postings)
+    assert postings.find_weight(0) == 0
+    assert postings.find_weight(weight(4) - 1) == 0
+    assert postings.find_weight(weight(4)) == 1
+    assert postings.find_weight(postings.total_weight() - 1) == 2
+
+def linear_weighted_sample(somelist, n):
+    """The original O(n**2) algorithm, for comparison."""
+    weights = [weight(posting[1]) for posting in somelist]
+    total = float(sum(weights))
+    ret = []
+    for _ in range(n):
+        g = total * random.random()
+        for i, w in enumerate(weights):
+            if g < w:
+                ret.append(somelist[i])
+                total -= w
+                weights[i] = 0.0
+                break
+            g -= w
+    return ret
+
+@pytest.fixture
+def sample_postings(tmpdir, checksum):
+    lengths = [10, 30, 40, 50, 60, 65, 70, 90]
+    postings = [(i * 100, length, 0, 1) for i, length in enumerate(lengths)]
+    path = str(tmpdir.join('sample.index'))
+    write_index(path, ({u'する': postings}, {}), checksum)
+    return postings, ExampleIndex(path).lookup(0, u'する')
+
+@pytest.mark.parametrize('n', [1, 2, 8])
+def test_weighted_sample_distribution(sample_postings, n):
+    postings, indexed = sample_postings
+    trials = 20000
+    random.seed(0)
+    expected = Counter(tuple(linear_weighted_sample(postings, n))
+                       for _ in range(trials))
+    random.seed(1)
+    actual = Counter(tuple(weighted_sample(indexed, n))
+                     for _ in range(trials))
+    for outcome, count in expected.items():
+        if count > 500:
+            assert abs(actual[outcome] - count) < 5 * count ** 0.5
+
+def test_weighted_sample_distinct(sample_postings):
+    postings, indexed = sample_postings
+    for n in range(len(postings) + 1):
+        sample = weighted_sample(indexed, n)
+        assert len(sample) == len(set(sample)) == n
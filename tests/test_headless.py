@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+"""Unit tests for headless.py"""
+from StringIO import StringIO
+import os
+import subprocess
+import sys
+
+import mock
+import pytest
+
+from ankihorse import headless, updateraddon
+from ankihorse.updateraddon import Regenerator
+
+
+@pytest.fixture
+def module():
+    module = mock.Mock(__name__='ankihorse.horse')
+    module.field_updater.return_value.sourceFields.return_value = ['src']
+    return module
+
+def test_regenerators(module):
+    addons = [ ( module
+               , dict( name='Horse'
+                     , source_fields=['src']
+                     , model_name_substring='horse'
+                     , on_focus_lost=True
+                     , async_focus_lost=True
+                     )
+               )
+             , (module, dict(source_fields=['other']))
+             ]
+    first, second = headless.regenerators(addons, fetch_workers=8)
+    assert module.field_updater.call_args_list == \
+            [mock.call(source_fields=['src']), mock.call(source_fields=['other'])]
+    assert isinstance(first, Regenerator)
+    assert first.name == 'Horse'
+    assert first._model_name_substring == 'horse'
+    assert first._fetch_workers == 8
+    assert second.name == 'horse'
+
+def test_regenerators_by_name(module):
+    addons = [(module, dict(name='Horse')), (module, dict(name='Pony'))]
+    assert [r.name for r in headless.regenerators(addons, ['Pony'])] == \
+            ['Pony']
+
+def test_install(monkeypatch):
+    monkeypatch.setattr(updateraddon, 'mw', updateraddon.mw)
+    monkeypatch.setattr(updateraddon, 'showInfo', updateraddon.showInfo)
+    col = mock.Mock(path='/decks/User 1/collection.anki2')
+    window = headless.HeadlessWindow(col)
+    headless.install(window)
+    assert updateraddon.mw is window
+    assert updateraddon.mw.pm.profileFolder() == '/decks/User 1'
+    updateraddon.showInfo('neigh')  # no dialog
+
+def test_run(monkeypatch):
+    monkeypatch.setattr(headless, 'install', mock.Mock())
+    regenerator = mock.Mock()
+    regenerator.name = 'Horse'
+    regenerator.candidates.return_value = ([1, 2], [(3, 'hash')])
+    regenerator.regenerate.return_value = 2
+    idle = mock.Mock()
+    idle.candidates.return_value = ([], [])
+    monkeypatch.setattr(headless, 'regenerators',
+                        lambda *args: [regenerator, idle])
+
+    out = StringIO()
+    col = mock.Mock(path='/decks/User 1/collection.anki2')
+    assert headless.run(col, [], out=out) == 2
+    regenerator.candidates.assert_called_once_with(True)
+    assert regenerator.regenerate.call_args[0][:2] == ([1, 2], [(3, 'hash')])
+    assert not idle.regenerate.called
+    assert 'Horse: 2 notes to regenerate' in out.getvalue()
+
+def test_progress_printer():
+    out = StringIO()
+    headless.progress_printer('Horse', out)(5, 10)
+    assert out.getvalue().startswith('Horse: 5/10 notes')
+
+
+def test_imports_without_gui():
+    # a fresh interpreter in which aqt can't be imported
+    script = ("import sys; sys.modules['aqt'] = None; "
+              "import ankihorse.headless, ankihorse_; "
+              "assert ankihorse_.mw is None")
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([root] + sys.path))
+    subprocess.check_call([sys.executable, '-c', script], env=env)
@@ -0,0 +1,216 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+"""Unit tests for httpclient.py"""
+import errno
+import gzip
+import httplib
+import socket
+import threading
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+from StringIO import StringIO
+from urllib2 import HTTPError
+
+import pytest
+
+from ankihorse.httpclient import HTTPClient, DownloadError, retrieve
+from ankihorse.ratelimit import RateLimiter
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    throttle = 0  # how many more requests to /throttle to refuse
+
+    def log_message(self, *args):
+        pass
+
+    def reply(self, status, body, headers={}):
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path.startswith('/gzip'):
+            buf = StringIO()
+            with gzip.GzipFile(fileobj=buf, mode='wb') as f:
+                f.write('horse' * 100)
+            self.reply(200, buf.getvalue(), {'Content-Encoding': 'gzip'})
+        elif self.path.startswith('/redirect'):
+            self.reply(302, '', {'Location': '/echo?redirected'})
+        elif self.path.startswith('/image'):
+            self.reply(200, 'x' * 1000, {'Content-Type': 'image/png'})
+        elif self.path.startswith('/throttle'):
+            if Handler.throttle > 0:
+                Handler.throttle -= 1
+                self.reply(429, 'slow down', {'Retry-After': '0'})
+            else:
+                self.reply(200, 'ok')
+        elif self.path.startswith('/missing'):
+            self.reply(404, 'not here')
+        else:
+            self.reply(200, self.path)
+
+    def do_POST(self):
+        length = int(self.headers.getheader('content-length'))
+        self.reply(200, self.rfile.read(length))
+
+
+class Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+@pytest.fixture
+def server():
+    server = Server(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=server.serve_forever, args=(0.05,))
+    thread.daemon = True
+    thread.start()
+    yield 'http://127.0.0.1:{}'.format(server.server_address[1])
+    server.shutdown()
+    server.server_close()
+
+@pytest.fixture
+def client():
+    client = HTTPClient(timeout=5)
+    yield client
+    client.close()
+
+def test_get_with_params(server, client):
+    response = client.request('GET', server + '/echo', {'q': 'horse'})
+    assert response.status == 200
+    assert response.read() == '/echo?q=horse'
+
+def test_post(server, client):
+    assert client.request('POST', server, data='pony').read() == 'pony'
+
+def test_connection_reused(server, client):
+    for _ in range(3):
+        client.request('GET', server + '/echo').read()
+    stats = client.stats()
+    assert stats['requests'] == 3
+    assert stats['connections_opened'] == 1
+    assert stats['connections_reused'] == 2
+
+def test_unread_response_not_reused(server, client):
+    client.request('GET', server + '/echo').close()
+    client.request('GET', server + '/echo').read()
+    assert client.stats()['connections_opened'] == 2
+
+def test_gzip(server, client):
+    assert client.request('GET', server + '/gzip').read() == 'horse' * 100
+
+def test_gzip_chunked_read(server, client):
+    response = client.request('GET', server + '/gzip')
+    chunks = iter(lambda: response.read(16), '')
+    assert ''.join(chunks) == 'horse' * 100
+
+def test_redirect(server, client):
+    response = client.request('GET', server + '/redirect')
+    assert response.read() == '/echo?redirected'
+
+def test_error_status(server, client):
+    with pytest.raises(HTTPError) as info:
+        client.request('GET', server + '/missing')
+    assert info.value.code == 404
+    assert info.value.read() == 'not here'
+
+def test_error_connection_reused(server, client):
+    with pytest.raises(HTTPError):
+        client.request('GET', server + '/missing')
+    client.request('GET', server + '/echo').read()
+    assert client.stats()['connections_reused'] == 1
+
+def test_retrieve(server, tmpdir):
+    path = str(tmpdir.join('echo'))
+    retrieve(server + '/echo', path)
+    assert open(path).read() == '/echo'
+
+def test_retrieve_image(server, tmpdir):
+    path = str(tmpdir.join('image'))
+    retrieve(server + '/image', path, max_bytes=1000, content_types=('image/',))
+    assert len(open(path).read()) == 1000
+
+def test_retrieve_content_length_too_large(server, tmpdir):
+    path = str(tmpdir.join('image'))
+    with pytest.raises(DownloadError):
+        retrieve(server + '/image', path, max_bytes=999)
+    assert not tmpdir.join('image').check()
+
+def test_retrieve_body_too_large(server, tmpdir):
+    # the Content-Length is of the compressed body, so only streaming
+    # notices that it is too large
+    path = str(tmpdir.join('gzip'))
+    with pytest.raises(DownloadError):
+        retrieve(server + '/gzip', path, max_bytes=100)
+    assert not tmpdir.join('gzip').check()
+
+def test_retrieve_wrong_content_type(server, tmpdir):
+    path = str(tmpdir.join('echo'))
+    with pytest.raises(DownloadError):
+        retrieve(server + '/echo', path, content_types=('image/',))
+    assert not tmpdir.join('echo').check()
+
+def test_throttled_slows_limiter(server, client, monkeypatch):
+    monkeypatch.setattr(Handler, 'throttle', 1)
+    limiter = RateLimiter('test', 100)
+    with pytest.raises(HTTPError) as info:
+        client.request('GET', server + '/throttle', limiter=limiter)
+    assert info.value.code == 429
+    assert limiter.rate < 100
+    response = client.request('GET', server + '/throttle', limiter=limiter)
+    assert response.read() == 'ok'
+
+
+class FailingConnection(object):
+    """A pooled connection whose request or response fails."""
+
+    def __init__(self, request_error=None, response_error=None):
+        self.request_error = request_error
+        self.response_error = response_error
+        self.sent = 0
+        self.sock = None
+
+    def request(self, *args):
+        if self.request_error is not None:
+            raise self.request_error
+        self.sent += 1
+
+    def getresponse(self):
+        raise self.response_error
+
+    def close(self):
+        pass
+
+def reused(client, server, connection):
+    host, port = server.split('//')[1].split(':')
+    client._idle[('http', host, int(port))] = [connection]
+
+@pytest.mark.parametrize('method,error', [
+        ('GET', httplib.BadStatusLine("''")),
+        ('GET', socket.error(errno.ECONNRESET, 'reset')),
+        ('POST', None)])
+def test_dropped_idle_connection_retried(server, client, method, error):
+    if error is None:  # fails before anything is sent
+        stale = FailingConnection(request_error=socket.error(errno.EPIPE,
+                                                             'broken'))
+    else:
+        stale = FailingConnection(response_error=error)
+    reused(client, server, stale)
+    response = client.request(method, server + '/echo', data='horse')
+    assert response.status == 200
+    assert client.stats()['connections_opened'] == 1
+
+@pytest.mark.parametrize('method,error', [
+        ('POST', httplib.BadStatusLine("''")),
+        ('POST', socket.error(errno.ECONNRESET, 'reset')),
+        ('GET', socket.timeout('timed out'))])
+def test_sent_request_not_retried(server, client, method, error):
+    stale = FailingConnection(response_error=error)
+    reused(client, server, stale)
+    with pytest.raises(type(error)):
+        client.request(method, server + '/echo', data='horse')
+    assert stale.sent == 1
+    assert client.stats()['connections_opened'] == 0
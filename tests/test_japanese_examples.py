@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+"""Unit tests for japanese_examples.py"""
+import mmap
+import re
+
+import pytest
+
+from ankihorse import japanese_examples
+from ankihorse.japanese_examples import (HIGHLIGHT,
+        JapaneseExamplesFieldUpdater, highlight_span, sentence_forms)
+
+CORPUS = (u'A: 猫が好きです。\tI like cats.#ID=1\n'
+          u'B: 猫 が 好き です\n')
+
+
+# Priority (~), conjugated ({...}), reading-only ((...)) and Latin script
+# words, and multibyte text before each line. The last word of a B line isn't
+# indexed.
+SAMPLE = (u'A: 猫が好きです。\tI like cats.#ID=1\n'
+          u'B: 猫(ねこ)~ が 好き です\n'
+          u'A: 駅に戻ります。\tI\'ll go back to the station.#ID=2\n'
+          u'B: 駅 に 戻る(もどる){戻ります} 。\n'
+          u'A: 犬と猫がいる。\tThere is a dog and a cat.#ID=3\n'
+          u'B: 犬 と 猫 が 居る{いる}\n'
+          u'A: CDを買った。\tI bought a CD.#ID=4\n'
+          u'B: CD を 買う{買った} 。')
+
+
+def install_corpus(monkeypatch, tmpdir, text):
+    path = tmpdir.join('japanese_examples.utf')
+    path.write(text.encode('utf-8'), mode='wb')
+    monkeypatch.setattr(japanese_examples, 'FNAME', str(path))
+    monkeypatch.setattr(japanese_examples, 'FILE_INDEX',
+                        str(tmpdir.join('japanese_examples.index')))
+    monkeypatch.setattr(japanese_examples, 'FILE_PICKLE',
+                        str(tmpdir.join('japanese_examples.pickle')))
+    return path
+
+@pytest.fixture
+def corpus(monkeypatch, tmpdir):
+    return install_corpus(monkeypatch, tmpdir, CORPUS)
+
+@pytest.fixture
+def sample(monkeypatch, tmpdir):
+    install_corpus(monkeypatch, tmpdir, SAMPLE)
+    updater = make_updater()
+    updater.weighted = False
+    return updater
+
+def make_updater():
+    return JapaneseExamplesFieldUpdater(
+            ['Expression'], ['Sentence', 'Sentence-English', 'Sentence-Clozed'])
+
+def test_loads_lazily(corpus):
+    updater = make_updater()
+    assert updater.index is None
+    [(japanese, english)] = updater.find_examples(u'猫', 1)
+    assert english == u'I like cats.'
+    assert japanese_examples.HIGHLIGHT % u'猫' in japanese
+
+def test_warm(corpus):
+    updater = make_updater()
+    loading = updater.warm()
+    assert updater.warm() is loading
+    loading.result(timeout=5)
+    assert updater.index is not None
+    assert updater.find_examples(u'犬', 1) == []
+
+def test_missing_corpus(corpus):
+    corpus.remove()
+    updater = make_updater()  # doesn't touch the corpus
+    with pytest.raises(EnvironmentError):
+        updater.find_examples(u'猫', 1)
+
+
+def test_corpus_is_mapped(sample):
+    sample.wait()
+    assert isinstance(sample.content, mmap.mmap)
+    assert sample.content[:3] == 'A: '
+
+def test_lines_byte_offsets(sample):
+    sample.wait()
+    encoded = SAMPLE.encode('utf-8')
+    lines = list(sample.lines())
+    assert [line for _, line in lines] == encoded.split('\n')
+    for offset, line in lines:
+        assert encoded[offset:offset + len(line)] == line
+
+def test_line_at_multibyte(sample):
+    sample.wait()
+    lines = SAMPLE.split(u'\n')
+    offsets = [offset for offset, _ in sample.lines()]
+    assert offsets[4] == len(u'\n'.join(lines[:4]).encode('utf-8')) + 1
+    assert offsets[4] > len(u'\n'.join(lines[:4])) + 1
+    for i, offset in enumerate(offsets):
+        line, following = sample.line_at(offset)
+        assert line == lines[i]
+        if i + 1 < len(offsets):
+            assert following == offsets[i + 1]
+    assert sample.line_at(offsets[-1])[1] == len(SAMPLE.encode('utf-8')) + 1
+
+
+def old_example(a_line, b_line, expression, checked):
+    """How find_examples highlighted an example before spans were
+    precomputed, for comparison."""
+    example = a_line.split("#ID=")[0][3:]
+    if checked:
+        example = example + " {CHECKED}"
+    example = example.replace(expression, HIGHLIGHT % expression)
+    regexp = (u"(?:\\(*%s\\)*)(?:\\([^\\s]+?\\))*(?:\\[\\d+\\])*\\{(.+?)\\}"
+              % expression)
+    match = re.search(regexp, b_line)
+    match_reading = re.search(u"(?:\\s([^\\s]*?))(?:\\(%s\\))" % expression,
+                              b_line)
+    if match:
+        form = match.group(1)
+    elif match_reading:
+        form = match_reading.group(1)
+    else:
+        form = expression
+    example = example.replace(form, HIGHLIGHT % form)
+    # the old code could wrap a word in two FONT tags; it looks the same
+    opening, closing = HIGHLIGHT.split(u'%s')
+    example = example.replace(opening * 2, opening)
+    example = example.replace(closing * 2, closing)
+    return tuple(example.split('\t'))
+
+def old_examples(expression, *pairs):
+    lines = SAMPLE.split(u'\n')
+    return [old_example(lines[2 * i], lines[2 * i + 1], expression, checked)
+            for i, checked in pairs]
+
+def test_sentence_forms():
+    forms = sentence_forms(u'B: 駅 に 戻る(もどる){戻ります} 猫(ねこ)~ 戻る')
+    assert forms[u'戻る'] == u'戻ります'
+    assert forms[u'もどる'] == u'戻ります'
+    assert forms[u'戻ります'] == u'戻ります'
+    assert forms[u'猫'] == forms[u'ねこ'] == u'猫'
+    assert forms[u'駅'] == u'駅'
+    assert u'B:' not in forms
+
+def test_highlight_span():
+    forms = {u'戻る': u'戻ります', u'ねこ': u'猫'}
+    assert highlight_span(u'駅に戻ります。', u'戻る', forms) == (2, 4)
+    assert highlight_span(u'猫が好きです。', u'ねこ', forms) == (0, 1)
+    assert highlight_span(u'猫が好きです。', u'好き', forms) == (2, 2)
+    assert highlight_span(u'猫が好きです。', u'犬', forms) == (0, 0)
+
+def test_conjugated_form(sample):
+    examples = sample.find_examples(u'戻る', 5)
+    assert examples == [(u'駅に' + HIGHLIGHT % u'戻ります' + u'。',
+                         u"I'll go back to the station.")]
+    assert examples == old_examples(u'戻る', (1, False))
+
+def test_reading_only(sample):
+    assert sample.find_examples(u'もどる', 5) == \
+            old_examples(u'もどる', (1, False))
+    examples = sample.find_examples(u'ねこ', 5)
+    assert examples == [(HIGHLIGHT % u'猫' + u'が好きです。',
+                         u'I like cats. {CHECKED}')]
+    assert examples == old_examples(u'ねこ', (0, True))
+
+def test_priority_dictionary_first(sample):
+    examples = sample.find_examples(u'猫', 5)
+    assert examples == old_examples(u'猫', (0, True), (2, False))
+    assert examples[1] == (u'犬と' + HIGHLIGHT % u'猫' + u'がいる。',
+                           u'There is a dog and a cat.')
+    assert sample.find_examples(u'猫', 1) == old_examples(u'猫', (0, True))
+
+def test_latin_word_highlighted_in_translation(sample):
+    examples = sample.find_examples(u'CD', 5)
+    assert examples == [(HIGHLIGHT % u'CD' + u'を買った。',
+                         u'I bought a ' + HIGHLIGHT % u'CD' + u'.')]
+    assert examples == old_examples(u'CD', (3, False))
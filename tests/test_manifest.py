@@ -0,0 +1,33 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+"""Unit tests for manifest.py"""
+import pytest
+
+from ankihorse.manifest import Manifest
+
+
+@pytest.fixture
+def path(tmpdir):
+    return str(tmpdir.join('profile', 'manifest.sqlite'))
+
+def test_empty(path):
+    assert Manifest(path).hashes('horse') == {}
+
+def test_update_persists(path):
+    manifest = Manifest(path)
+    manifest.update('horse', [(1, 'a'), (2, 'b')])
+    manifest.close()
+    assert Manifest(path).hashes('horse') == {1: 'a', 2: 'b'}
+
+def test_update_replaces(path):
+    manifest = Manifest(path)
+    manifest.update('horse', [(1, 'a')])
+    manifest.update('horse', [(1, 'b')])
+    assert manifest.hashes('horse') == {1: 'b'}
+
+def test_addons_are_separate(path):
+    manifest = Manifest(path)
+    manifest.update('horse', [(1, 'a')])
+    manifest.update('pony', [(1, 'b')])
+    assert manifest.hashes('horse') == {1: 'a'}
+    assert manifest.hashes('pony') == {1: 'b'}
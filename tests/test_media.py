@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+"""Unit tests for media.py"""
+import os
+
+import pytest
+
+from ankihorse.media import add_file, media_name, write_file
+
+
+@pytest.fixture
+def media_dir(tmpdir):
+    return tmpdir.mkdir('media')
+
+def test_add_file(tmpdir, media_dir):
+    source = tmpdir.join('horse.mp3')
+    source.write('neigh')
+    assert add_file(str(source), str(media_dir)) == u'horse.mp3'
+    assert media_dir.join('horse.mp3').read() == 'neigh'
+    assert source.check()
+
+def test_add_file_copies(tmpdir, media_dir):
+    source = tmpdir.join('horse.mp3')
+    source.write('neigh')
+    add_file(str(source), str(media_dir))
+    media_dir.join('horse.mp3').write('whinny')
+    assert source.read() == 'neigh'
+    os.utime(str(source), (0, 0))
+    assert os.stat(str(media_dir.join('horse.mp3'))).st_mtime != 0
+
+def test_add_file_keeps_existing(tmpdir, media_dir):
+    media_dir.join('horse.mp3').write('neigh')
+    source = tmpdir.join('horse.mp3')
+    source.write('whinny')
+    assert add_file(str(source), str(media_dir), 'horse.mp3') == u'horse.mp3'
+    assert media_dir.join('horse.mp3').read() == 'neigh'
+
+def test_write_file(media_dir):
+    def write(path):
+        with open(path, 'wb') as f:
+            f.write('neigh')
+    assert write_file(str(media_dir), u'horse.mp3', write) == u'horse.mp3'
+    assert media_dir.listdir() == [media_dir.join('horse.mp3')]
+    assert media_dir.join('horse.mp3').read() == 'neigh'
+
+def test_write_file_failure(media_dir):
+    def write(path):
+        with open(path, 'wb') as f:
+            f.write('nei')
+        raise IOError
+    with pytest.raises(IOError):
+        write_file(str(media_dir), u'horse.mp3', write)
+    assert media_dir.listdir() == []
+
+def test_media_name():
+    assert media_name('horse.mp3') == u'horse.mp3'
+    assert media_name(u'a/b:c?*"<>|.mp3') == u'abc.mp3'
+    assert media_name(u'\u30cf\u309a.mp3') == u'\u30d1.mp3'
+
+def test_write_file_cleans_name(media_dir):
+    def write(path):
+        with open(path, 'wb') as f:
+            f.write('neigh')
+    assert write_file(str(media_dir), u'ho:rse.mp3', write) == u'horse.mp3'
+    assert media_dir.join('horse.mp3').read() == 'neigh'
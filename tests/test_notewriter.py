@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+"""Unit tests for notewriter.py"""
+import mock
+import pytest
+
+from ankihorse.notewriter import NoteWriter
+
+
+@pytest.fixture
+def col():
+    col = mock.MagicMock()
+    col.stored = {}
+    col.db.all.side_effect = lambda sql: list(col.stored.items())
+    col.usn.return_value = -1
+    return col
+
+def note(nid, flds):
+    note = mock.Mock()
+    note.id = nid
+    note.joinedFields.return_value = flds
+    return note
+
+def written(col):
+    return [ [row[-1] for row in c[0][1]]
+             for c in col.db.executemany.call_args_list ]
+
+def test_writes_in_chunks(col):
+    writer = NoteWriter(col, chunk_size=2)
+    for nid in range(5):
+        writer.add(note(nid, u'horse'))
+    assert written(col) == [[0, 1], [2, 3]]
+    writer.commit()
+    assert written(col) == [[0, 1], [2, 3], [4]]
+    assert col.save.call_count == 3
+    assert col.genCards.call_args_list[-1] == mock.call([4])
+    assert col.updateFieldCache.call_args_list[-1] == mock.call([4])
+    assert writer.written == 5
+
+def test_skips_unchanged(col):
+    col.stored = {0: u'horse', 1: u'pony'}
+    with NoteWriter(col) as writer:
+        writer.add(note(0, u'horse'))
+        writer.add(note(1, u'foal'))
+    assert written(col) == [[1]]
+    assert col.save.called
+    assert writer.written == 1
+
+def test_on_commit(col):
+    committed = []
+    writer = NoteWriter(col, chunk_size=2,
+                        on_commit=lambda *args: committed.append(args))
+    notes = [note(0, u'horse'), note(1, u'pony')]
+    for n in notes:
+        writer.add(n)
+    assert committed == [(notes, notes)]
+    writer.commit()
+    assert committed == [(notes, notes)]
+
+def test_on_commit_unsettled(col):
+    committed = []
+    writer = NoteWriter(col, chunk_size=2,
+                        on_commit=lambda *args: committed.append(args))
+    notes = [note(0, u'horse'), note(1, u'pony')]
+    writer.add(notes[0], settled=False)
+    writer.add(notes[1])
+    assert committed == [(notes, notes[1:])]
+
+def test_commits_on_error(col):
+    with pytest.raises(ValueError):
+        with NoteWriter(col) as writer:
+            writer.add(note(0, u'horse'))
+            raise ValueError
+    assert written(col) == [[0]]
@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+"""Unit tests for pipeline.py"""
+import threading
+
+import pytest
+
+from ankihorse.pipeline import Future, background, imap_unordered
+
+
+def test_future_result():
+    future = Future()
+    future.set_result(3)
+    assert future.done()
+    assert future.result() == 3
+
+def test_future_reraises():
+    future = Future()
+    try:
+        raise KeyError('horse')
+    except KeyError:
+        import sys
+        future.set_exc_info(sys.exc_info())
+    with pytest.raises(KeyError):
+        future.result()
+
+def test_future_timeout():
+    with pytest.raises(RuntimeError):
+        Future().result(timeout=0.01)
+
+def test_done_callback_after_done():
+    future = Future()
+    future.set_result(None)
+    called = []
+    future.add_done_callback(called.append)
+    assert called == [future]
+
+def test_imap_unordered_maps_everything():
+    results = dict(imap_unordered(lambda x: x * x, range(50), workers=4))
+    assert results == dict((x, x * x) for x in range(50))
+
+def test_imap_unordered_empty():
+    assert list(imap_unordered(lambda x: x, [], workers=4)) == []
+
+def test_imap_unordered_runs_fn_off_thread():
+    main = threading.current_thread()
+    threads = [t for _, t in imap_unordered(
+                   lambda _: threading.current_thread(), range(10), 3)]
+    assert main not in threads
+
+def test_imap_unordered_consumes_items_on_calling_thread():
+    main = threading.current_thread()
+    seen = []
+    def items():
+        for i in range(10):
+            seen.append(threading.current_thread())
+            yield i
+    list(imap_unordered(lambda x: x, items(), workers=3))
+    assert seen == [main] * 10
+
+def test_imap_unordered_bounds_pending():
+    produced = []
+    def items():
+        for i in range(100):
+            produced.append(i)
+            yield i
+    gen = imap_unordered(lambda x: x, items(), workers=2, max_pending=3)
+    next(gen)
+    assert len(produced) <= 4
+    gen.close()
+
+def test_imap_unordered_raises():
+    def fn(x):
+        if x == 5:
+            raise ValueError(x)
+        return x
+    with pytest.raises(ValueError):
+        list(imap_unordered(fn, range(10), workers=2))
+
+def test_background():
+    release = threading.Event()
+    future = background(lambda x: release.wait(5) and x, 'horse')
+    assert not future.done()
+    release.set()
+    assert future.result(timeout=5) == 'horse'
+
+def test_background_reraises():
+    future = background(dict.__getitem__, {}, 'horse')
+    with pytest.raises(KeyError):
+        future.result(timeout=5)
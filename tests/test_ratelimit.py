@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+"""Unit tests for ratelimit.py"""
+import pytest
+
+from ankihorse import ratelimit
+from ankihorse.config import Config
+from ankihorse.ratelimit import RateLimiter, QuotaExceeded, parse_retry_after
+
+
+class Clock(object):
+    """A fake clock that advances only when slept on."""
+    def __init__(self):
+        self.now = 1000000.0
+        self.slept = 0.0
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+        self.slept += seconds
+
+@pytest.fixture
+def clock():
+    return Clock()
+
+def make(clock, rate, **kwargs):
+    return RateLimiter('horse', rate, clock=clock, sleep=clock.sleep,
+                       **kwargs)
+
+def test_burst_then_rate(clock):
+    limiter = make(clock, 2)
+    limiter.acquire()
+    limiter.acquire()
+    assert clock.slept == 0
+    for _ in range(4):
+        limiter.acquire()
+    assert clock.slept == pytest.approx(2.0)
+
+def test_daily_quota(clock):
+    limiter = make(clock, 100, daily_quota=3)
+    for _ in range(3):
+        limiter.acquire()
+    with pytest.raises(QuotaExceeded):
+        limiter.acquire()
+    clock.now += 24 * 60 * 60
+    limiter.acquire()
+
+def test_throttled_waits_for_retry_after(clock):
+    limiter = make(clock, 4)
+    limiter.throttled(10)
+    limiter.acquire()
+    assert clock.slept >= 10
+    assert limiter.rate == 2
+
+def test_recovers(clock):
+    limiter = make(clock, 4)
+    for _ in range(10):
+        limiter.throttled()
+    assert limiter.rate == limiter.min_rate
+    for _ in range(20):
+        limiter.succeeded()
+    assert limiter.rate == 4
+
+def test_parse_retry_after():
+    assert parse_retry_after(None) is None
+    assert parse_retry_after('120') == 120
+    assert parse_retry_after('Wed, 21 Oct 2015 07:28:00 GMT',
+                             now=1445412450) == 30
+    assert parse_retry_after('soon') is None
+
+def test_limiter_follows_config(monkeypatch, tmpdir):
+    store = Config(str(tmpdir.join('config.json')))
+    store.subscribe(ratelimit._limits_changed, 'rate limits')
+    monkeypatch.setattr(ratelimit, 'store', store)
+    monkeypatch.setattr(ratelimit, '_limiters', {})
+    store.set('rate limits', 'voicerss daily quota', 100)
+    limiter = ratelimit.limiter('voicerss')
+    assert limiter.daily_quota == 100
+    assert ratelimit.limiter('voicerss') is limiter
+    store.set('rate limits', 'voicerss requests per second', 0.5)
+    limiter = ratelimit.limiter('voicerss')
+    assert (limiter.max_rate, limiter.daily_quota) == (0.5, 100)
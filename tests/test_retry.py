@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+"""Unit tests for retry.py"""
+import socket
+from mimetools import Message
+from StringIO import StringIO
+from urllib2 import HTTPError
+
+import mock
+import pytest
+
+from ankihorse import retry
+from ankihorse.retry import RetryPolicy, TransientError, classify
+
+
+def http_error(code, headers=''):
+    return HTTPError('http://horse', code, 'nope', Message(StringIO(headers)),
+                     StringIO(''))
+
+@pytest.fixture
+def slept():
+    return []
+
+@pytest.fixture
+def policy(slept):
+    now = [0.0]
+    def sleep(seconds):
+        slept.append(seconds)
+        now[0] += seconds
+    return RetryPolicy(attempts=4, base_delay=1, max_delay=3, deadline=10,
+                       clock=lambda: now[0], sleep=sleep,
+                       random=lambda: 1.0)
+
+def failing(*errors):
+    """Returns a mock that raises `errors` in turn, then returns 'ok'."""
+    return mock.Mock(side_effect=list(errors) + ['ok'])
+
+def test_classify():
+    assert classify(http_error(401)) == retry.AUTH
+    assert classify(http_error(429)) == retry.THROTTLED
+    assert classify(http_error(503)) == retry.THROTTLED
+    assert classify(http_error(500)) == retry.TRANSIENT
+    assert classify(http_error(404)) == retry.PERMANENT
+    assert classify(socket.timeout()) == retry.TRANSIENT
+    assert classify(TransientError()) == retry.TRANSIENT
+    assert classify(ValueError()) == retry.PERMANENT
+
+def test_success(policy, slept):
+    assert policy.call(lambda x: x, 'ok') == 'ok'
+    assert slept == []
+
+def test_transient_backoff(policy, slept):
+    fn = failing(socket.error(), http_error(500), TransientError())
+    assert policy.call(fn) == 'ok'
+    assert slept == [1, 2, 3]
+
+def test_attempts_run_out(policy):
+    fn = failing(*[TransientError()] * 4)
+    with pytest.raises(TransientError):
+        policy.call(fn)
+    assert fn.call_count == 4
+
+def test_permanent_not_retried(policy):
+    fn = failing(http_error(404))
+    with pytest.raises(HTTPError):
+        policy.call(fn)
+    assert fn.call_count == 1
+
+def test_retry_after_honoured(policy, slept):
+    fn = failing(http_error(429, 'Retry-After: 5\r\n\r\n'))
+    assert policy.call(fn) == 'ok'
+    assert slept == [5]
+
+def test_deadline(policy):
+    fn = failing(http_error(429, 'Retry-After: 20\r\n\r\n'))
+    with pytest.raises(HTTPError):
+        policy.call(fn)
+    assert fn.call_count == 1
+
+def test_auth_refreshed_once(policy, slept):
+    on_auth = mock.Mock()
+    fn = failing(http_error(401))
+    assert policy.call(fn, on_auth=on_auth) == 'ok'
+    assert on_auth.call_count == 1
+    assert slept == []
+
+    fn = failing(http_error(401), http_error(403))
+    with pytest.raises(HTTPError):
+        policy.call(fn, on_auth=on_auth)
+
+def test_auth_without_refresh(policy):
+    fn = failing(http_error(403))
+    with pytest.raises(HTTPError):
+        policy.call(fn)
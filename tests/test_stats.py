@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+"""Unit tests for stats.py"""
+import json
+
+import mock
+import pytest
+
+from ankihorse import stats
+from ankihorse.config import Config
+
+
+@pytest.fixture
+def recording(monkeypatch):
+    monkeypatch.setattr(stats, '_enabled', True)
+    monkeypatch.setattr(stats, '_timers', {})
+
+@pytest.fixture
+def off(monkeypatch):
+    monkeypatch.setattr(stats, '_enabled', False)
+    monkeypatch.setattr(stats, '_timers', {})
+
+def test_disabled_is_free(off):
+    updater = object()
+    assert stats.instrument(updater, 'horse') is updater
+    assert stats.timed('horse', 'fetch') is stats.timed('horse', 'search')
+    with stats.timed('horse', 'fetch'):
+        pass
+    assert stats.snapshot() == {}
+    assert 'off' in stats.report()
+
+def test_enabled_from_config(monkeypatch, tmpdir):
+    monkeypatch.setattr(stats, '_enabled', None)
+    store = Config(str(tmpdir.join('config.json')))
+    store.set('stats', 'enabled', True)
+    monkeypatch.setattr(stats, 'store', store)
+    assert stats.enabled()
+
+def test_config_change_resets(monkeypatch):
+    monkeypatch.setattr(stats, '_enabled', True)
+    stats._config_changed('stats', 'enabled', False)
+    assert stats._enabled is None
+
+def test_record(recording):
+    stats.record('horse', 'fetch', 0.003)
+    stats.record('horse', 'fetch', 0.040)
+    stats.record('horse', 'fetch', 60)
+    figures = stats.snapshot()['horse']['fetch']
+    assert figures['count'] == 3
+    assert figures['total_s'] == pytest.approx(60.043)
+    assert figures['max_ms'] == pytest.approx(60000)
+    assert figures['histogram_ms'] == [[5, 1], [50, 1], ['>10000', 1]]
+
+def test_percentile():
+    timer = stats.Timer()
+    for seconds in [0.001] * 98 + [0.4, 0.4]:
+        timer.add(seconds)
+    assert timer.percentile(0.5) == 1
+    assert timer.percentile(0.99) == 500
+
+def test_timed_counts_failures(recording):
+    with pytest.raises(ValueError):
+        with stats.timed('horse', 'fetch'):
+            raise ValueError()
+    assert stats.snapshot()['horse']['fetch']['count'] == 1
+
+def test_instrument(recording):
+    updater = mock.Mock(pipelined=True)
+    updater.fetch.return_value = 'neigh'
+    instrumented = stats.instrument(updater, 'horse')
+    assert instrumented.pipelined
+    assert instrumented.fetch('query') == 'neigh'
+    instrumented.modifyFields('note')
+    assert sorted(stats.snapshot()['horse']) == ['fetch', 'modify']
+
+def test_dump_and_report(recording, tmpdir):
+    stats.record('horse', 'fetch', 0.1)
+    path = str(tmpdir.join('stats.json'))
+    stats.dump(path)
+    with open(path) as f:
+        assert json.load(f)['horse']['fetch']['count'] == 1
+    assert 'fetch' in stats.report()
+    stats.reset()
+    assert stats.snapshot() == {}
@@ -1,7 +1,10 @@
 #!/usr/bin/env python
 # -*- encoding: utf-8 -*-
 """Unit tests for updateraddon.py"""
-from ankihorse import updateraddon
+import time
+
+from ankihorse import stats, updateraddon
+from ankihorse.config import Config
 from ankihorse.updateraddon import FieldUpdater, Addon
 import pytest
 import mock
@@ -47,6 +50,7 @@ def patches(monkeypatch):
 
     def fieldNames(model): return [ f['name'] for f in model['flds'] ]
     patches['mw'].col.models.fieldNames = fieldNames
+    monkeypatch.setattr(updateraddon, '_model_infos', {})
     return patches
 
 @pytest.fixture
@@ -115,6 +119,12 @@ def test_valid_model(field_updater, addon, good_note):
     field_updater.modify_return_value = False
     assert not addon.modifyFields(good_note)
 
+def test_modify_timed(monkeypatch, field_updater, addon, good_note):
+    monkeypatch.setattr(stats, '_enabled', True)
+    monkeypatch.setattr(stats, '_timers', {})
+    addon.modifyFields(good_note)
+    assert stats.snapshot()['test']['modify']['count'] == 1
+
 #class OnFocusLostTestCase(unittest.TestCase):
 #
 #    @mock.patch('{}.updateraddon.SIGNAL'.format(__name__))
@@ -143,4 +153,317 @@ def test_valid_model(field_updater, addon, good_note):
 #        self.assertFalse(self.addon.onFocusLost(False, note, 0))
         
 
-#TODO: tests for regenerateAll
+class MockPipelinedFieldUpdater(MockFieldUpdater):
+    """Pipelined field updater for testing purposes."""
+    pipelined = True
+
+    def queryFor(self, note):
+        return note.query
+
+    def fetch(self, query):
+        return query.upper()
+
+    def applyFetched(self, note, query, result):
+        note.result = result
+        return True
+
+class HalfPipelinedFieldUpdater(MockFieldUpdater):
+    """Claims to be pipelined, but only implements queryFor."""
+    pipelined = True
+
+    def queryFor(self, note):
+        return note.query
+
+def test_pipelined_must_implement_pipeline(patches):
+    with pytest.raises(TypeError) as error:
+        Addon(HalfPipelinedFieldUpdater(('src',), ('tgt',)), 'test')
+    assert 'fetch, applyFetched' in str(error.value)
+    Addon(MockPipelinedFieldUpdater(('src',), ('tgt',)), 'test')
+
+@pytest.fixture
+def regenerate_patches(monkeypatch, tmpdir, patches, valid_model):
+    for name in ('askUser', 'showInfo'):
+        patches[name] = mock.MagicMock()
+        monkeypatch.setattr(updateraddon, name, patches[name])
+    patches['askUser'].return_value = True
+
+    valid_model['id'] = 1
+    for i, field in enumerate(valid_model['flds']):
+        field['ord'] = i
+    names = [f['name'] for f in valid_model['flds']]
+
+    notes = {}
+    for nid, query in enumerate(['horse', None, 'pony']):
+        fields = dict((name, u'') for name in names)
+        fields['src1'] = query or u''
+        notes[nid] = mock.MagicMock()
+        notes[nid].id = nid
+        notes[nid].fields = fields
+        notes[nid].__getitem__.side_effect = fields.__getitem__
+        notes[nid].__contains__.side_effect = fields.__contains__
+        notes[nid].query = query
+        notes[nid].result = None
+
+    def all(sql, *args):
+        if 'where mid' not in sql:
+            return []
+        return [ (nid, u'\x1f'.join(note.fields[n] for n in names))
+                 for nid, note in sorted(notes.items()) ]
+
+    patches['mw'].col.models.all.return_value = [valid_model]
+    patches['mw'].col.db.all.side_effect = all
+    patches['mw'].col.getNote.side_effect = notes.__getitem__
+    patches['mw'].pm.profileFolder.return_value = str(tmpdir)
+    patches['mw'].col.media.strip.side_effect = lambda s: s
+    patches['notes'] = notes
+    return patches
+
+def loaded(mw):
+    return sorted(c[0][0] for c in mw.col.getNote.call_args_list)
+
+def written(mw):
+    return sorted(row[-1] for c in mw.col.db.executemany.call_args_list
+                          for row in c[0][1])
+
+def test_needs_modification(field_updater):
+    fields = {'src1': u'', 'src2': u'horse', 'tgt1': u'', 'tgt2': u'neigh'}
+    assert field_updater.needsModification(fields)
+    field_updater.overwrites = False
+    assert not field_updater.needsModification(fields)
+    fields['tgt2'] = u''
+    assert field_updater.needsModification(fields)
+    fields['src2'] = u''
+    assert not field_updater.needsModification(fields)
+
+def test_regenerate_serial(regenerate_patches, field_updater):
+    Addon(field_updater, 'test').regenerateAll()
+    assert loaded(regenerate_patches['mw']) == [0, 2]
+    assert written(regenerate_patches['mw']) == [0, 2]
+
+def test_regenerate_pipelined(regenerate_patches):
+    field_updater = MockPipelinedFieldUpdater(('src1', 'src2'),
+                                              ('tgt1', 'tgt2'))
+    Addon(field_updater, 'test', fetch_workers=3).regenerateAll()
+    notes = regenerate_patches['notes']
+    assert [notes[i].result for i in sorted(notes)] == ['HORSE', None, 'PONY']
+    assert written(regenerate_patches['mw']) == [0, 2]
+    assert not any(note.flush.called for note in notes.values())
+
+def test_regenerate_pipelined_dedupes(regenerate_patches):
+    field_updater = MockPipelinedFieldUpdater(('src1', 'src2'),
+                                              ('tgt1', 'tgt2'))
+    fetch = mock.MagicMock(side_effect=lambda query: query.upper())
+    field_updater.fetch = fetch
+    notes = regenerate_patches['notes']
+    notes[1].query = notes[1].fields['src1'] = 'horse '
+    notes[2].query = notes[2].fields['src1'] = 'horse'
+    Addon(field_updater, 'test', fetch_workers=3).regenerateAll()
+    fetch.assert_called_once_with('horse')
+    assert [notes[i].result for i in sorted(notes)] == ['HORSE'] * 3
+    assert written(regenerate_patches['mw']) == [0, 1, 2]
+
+def test_query_key():
+    assert updateraddon.query_key(u' a  horse\n') == u'a horse'
+    assert updateraddon.query_key(('a', 'horse')) == ('a', 'horse')
+
+def test_regenerator_progress(regenerate_patches, field_updater):
+    progress = mock.Mock()
+    regenerator = updateraddon.Regenerator(field_updater, 'test')
+    nids, unmodified = regenerator.candidates(changed_only=False)
+    regenerator.regenerate(nids, unmodified, progress)
+    progress.assert_called_once_with(2, 2)
+    assert written(regenerate_patches['mw']) == [0, 2]
+    assert not regenerate_patches['showInfo'].called
+
+def test_regenerate_skips_filled_targets(regenerate_patches, field_updater):
+    field_updater.overwrites = False
+    regenerate_patches['notes'][2].fields['tgt1'] = u'neigh'
+    Addon(field_updater, 'test').regenerateAll()
+    assert loaded(regenerate_patches['mw']) == [0]
+
+def test_regenerate_changed(regenerate_patches, field_updater):
+    mw = regenerate_patches['mw']
+    notes = regenerate_patches['notes']
+    field_updater.modify_return_value = True
+    addon = Addon(field_updater, 'test')
+    addon.regenerateChanged()
+    assert loaded(mw) == [0, 2]
+
+    mw.col.getNote.reset_mock()
+    addon.regenerateChanged()
+    assert not mw.col.getNote.called
+
+    # a source changes and a target is filled in by hand
+    notes[0].fields['src1'] = u'stallion'
+    notes[2].fields['tgt2'] = u'neigh'
+    addon.regenerateChanged()
+    assert loaded(mw) == [0, 2]
+
+def test_regenerate_changed_retries_failures(regenerate_patches,
+                                              field_updater):
+    mw = regenerate_patches['mw']
+    addon = Addon(field_updater, 'test')
+    field_updater.modify_return_value = False  # e.g. the fetch failed
+    addon.regenerateChanged()
+    assert loaded(mw) == [0, 2]
+
+    mw.col.getNote.reset_mock()
+    field_updater.modify_return_value = True
+    addon.regenerateChanged()
+    assert loaded(mw) == [0, 2]
+
+    mw.col.getNote.reset_mock()
+    addon.regenerateChanged()
+    assert not mw.col.getNote.called
+
+def test_regenerate_pipelined_retries_failures(regenerate_patches):
+    mw = regenerate_patches['mw']
+    field_updater = MockPipelinedFieldUpdater(('src1', 'src2'),
+                                              ('tgt1', 'tgt2'))
+    field_updater.fetch = lambda query: None if query == 'pony' else query
+    field_updater.applyFetched = lambda note, query, result: bool(result)
+    addon = Addon(field_updater, 'test', fetch_workers=3)
+    addon.regenerateChanged()
+    mw.col.getNote.reset_mock()
+    addon.regenerateChanged()
+    assert loaded(mw) == [2]
+
+@pytest.fixture
+def timers(patches):
+    timers = []
+    def timer(ms, callback, repeat):
+        timers.append((callback, repeat))
+        return mock.MagicMock()
+    patches['mw'].progress.timer.side_effect = timer
+    return timers
+
+@pytest.fixture
+def async_addon(patches, timers):
+    field_updater = MockPipelinedFieldUpdater(('src1', 'src2'),
+                                              ('tgt1', 'tgt2'))
+    return Addon(field_updater, 'test', on_focus_lost=True,
+                 async_focus_lost=True)
+
+@pytest.fixture
+def focus_note(valid_model):
+    note = mock.MagicMock()
+    note.id = 1
+    note.model.return_value = valid_model
+    note.query = 'horse'
+    note.result = None
+    return note
+
+def fire(timers):
+    """Runs the pending single-shot timers."""
+    for callback, repeat in [t for t in timers if not t[1]]:
+        timers.remove((callback, repeat))
+        callback()
+
+def drain(addon):
+    for _ in range(200):
+        addon._drainResults()
+        if not addon._pending:
+            return
+        time.sleep(0.01)
+    raise AssertionError('fetch did not finish')
+
+def test_async_hook(patches, async_addon):
+    patches['addHook'].assert_any_call('editFocusLost',
+                                       async_addon.onFocusLostAsync)
+
+def test_async_off_by_default(monkeypatch, tmpdir, patches):
+    store = Config(str(tmpdir.join('config.json')))
+    monkeypatch.setattr(updateraddon, 'store', store)
+    field_updater = MockPipelinedFieldUpdater(('src1', 'src2'),
+                                              ('tgt1', 'tgt2'))
+    addon = Addon(field_updater, 'test', on_focus_lost=True)
+    patches['addHook'].assert_any_call('editFocusLost', addon.onFocusLost)
+
+    store.set('editor', 'async focus lost', True)
+    addon = Addon(field_updater, 'test', on_focus_lost=True)
+    patches['addHook'].assert_any_call('editFocusLost',
+                                       addon.onFocusLostAsync)
+
+def test_async_focus_lost(async_addon, timers, focus_note):
+    editor = mock.MagicMock()
+    editor.note = focus_note
+    async_addon._onLoadNote(editor)
+
+    assert not async_addon.onFocusLostAsync(False, focus_note, 0)
+    assert focus_note.result is None
+    fire(timers)
+    drain(async_addon)
+    assert focus_note.result == 'HORSE'
+    assert focus_note.flush.called
+    assert editor.loadNote.called
+
+def test_async_focus_lost_ignores_targets(async_addon, timers, focus_note):
+    async_addon.onFocusLostAsync(False, focus_note, 2)
+    assert not timers
+
+def test_async_focus_lost_debounced(async_addon, timers, focus_note):
+    fetch = mock.MagicMock(side_effect=lambda query: query.upper())
+    async_addon._field_updater.fetch = fetch
+    async_addon.onFocusLostAsync(False, focus_note, 0)
+    focus_note.query = 'pony'
+    async_addon.onFocusLostAsync(False, focus_note, 0)
+    fire(timers)
+    drain(async_addon)
+    fetch.assert_called_once_with('pony')
+    assert focus_note.result == 'PONY'
+
+def test_async_focus_lost_stale(async_addon, timers, focus_note):
+    async_addon.onFocusLostAsync(False, focus_note, 0)
+    fire(timers)
+    focus_note.query = 'pony'  # edited while fetching
+    drain(async_addon)
+    assert focus_note.result is None
+    assert not focus_note.flush.called
+
+def test_async_focus_lost_fetch_fails(monkeypatch, async_addon, timers,
+        focus_note, valid_model):
+    show_info = mock.MagicMock()
+    monkeypatch.setattr(updateraddon, 'showInfo', show_info)
+    def fetch(query):
+        if query == 'horse':
+            raise IOError('no horses')
+        return query.upper()
+    async_addon._field_updater.fetch = fetch
+    other_note = mock.MagicMock()
+    other_note.id = 2
+    other_note.model.return_value = valid_model
+    other_note.query = 'pony'
+    other_note.result = None
+    async_addon.onFocusLostAsync(False, focus_note, 0)
+    async_addon.onFocusLostAsync(False, other_note, 0)
+    fire(timers)
+    drain(async_addon)
+    assert 'no horses' in show_info.call_args[0][0]
+    assert focus_note.result is None
+    assert other_note.result == 'PONY'
+    assert async_addon._poll_timer is None
+
+def test_eligibility_cached_per_model_version(patches, field_updater,
+        valid_model):
+    valid_model['id'], valid_model['mod'] = 7, 100
+    field_updater.shouldModify = mock.MagicMock(return_value=True)
+    addon = Addon(field_updater, 'test')
+    assert addon.shouldModify(valid_model)
+    assert addon.shouldModify(valid_model)
+    assert field_updater.shouldModify.call_count == 1
+
+    # editing the note type bumps its mod
+    valid_model['mod'] = 101
+    valid_model['flds'] = valid_model['flds'][:1]
+    field_updater.shouldModify.return_value = False
+    assert not addon.shouldModify(valid_model)
+    assert field_updater.shouldModify.call_count == 2
+    assert updateraddon.model_info(valid_model).field_names == ['src1']
+
+def test_eligibility_per_addon(patches, field_updater, valid_model):
+    valid_model['id'], valid_model['mod'] = 8, 100
+    good = Addon(field_updater, 'test',
+                 model_name_substring=valid_model['name'])
+    bad = Addon(field_updater, 'test', model_name_substring='__ASDF')
+    assert good.shouldModify(valid_model)
+    assert not bad.shouldModify(valid_model)